@@ -0,0 +1,20 @@
+"""
+One-off command computing the running balances of existing accounts.
+
+It should be run once on databases created before the `balances` table
+existed, before enabling the `PRECOMPUTED_BALANCES` option:
+
+>>> cd src/ && python backfill.py
+"""
+import asyncio
+
+from handler import Handler
+
+
+async def main():
+    handler = await Handler.create()
+    await handler.backfill_balances()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    asyncio.run(main())
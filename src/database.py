@@ -1,7 +1,12 @@
 import asyncio
 import dataclasses
+import functools
 import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from enum import Enum
+from typing import AsyncIterator
 
 import aiomysql
 
@@ -9,11 +14,51 @@ import utils
 
 logger = utils.get_logger(__name__)
 
+# When set, reads of the current context (i.e. request) are sent to the
+# primary instead of a replica, so that they see its latest writes
+_read_from_primary: ContextVar[bool] = ContextVar(
+    "read_from_primary", default=False)
+
+# Connections bound to the current context (i.e. request) by
+# `Database.request_scope`, by pool. None outside of such a scope
+_scoped_connections: ContextVar[dict | None] = ContextVar(
+    "scoped_connections", default=None)
+
+
+# Values bound to the `%s` placeholders of a query
+QueryArgs = tuple[str | int | float | None, ...]
+
 
 class Tables(Enum):
     transfers = "transfers"
     customers = "customers"
     accounts = "accounts"
+    balances = "balances"
+    schema_versions = "schema_versions"
+    idempotency_keys = "idempotency_keys"
+    balance_shards = "balance_shards"
+    balance_checkpoints = "balance_checkpoints"
+
+
+# Raised when a row conflicts with an existing one on a unique key
+IntegrityError = aiomysql.IntegrityError
+
+# Default maximum number of rows inserted by a single INSERT statement
+INSERT_MANY_CHUNK_SIZE = 1000
+
+# Default number of rows read at once from the server by `Database.stream`
+STREAM_FETCH_SIZE = 500
+
+
+@functools.lru_cache(maxsize=256)
+def insert_query(table: Tables, fields: tuple[str, ...], rows: int = 1) -> str:
+    """
+    Build, once per table, fields & number of rows, the parameterized
+    query inserting `rows` rows with the given fields
+    """
+    placeholders = ", ".join(["%s"] * len(fields))
+    values = ", ".join([f"({placeholders})"] * rows)
+    return f"INSERT INTO {table.value} ({', '.join(fields)}) VALUES {values}"
 
 
 @dataclasses.dataclass
@@ -23,37 +68,274 @@ class DBConnectionData:
     user: str
     password: str
     dbname: str
+    # connections opened when the pool is created, and kept open
+    pool_minsize: int = 1
+    # maximum number of connections opened at once to each server. Those to
+    # the primary are shared by its pools for writes & for reads
+    pool_maxsize: int = 10
+    # the primary's connections reserved to reads (0: none, the reads
+    # share the writes' connections. None: half of them without replicas,
+    # none with replicas, which serve most reads)
+    primary_read_maxsize: int | None = None
+    # connections older than this number of seconds are re-opened
+    # (-1: never)
+    pool_recycle: int = -1
+    # maximum number of seconds to wait for a free connection
+    # (None: no limit)
+    acquire_timeout: float | None = None
+    # (host, port) of the read replicas. Reads go to the primary if empty
+    replicas: list[tuple[str, int]] = dataclasses.field(default_factory=list)
+    # reuse a single connection per pool for all queries of a request
+    request_scoped: bool = False
+
+    @staticmethod
+    def __parse_address(address: str) -> tuple[str, int]:
+        """
+        Parse a `host:port` address
+        It should raise if the port has not the right format
+        """
+        host, port = address.split(":")
+        try:
+            return host, int(port)
+        except ValueError as e:
+            raise ValueError(f"Error: Wrong db port format: {port}!") from e
+
+    @staticmethod
+    def __parse_env(name: str, type_: type, default: int | float | None):
+        """
+        Read the environment `name`, cast into `type_`
+        It should raise if it has not the right format
+        """
+        value = os.getenv(name)
+        if value is None:
+            return default
+        try:
+            return type_(value)
+        except ValueError as e:
+            raise ValueError(f"Error: Wrong {name} format: {value}!") from e
 
     @classmethod
     def from_environment(cls) -> "DBConnectionData":
         """
         Read Database  address, credentials & db name from environments
+        as well as the connection pool's options
         """
         # load from environments
-        host, port = os.getenv("MYSQL_DB_ADDRESS").split(":")
+        # transform ports to int
+        # it should raise if a port has not the right format
+        host, port = cls.__parse_address(os.getenv("MYSQL_DB_ADDRESS"))
         user = os.getenv("MYSQL_USER")
         password = os.getenv("MYSQL_PASSWORD")
         dbname = os.getenv("MYSQL_DATABASE")
-
-        # transform port to an int
-        # it should raise if the port has not the right format
-        try:
-            port = int(port)
-        except ValueError as e:
-            raise ValueError(f"Error: Wrong db port format: {port}!") from e
+        # comma-separated list of replicas' addresses
+        replicas = [
+            cls.__parse_address(address.strip())
+            for address in os.getenv("MYSQL_REPLICA_ADDRESSES", "").split(",")
+            if address.strip()
+        ]
 
         return cls(
             host=host,
             port=port,
             user=user,
             password=password,
-            dbname=dbname
+            dbname=dbname,
+            pool_minsize=cls.__parse_env("MYSQL_POOL_MINSIZE", int, 1),
+            pool_maxsize=cls.__parse_env("MYSQL_POOL_MAXSIZE", int, 10),
+            primary_read_maxsize=cls.__parse_env(
+                "MYSQL_PRIMARY_READ_POOL_MAXSIZE", int, None),
+            pool_recycle=cls.__parse_env("MYSQL_POOL_RECYCLE", int, -1),
+            acquire_timeout=cls.__parse_env(
+                "MYSQL_POOL_ACQUIRE_TIMEOUT", float, None),
+            replicas=replicas,
+            request_scoped=utils.get_env_flag(
+                "MYSQL_REQUEST_SCOPED_CONNECTIONS"),
+        )
+
+    def primary_pool_sizes(
+            self
+    ) -> tuple[tuple[int, int], tuple[int, int] | None]:
+        """
+        Split the primary's connections, [pool_minsize, pool_maxsize],
+        between its pool for writes and its pool for reads, so that no more
+        than `pool_maxsize` connections are opened to the primary.
+        If no connection is left for the reads' pool (e.g. a single one),
+        the reads share the writes' pool.
+        It should raise if the writes' pool would get no connection
+
+        :return: the (minsize, maxsize) of the writes' pool,
+           and of the reads' pool, None if they share the writes' one
+        """
+        read_maxsize = self.primary_read_maxsize
+        if read_maxsize is None:
+            read_maxsize = 0 if self.replicas else self.pool_maxsize // 2
+        if not 0 <= read_maxsize < self.pool_maxsize:
+            raise ValueError(
+                f"Error: Wrong primary's read pool size: {read_maxsize}! "
+                f"It should be positive or 0, and less than "
+                f"MYSQL_POOL_MAXSIZE={self.pool_maxsize}")
+        if read_maxsize == 0:
+            return (self.pool_minsize, self.pool_maxsize), None
+        read_minsize = self.pool_minsize * read_maxsize // self.pool_maxsize
+        return (
+            (self.pool_minsize - read_minsize,
+             self.pool_maxsize - read_maxsize),
+            (read_minsize, read_maxsize),
         )
 
 
+@dataclasses.dataclass
+class PoolStats:
+    """
+    Counters about the connections acquired from a pool
+    """
+    # number of acquired connections
+    acquired: int = 0
+    # number of callers currently waiting for a connection
+    waiting: int = 0
+    # number of acquisitions that timed out
+    timeouts: int = 0
+    # total & maximum time spent waiting for a connection
+    wait_seconds_total: float = 0.
+    wait_seconds_max: float = 0.
+
+    def record_wait(self, seconds: float):
+        self.acquired += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+
+class Transaction(object):
+    """
+    Statements executed on the connection of an ongoing transaction.
+    It is created by `Database.transaction`, which commits or rolls back
+    """
+    def __init__(self, cursor: aiomysql.Cursor):
+        self._curr = cursor
+
+    async def execute(self, query: str, args: QueryArgs | None = None):
+        """
+        Execute the given SQL query and return all the found results
+
+        :param query: SQL query, with a `%s` placeholder for each argument
+        :param args: the query's arguments, escaped by the client
+        """
+        logger.debug(f"MySQL: Executing query={query} args={args}")
+        await self._curr.execute(query, args)
+        return await self._curr.fetchall()
+
+    async def insert(self, table: Tables, *field_values: str | int | float) -> int:
+        """
+        Insert a new row into table with the given fields & values
+
+        :param table: Table where to insert the new row
+        :param field_values: Fields & values to insert.
+        :return: The newly created row's id
+
+        **Example**
+        >> tx.insert(Tables.customers, "name", "John Smith")
+        """
+        if len(field_values) % 2 != 0:
+            raise ValueError("Each inserted value should have a field name")
+        # the values are sent separately from the query, and escaped
+        fields, values = tuple(field_values[::2]), tuple(field_values[1::2])
+        query = insert_query(table, fields)
+        logger.debug(f"MySQL: Executing query={query} args={values}")
+        await self._curr.execute(query, values)
+        logger.debug(
+            f"Successfully inserted new row fields={fields} values={values} "
+            f"into table={table.value}")
+        return self._curr.lastrowid
+
+    async def insert_or_get(
+            self,
+            table: Tables,
+            *field_values: str | int | float
+    ) -> int:
+        """
+        Insert a new row into table with the given fields & values, unless
+        it conflicts with an existing row on a unique key. In a single
+        statement, without any race between concurrent clients
+
+        :return: The new row's id, or the existing row's id
+
+        **Example**
+        >> tx.insert_or_get(Tables.customers, "name", "John Smith")
+        """
+        if len(field_values) % 2 != 0:
+            raise ValueError("Each inserted value should have a field name")
+        fields, values = tuple(field_values[::2]), tuple(field_values[1::2])
+        # on conflict, LAST_INSERT_ID(id) makes the existing row's id
+        # the one returned to the client
+        query = (
+            f"{insert_query(table, fields)} "
+            f"ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)")
+        logger.debug(f"MySQL: Executing query={query} args={values}")
+        await self._curr.execute(query, values)
+        return self._curr.lastrowid
+
+    async def insert_many(
+            self,
+            table: Tables,
+            fields: tuple[str, ...],
+            rows: list[QueryArgs],
+            chunk_size: int = INSERT_MANY_CHUNK_SIZE
+    ) -> list[int]:
+        """
+        Insert all `rows` into table.
+        Rows are sent by chunks of `chunk_size` rows, each chunk being a
+        single multi-rows INSERT statement
+
+        :param table: Table where to insert the new rows
+        :param fields: Fields names, common to all rows
+        :param rows: Values to insert, in the same order as `fields`
+        :param chunk_size: maximum number of rows per INSERT statement
+        :return: The newly created rows' ids, in the same order as `rows`.
+           They are consecutive: the server's `auto_increment_increment`
+           should be 1 (its default, unlike multi-primary setups)
+
+        **Example**
+        >> tx.insert_many(Tables.customers, ("name",), [("John",), ("Kevin",)])
+        """
+        if chunk_size <= 0:
+            raise ValueError("The chunk size should be positive")
+        if any(len(row) != len(fields) for row in rows):
+            raise ValueError("Each inserted row should have a value per field")
+
+        ids = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            query = insert_query(table, fields, rows=len(chunk))
+            logger.debug(
+                f"MySQL: Executing multi-rows insert into "
+                f"table={table.value} rows={len(chunk)}")
+            await self._curr.execute(
+                query, tuple(v for row in chunk for v in row))
+            # InnoDB allocates consecutive ids to the rows of a
+            # single multi-rows insert (with auto_increment_increment=1).
+            # `lastrowid` is the first one
+            ids.extend(range(
+                self._curr.lastrowid, self._curr.lastrowid + len(chunk)))
+        logger.debug(
+            f"Successfully inserted {len(rows)} new rows "
+            f"into table={table.value}")
+        return ids
+
+
 class Database(object):
     def __init__(self):
+        # the primary's pool, used for writes
         self._pool: aiomysql.Pool | None = None
+        # the primary's pool used for reads, in autocommit mode. Or its
+        # pool for writes, if they share it
+        self._primary_read_pool: aiomysql.Pool | None = None
+        self._shared_primary_pool = False
+        # the replicas' pools, used for reads, in turn, in autocommit mode
+        self._read_pools: list[aiomysql.Pool] = []
+        self._next_read_pool = 0
+        self._acquire_timeout: float | None = None
+        self._request_scoped = False
+        self._pool_stats: dict[aiomysql.Pool, PoolStats] = {}
 
     @classmethod
     async def create(cls) -> "Database":
@@ -68,21 +350,228 @@ class Database(object):
         # Read Database  address, credentials & db name from environments
         data = DBConnectionData.from_environment()
 
+        # create the pools
+        # Reads don't need any transaction: their pools are in autocommit
+        # mode, so that a read doesn't need to be followed by a COMMIT.
+        # The primary's connections are split between its 2 pools, if
+        # there are enough of them
+        write_sizes, read_sizes = data.primary_pool_sizes()
+        replica_sizes = (data.pool_minsize, data.pool_maxsize)
+        self._pool, *self._read_pools = await asyncio.gather(
+            self.__create_pool(data, data.host, data.port, write_sizes),
+            *[
+                self.__create_pool(
+                    data, host, port, replica_sizes, autocommit=True)
+                for host, port in data.replicas
+            ],
+        )
+        self._primary_read_pool = self._pool
+        self._shared_primary_pool = read_sizes is None
+        if read_sizes is not None:
+            self._primary_read_pool = await self.__create_pool(
+                data, data.host, data.port, read_sizes, autocommit=True)
+        self._pool_stats = {
+            pool: PoolStats() for pool in self.__pools()}
+        self._acquire_timeout = data.acquire_timeout
+        self._request_scoped = data.request_scoped
+        return self
+
+    @staticmethod
+    async def __create_pool(
+            data: DBConnectionData,
+            host: str,
+            port: int,
+            sizes: tuple[int, int],
+            autocommit: bool = False
+    ) -> aiomysql.Pool:
+        """
+        Create a pool of [minsize, maxsize] (`sizes`) connections to the
+        MySQL server at host:port
+        It opens `minsize` connections before returning, so that the
+        first requests don't have to wait for them
+        """
+        minsize, maxsize = sizes
         # The password is not logged (even debug) for security reasons
         logger.info(
-            f"Connecting to Database=(address={data.host}:{data.port} "
-            f"creds={data.user}:xxx dbname={data.dbname} )")
-
-        # create the pool
-        self._pool = await aiomysql.create_pool(
-            host=data.host, port=data.port,
+            f"Connecting to Database=(address={host}:{port} "
+            f"creds={data.user}:xxx dbname={data.dbname} "
+            f"pool=[{minsize}, {maxsize}] )")
+        return await aiomysql.create_pool(
+            host=host, port=port,
             user=data.user, password=data.password,
-            db=data.dbname, autocommit=False)
-        return self
+            db=data.dbname, autocommit=autocommit,
+            minsize=minsize, maxsize=maxsize,
+            pool_recycle=data.pool_recycle)
+
+    def __pools(self) -> list[aiomysql.Pool]:
+        # the primary's reads might share the writes' pool
+        pools = [self._pool, self._primary_read_pool, *self._read_pools]
+        return [
+            pool
+            for pool in dict.fromkeys(pools)
+            if pool is not None
+        ]
 
     def __del__(self):
-        if self._pool:
-            self._pool.close()
+        for pool in self.__pools():
+            pool.close()
+
+    @staticmethod
+    def pin_primary():
+        """
+        Send all next reads of the current context (i.e. request)
+        to the primary, so that they see its latest writes
+        """
+        _read_from_primary.set(True)
+
+    @staticmethod
+    @asynccontextmanager
+    async def detached_scope():
+        """
+        Run the work of the context, shared with other requests (e.g. in
+        a task), in its own request scope if the current context (i.e.
+        request) has one: its queries reuse the same connections, which
+        are never bound to this request, which might be over before it.
+        They are released at the end of the context.
+        The reads' pinning to the primary is kept
+
+        >> async with db.request_scope():
+        >>     async with Database.detached_scope():
+        >>         await db.read(...)  # acquire a connection
+        >>         await db.read(...)  # reuse it
+        >>     await db.read(...)  # acquire another one, for the request
+        """
+        if _scoped_connections.get() is None:
+            yield
+            return
+        scope = {}
+        token = _scoped_connections.set(scope)
+        try:
+            yield
+        finally:
+            _scoped_connections.reset(token)
+            for pool, conn in scope.items():
+                await pool.release(conn)
+
+    @staticmethod
+    def is_primary_pinned() -> bool:
+        """
+        Whether the reads of the current context are sent to the primary
+        """
+        return _read_from_primary.get()
+
+    def _read_pool(self) -> aiomysql.Pool:
+        """
+        Return the pool to read from: the replicas' pools in turn,
+        or the primary's if there are none or if the reads are pinned to it
+        """
+        if not self._read_pools or _read_from_primary.get():
+            return self._primary_read_pool
+        self._next_read_pool = (self._next_read_pool + 1) % len(self._read_pools)
+        return self._read_pools[self._next_read_pool]
+
+    @asynccontextmanager
+    async def request_scope(self):
+        """
+        Within this context (i.e. a request), the first query on a pool binds
+        its connection to the context: the next queries on this pool reuse it,
+        instead of acquiring a new one. The connections are released at the
+        end of the context.
+        It does nothing if the request-scoped connections are disabled
+
+        >> async with db.request_scope():
+        >>     await db.read(...)  # acquire a connection
+        >>     await db.read(...)  # reuse it
+        """
+        if not self._request_scoped or _scoped_connections.get() is not None:
+            yield
+            return
+        scope = {}
+        _scoped_connections.set(scope)
+        try:
+            yield
+        finally:
+            _scoped_connections.set(None)
+            for pool, conn in scope.items():
+                await pool.release(conn)
+
+    @asynccontextmanager
+    async def _acquire(
+            self,
+            pool: aiomysql.Pool | None = None,
+            scoped: bool = True
+    ) -> AsyncIterator[aiomysql.Connection]:
+        """
+        Acquire a connection from `pool` (the primary's by default)
+        for the duration of the context.
+        Within a request scope (see `request_scope`), the connection bound to
+        the request is used, if it is not already in use. Otherwise, a new one
+        is acquired from the pool, unless `scoped` is False
+        """
+        pool = pool or self._pool
+        scope = _scoped_connections.get() if scoped else None
+        # the bound connection is taken out of the scope while it's in use:
+        # concurrent queries of the same request get their own connection
+        conn = scope.pop(pool, None) if scope is not None else None
+        if conn is None:
+            conn = await self.__acquire_from(pool)
+        try:
+            yield conn
+        except BaseException:
+            # the connection might be in an unknown state (e.g. an ongoing
+            # transaction): it's given back to the pool, which handles it
+            await pool.release(conn)
+            raise
+        if scope is not None and pool not in scope:
+            scope[pool] = conn
+        else:
+            await pool.release(conn)
+
+    async def __acquire_from(
+            self,
+            pool: aiomysql.Pool
+    ) -> aiomysql.Connection:
+        """
+        Acquire a connection from `pool`, and record how long it took.
+        If no connection is free after the acquire timeout,
+        a TimeoutError is raised
+        """
+        stats = self._pool_stats[pool]
+        start = time.monotonic()
+        stats.waiting += 1
+        try:
+            conn = await asyncio.wait_for(
+                pool.acquire(), self._acquire_timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            logger.warning(
+                f"MySQL: no free connection after {self._acquire_timeout}s")
+            raise
+        finally:
+            stats.waiting -= 1
+        stats.record_wait(time.monotonic() - start)
+        return conn
+
+    def __pool_stats(self, pool: aiomysql.Pool) -> dict:
+        return {
+            "minsize": pool.minsize,
+            "maxsize": pool.maxsize,
+            "size": pool.size,
+            "free": pool.freesize,
+            "used": pool.size - pool.freesize,
+            **dataclasses.asdict(self._pool_stats[pool]),
+        }
+
+    def stats(self) -> dict:
+        """
+        Return the pools' occupancy and the time spent waiting for their
+        connections, useful to size the pools
+        """
+        return {
+            "primary": self.__pool_stats(self._pool),
+            "primary_read": self.__pool_stats(self._primary_read_pool),
+            "replicas": [self.__pool_stats(p) for p in self._read_pools],
+        }
 
     async def __create_table(self, table: Tables, *columns: str):
         """
@@ -110,17 +599,20 @@ class Database(object):
             f"(id int NOT NULL AUTO_INCREMENT, {fields}, PRIMARY KEY (id))"
         )
         logger.info(f"[MySQL] Create new table from query=\"{query}\"")
-        async with self._pool.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as curr:
                 await curr.execute(query)
                 await conn.commit()
 
     async def create_tables(self):
         """
-        Create the 3 tables: transfers, accounts, customers
+        Create the 5 tables: transfers, accounts, customers, balances
+        and schema_versions
         The creation happens only if they don't exist
+        Any later change to the schema is done by a migration
+        (see `migrations.py`)
         """
-        await asyncio.wait([
+        await asyncio.gather(
             self.__create_table(
                 Tables.transfers,
                 "from_id", "int",
@@ -137,49 +629,170 @@ class Database(object):
                 Tables.customers,
                 "name", "Varchar(1023)",
             ),
-        ])
+            # running credits & debits, the id being the account's id
+            self.__create_table(
+                Tables.balances,
+                "credits", "double NOT NULL DEFAULT 0",
+                "debits", "double NOT NULL DEFAULT 0",
+            ),
+            # the applied migrations
+            self.__create_table(
+                Tables.schema_versions,
+                "version", "int NOT NULL UNIQUE",
+                "description", "Varchar(255)",
+                "`utc_timestamp`", "int",
+            ),
+        )
 
-    async def insert(self, table: Tables, *field_values: str | int | float) -> int:
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["Transaction"]:
         """
-        Insert a new row into table with the given fields & values
+        Run the statements of the context in a single transaction, on a
+        single connection of the primary.
+        The transaction is committed at the end of the context, or rolled
+        back if an exception is raised
 
-        :param table: Table where to insert the new row
-        :param field_values: Fields & values to insert.
-        :return: The newly created row's id
+        >> async with db.transaction() as tx:
+        >>     customer_id = await tx.insert(Tables.customers, "name", "John")
+        >>     await tx.insert(Tables.accounts, "owner_id", customer_id)
+        """
+        async with self._acquire() as conn:
+            async with conn.cursor() as curr:
+                try:
+                    yield Transaction(curr)
+                except BaseException:
+                    logger.debug("MySQL: Rolling back transaction")
+                    await conn.rollback()
+                    raise
+                await conn.commit()
+        # the next reads of this request should see the committed writes
+        self.pin_primary()
+
+    async def insert(self, table: Tables, *field_values: str | int | float) -> int:
+        """
+        Insert a new row into table with the given fields & values, in its
+        own transaction. See `Transaction.insert`
 
         **Example**
         >> self.insert(Tables.customers, "name", "John Smith")
         This command insert a new row with name John Smith, and return its
         auto-generated id
         """
-        if len(field_values) % 2 != 0:
-            raise ValueError("Each inserted value should have a field name")
-        async with self._pool.acquire() as conn:
+        async with self.transaction() as tx:
+            return await tx.insert(table, *field_values)
+
+    async def insert_many(
+            self,
+            table: Tables,
+            fields: tuple[str, ...],
+            rows: list[QueryArgs],
+            chunk_size: int = INSERT_MANY_CHUNK_SIZE
+    ) -> list[int]:
+        """
+        Insert all `rows` into table, in a single transaction.
+        See `Transaction.insert_many`
+
+        **Example**
+        >> self.insert_many(Tables.customers, ("name",), [("John",), ("Kevin",)])
+        """
+        async with self.transaction() as tx:
+            return await tx.insert_many(table, fields, rows, chunk_size)
+
+    async def read(self, query: str, args: QueryArgs | None = None):
+        """
+        Execute the given read-only SQL query on a replica, if any,
+        and return all the found results.
+        Replicas might lag behind the primary: see `pin_primary`
+
+        The read connections are in autocommit mode: the query is its own
+        transaction, reading a consistent snapshot, and costs a single
+        round trip (no COMMIT). Unless the reads share the writes' pool
+
+        :param query: SQL query, with a `%s` placeholder for each argument
+        :param args: the query's arguments, escaped by the client
+        """
+        logger.debug(f"MySQL: Reading query={query} args={args}")
+        pool = self._read_pool()
+        async with self._acquire(pool) as conn:
             async with conn.cursor() as curr:
-                # collect field & values from field_values
-                fields = ", ".join(field_values[::2])
-                values = ", ".join(
-                    [f"{f}" if not isinstance(f, str) else f"'{f}'" for f in field_values[1::2]])
-
-                # request the DB
-                query = f"INSERT INTO {table.value} ({fields}) VALUES ({values})"
-                logger.debug(f"MySQL: Executing query={query}")
-                await curr.execute(query)
+                await curr.execute(query, args)
+                rows = await curr.fetchall()
+            if self._shared_primary_pool and pool is self._pool:
+                # end the read's transaction, whose snapshot would be
+                # seen by the next queries on this connection
                 await conn.commit()
-                logger.debug(
-                    f"Successfully inserted new row fields=({fields}) values=({values}) "
-                    f"into table={table.value}")
-                return curr.lastrowid
+            return rows
 
-    async def execute(self, query: str):
+    async def execute(self, query: str, args: QueryArgs | None = None):
         """
         Execute the given SQL query and return all the found results
         To get a unique row, one can simply call this method and get the
         first element
+
+        :param query: SQL query, with a `%s` placeholder for each argument
+        :param args: the query's arguments, escaped by the client
+
+        >> self.execute("SELECT deposit FROM accounts WHERE id=%s", (1,))
         """
-        logger.debug(f"MySQL: Executing query={query}")
-        async with self._pool.acquire() as conn:
+        logger.debug(f"MySQL: Executing query={query} args={args}")
+        async with self._acquire() as conn:
             async with conn.cursor() as curr:
-                await curr.execute(query)
+                await curr.execute(query, args)
                 await conn.commit()
                 return await curr.fetchall()
+
+    async def stream(
+            self,
+            query: str,
+            args: QueryArgs | None = None,
+            fetch_size: int = STREAM_FETCH_SIZE
+    ) -> AsyncIterator[tuple]:
+        """
+        Execute the given SQL query and yield the found rows one by one,
+        as they are received from the server.
+        The query is read-only, and executed on a replica if any.
+        The rows are not buffered by the client (server-side cursor): only
+        `fetch_size` rows are kept in memory at once, whatever the number
+        of found rows.
+        The connection is held until the iteration is over. It is never
+        bound to the request, since the iteration might outlive it
+
+        >> async for row in self.stream("SELECT id FROM accounts"):
+        >>     ...
+        """
+        logger.debug(f"MySQL: Streaming query={query} args={args}")
+        pool = self._read_pool()
+        async with self._acquire(pool, scoped=False) as conn:
+            async with conn.cursor(aiomysql.SSCursor) as curr:
+                await curr.execute(query, args)
+                while rows := await curr.fetchmany(fetch_size):
+                    for row in rows:
+                        yield row
+            if self._shared_primary_pool and pool is self._pool:
+                await conn.commit()
+
+    @asynccontextmanager
+    async def lock(self, name: str, timeout: int = 60):
+        """
+        Hold the named MySQL lock `name`, shared between all clients of the
+        database, for the duration of the context.
+        It is used to make sure a single worker does some work at once
+
+        :param timeout: seconds to wait for the lock. A TimeoutError is
+           raised if it couldn't be acquired in time
+
+        >> async with db.lock("migrations"):
+        >>     ...
+        """
+        async with self._acquire() as conn:
+            async with conn.cursor() as curr:
+                await curr.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+                rows = await curr.fetchall()
+                if not rows or rows[0][0] != 1:
+                    raise TimeoutError(f"Couldn't acquire MySQL lock={name}")
+                logger.debug(f"MySQL: Acquired lock={name}")
+                try:
+                    yield
+                finally:
+                    await curr.execute("SELECT RELEASE_LOCK(%s)", (name,))
+                    logger.debug(f"MySQL: Released lock={name}")
@@ -3,6 +3,7 @@ from fastapi import status
 
 class HTTPException(Exception):
     http_status: int = status.HTTP_500_INTERNAL_SERVER_ERROR
+    error: str = "INTERNAL_ERROR"
 
 
 class NotFoundException(HTTPException):
@@ -11,3 +12,33 @@ class NotFoundException(HTTPException):
     The fastapi catches this exception and return a 404 response
     """
     http_status = status.HTTP_404_NOT_FOUND
+    error = "NOT_FOUND"
+
+
+class BadRequestException(HTTPException):
+    """
+    This exception should be raised when the request's parameters are
+    invalid. The fastapi catches this exception and return a 400 response
+    """
+    http_status = status.HTTP_400_BAD_REQUEST
+    error = "BAD_REQUEST"
+
+
+class InsufficientFundsException(HTTPException):
+    """
+    This exception should be raised when a transfer exceeds the balance of
+    its source account. The fastapi catches this exception and return a 409
+    response
+    """
+    http_status = status.HTTP_409_CONFLICT
+    error = "INSUFFICIENT_FUNDS"
+
+
+class IdempotencyKeyReusedException(HTTPException):
+    """
+    This exception should be raised when an idempotency key is reused
+    with other parameters than the request which first used it.
+    The fastapi catches this exception and return a 422 response
+    """
+    http_status = status.HTTP_422_UNPROCESSABLE_ENTITY
+    error = "IDEMPOTENCY_KEY_REUSED"
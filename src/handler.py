@@ -1,34 +1,360 @@
-import asyncio
+import contextlib
+import dataclasses
+import functools
+import hashlib
+import json
+import random
+from typing import AsyncIterator, Awaitable, Callable
 
+import pydantic
+
+import migrations
 import models
 import utils
-from database import Database, Tables
-from exceptions import NotFoundException
+from database import (
+    Database, IntegrityError, QueryArgs, Tables, Transaction)
+from exceptions import (
+    IdempotencyKeyReusedException, InsufficientFundsException,
+    NotFoundException)
 
 logger = utils.get_logger(__name__)
 
+# Number of invalidation counters the accounts' balances are spread over
+BALANCE_GENERATIONS = 4096
+
+# Seconds between two removals of the expired idempotency keys
+IDEMPOTENCY_PRUNE_INTERVAL = 600
+
+# Number of locks the in-process idempotency keys are spread over
+IDEMPOTENCY_LOCK_STRIPES = 1024
+
+# Number of accounts read, then checkpointed, at once
+CHECKPOINT_CHUNK_SIZE = 1000
+
+
+@functools.lru_cache(maxsize=64)
+def balances_update_query(rows: int, sharded: bool = False) -> str:
+    """
+    Build, once per number of rows, the query adding credits & debits
+    to the running balances of `rows` accounts.
+    If `sharded`, they are added to one of the sub-counters of each
+    account instead, given by the rows' shard
+    """
+    if sharded:
+        table, fields = Tables.balance_shards, "id, shard, credits, debits"
+        values = ", ".join(["(%s, %s, %s, %s)"] * rows)
+    else:
+        table, fields = Tables.balances, "id, credits, debits"
+        values = ", ".join(["(%s, %s, %s)"] * rows)
+    return (
+        f"INSERT INTO {table.value} ({fields}) "
+        f"VALUES {values} ON DUPLICATE KEY UPDATE "
+        f"credits=credits+VALUES(credits), debits=debits+VALUES(debits)")
+
+
+def coalesced(method):
+    """
+    Concurrent calls of the decorated read `method` with the same
+    arguments share a single call, and its result (see `SingleFlight`)
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        # a read pinned to the primary can't share a replica's result.
+        # Nor can a read starting after a write share a read which
+        # started before it: the key holds the account's write epoch
+        account_id = args[0] if args else kwargs.get("account_id")
+        key = (
+            method.__name__, args, tuple(sorted(kwargs.items())),
+            Database.is_primary_pinned(), self._write_epoch(account_id))
+
+        async def call():
+            # the call outlives its first caller, if cancelled: it doesn't
+            # use its request's connections, but its own ones
+            async with Database.detached_scope():
+                return await method(self, *args, **kwargs)
+
+        return await self._inflight.do(key, call)
+    return wrapper
+
+
+@dataclasses.dataclass
+class HandlerConfig:
+    # read balances from the pre-computed `balances` table
+    # instead of summing all transfers on every request
+    precomputed_balances: bool = False
+    # maximum number of customers' ids cached by name (0: no cache)
+    customer_cache_size: int = 10000
+    # maximum number of accounts known to exist (0: no cache)
+    account_cache_size: int = 100000
+    # seconds during which an account is known not to exist, so that
+    # accounts created by other workers are eventually found
+    missing_account_ttl: int = 5
+    # fill the existing accounts' cache at startup
+    preload_accounts: bool = False
+    # maximum number of accounts' balances cached (0: no cache), and
+    # seconds after which they expire
+    balance_cache_size: int = 0
+    balance_cache_ttl: int = 5
+    # microseconds during which single accounts' lookups are collected,
+    # to be read by a single query (0: within the same event loop iteration)
+    batch_delay_us: int = 0
+    # queue the transfers, and write them by batches in the background
+    write_behind: bool = False
+    # maximum number of transfers written by a single transaction
+    flush_size: int = 100
+    # milliseconds during which queued transfers are collected into a batch
+    flush_max_wait_ms: int = 5
+    # maximum number of queued transfers. Next ones wait for some room
+    queue_size: int = 10000
+    # maximum number of idempotent requests' responses cached
+    idempotency_cache_size: int = 10000
+    # seconds during which the idempotency keys are kept (0: forever)
+    idempotency_key_ttl: int = 86400
+    # reject the transfers exceeding their source account's balance.
+    # Transfers are then never written behind
+    overdraft_check: bool = False
+    # number of in-process locks the accounts are spread over
+    account_lock_stripes: int = 1024
+    # number of sub-counters the running balance of each hot account is
+    # split into, by account's id
+    hot_account_shards: dict[int, int] = dataclasses.field(
+        default_factory=dict)
+    # seconds between two folds of the sub-counters into the balances
+    shard_fold_interval: int = 60
+    # seconds between two checkpoints of the balances (0: no checkpoint),
+    # and how far behind the current time they are taken, so that no
+    # transfer is committed before them once they are taken
+    checkpoint_interval: int = 0
+    checkpoint_lag: int = 60
+
+    @classmethod
+    def from_environment(cls) -> "HandlerConfig":
+        """
+        Read the handler's options from environments
+        """
+        return cls(
+            precomputed_balances=utils.get_env_flag("PRECOMPUTED_BALANCES"),
+            customer_cache_size=utils.get_env_int(
+                "CUSTOMER_CACHE_SIZE", 10000),
+            account_cache_size=utils.get_env_int(
+                "ACCOUNT_CACHE_SIZE", 100000),
+            missing_account_ttl=utils.get_env_int("MISSING_ACCOUNT_TTL", 5),
+            preload_accounts=utils.get_env_flag("PRELOAD_ACCOUNTS"),
+            balance_cache_size=utils.get_env_int("BALANCE_CACHE_SIZE", 0),
+            balance_cache_ttl=utils.get_env_int("BALANCE_CACHE_TTL", 5),
+            batch_delay_us=utils.get_env_int("ACCOUNT_BATCH_DELAY_US", 0),
+            write_behind=utils.get_env_flag("WRITE_BEHIND_TRANSFERS"),
+            flush_size=utils.get_env_int("TRANSFER_FLUSH_SIZE", 100),
+            flush_max_wait_ms=utils.get_env_int(
+                "TRANSFER_FLUSH_MAX_WAIT_MS", 5),
+            queue_size=utils.get_env_int("TRANSFER_QUEUE_SIZE", 10000),
+            idempotency_cache_size=utils.get_env_int(
+                "IDEMPOTENCY_CACHE_SIZE", 10000),
+            idempotency_key_ttl=utils.get_env_int(
+                "IDEMPOTENCY_KEY_TTL", 86400),
+            overdraft_check=utils.get_env_flag("CHECK_OVERDRAFT"),
+            account_lock_stripes=utils.get_env_int(
+                "ACCOUNT_LOCK_STRIPES", 1024),
+            hot_account_shards=utils.get_env_int_map("HOT_ACCOUNT_SHARDS"),
+            shard_fold_interval=utils.get_env_int("SHARD_FOLD_INTERVAL", 60),
+            checkpoint_interval=utils.get_env_int(
+                "BALANCE_CHECKPOINT_INTERVAL", 0),
+            checkpoint_lag=utils.get_env_int("BALANCE_CHECKPOINT_LAG", 60),
+        )
+
+
+class InvalidationChannel(object):
+    """
+    Channel through which the workers tell each other which accounts'
+    balances changed, so that they drop them from their cache.
+    This default channel doesn't reach any other worker: a multi-workers
+    deployment plugs in a shared one (e.g. a pub/sub) by implementing
+    `publish` & `subscribe`
+    """
+    async def publish(self, account_ids: list[int]):
+        """
+        Tell the other workers that these accounts' balances changed
+        """
+
+    def subscribe(self, callback: Callable[[list[int]], None]):
+        """
+        Call `callback` with the accounts' ids published by other workers
+        """
+
 
 class Handler(object):
-    def __init__(self, db: Database):
+    def __init__(
+            self,
+            db: Database,
+            config: HandlerConfig | None = None,
+            invalidation: InvalidationChannel | None = None
+    ):
         self._db: Database = db
+        self._config: HandlerConfig = config or HandlerConfig()
+        # customers' ids by name. Customers are never deleted nor renamed,
+        # so that a cached id is always valid
+        self._customers = utils.LRUCache(self._config.customer_cache_size)
+        # ids of the accounts known to exist, or not to exist.
+        # Accounts are never deleted: only their absence expires
+        self._accounts = utils.LRUCache(self._config.account_cache_size)
+        self._missing_accounts = utils.LRUCache(
+            self._config.account_cache_size,
+            ttl=self._config.missing_account_ttl)
+        # accounts' balances, dropped when a transfer changes them
+        self._balances = utils.LRUCache(
+            self._config.balance_cache_size,
+            ttl=self._config.balance_cache_ttl)
+        # incremented whenever the balances of their accounts are dropped:
+        # balances read meanwhile might be stale, and aren't cached
+        self._balance_generations = [0] * BALANCE_GENERATIONS
+        # incremented whenever an account is created by this worker
+        self._account_creations = 0
+        self._invalidation = invalidation or InvalidationChannel()
+        self._invalidation.subscribe(self.invalidate_balances)
+        # in-flight reads, shared by concurrent identical requests
+        self._inflight = utils.SingleFlight()
+        # single accounts' lookups of concurrent requests, batched
+        self._accounts_loader = utils.BatchLoader(
+            self.__load_accounts, delay=self._config.batch_delay_us / 1e6)
+        self._balances_loader = utils.BatchLoader(
+            self.__load_balances, delay=self._config.batch_delay_us / 1e6)
+        # transfers queued to be written by batches, if enabled.
+        # A batch is written by a single transaction: a transfer exceeding
+        # its source's balance would make the whole batch fail
+        self._transfers_writer: utils.BatchWriter | None = None
+        if self._config.write_behind and not self._config.overdraft_check:
+            self._transfers_writer = utils.BatchWriter(
+                self.__write_transfers,
+                batch_size=self._config.flush_size,
+                max_wait=self._config.flush_max_wait_ms / 1e3,
+                max_queue_size=self._config.queue_size)
+        # (request hash, response) of the idempotent requests, by
+        # (endpoint, key), in front of the `idempotency_keys` table.
+        # And the ones in flight
+        self._responses = utils.LRUCache(
+            self._config.idempotency_cache_size,
+            ttl=self._config.idempotency_key_ttl or None)
+        self._idempotency_locks = utils.StripedLock(IDEMPOTENCY_LOCK_STRIPES)
+        # expired idempotency keys, periodically removed
+        self._keys_pruner: utils.PeriodicTask | None = None
+        if self._config.idempotency_key_ttl > 0:
+            self._keys_pruner = utils.PeriodicTask(
+                self.prune_idempotency_keys,
+                interval=IDEMPOTENCY_PRUNE_INTERVAL)
+        # source accounts of the transfers being checked against overdraft
+        self._account_locks = utils.StripedLock(
+            self._config.account_lock_stripes)
+        # hot accounts' sub-counters, periodically folded into their balances
+        self._shards_folder: utils.PeriodicTask | None = None
+        if self._config.hot_account_shards:
+            self._shards_folder = utils.PeriodicTask(
+                self.fold_balance_shards,
+                interval=self._config.shard_fold_interval)
+        # checkpoints of the balances, to read them at any point in time
+        self._checkpointer: utils.PeriodicTask | None = None
+        if self._config.checkpoint_interval > 0:
+            self._checkpointer = utils.PeriodicTask(
+                self.checkpoint_balances,
+                interval=self._config.checkpoint_interval)
 
     @classmethod
-    async def create(cls):
+    async def create(cls, invalidation: InvalidationChannel | None = None):
         db = await Database.create()
-        # create tables
+        # create tables and bring their schema up to date
         await db.create_tables()
-        return cls(db)
+        await migrations.migrate(db)
+        self = cls(
+            db,
+            config=HandlerConfig.from_environment(),
+            invalidation=invalidation)
+        if self._config.preload_accounts:
+            await self.preload_accounts()
+        if self._shards_folder is not None:
+            self._shards_folder.start()
+        if self._checkpointer is not None:
+            self._checkpointer.start()
+        if self._keys_pruner is not None:
+            self._keys_pruner.start()
+        return self
+
+    async def close(self):
+        """
+        Write the queued transfers, if any, and stop the background jobs
+        before shutting down
+        """
+        if self._transfers_writer is not None:
+            await self._transfers_writer.close()
+        if self._shards_folder is not None:
+            await self._shards_folder.close()
+        if self._checkpointer is not None:
+            await self._checkpointer.close()
+        if self._keys_pruner is not None:
+            await self._keys_pruner.close()
+
+    @staticmethod
+    def pin_primary():
+        """
+        Read-your-writes: the next reads of the current request are sent to
+        the primary, instead of a possibly lagging replica
+        """
+        Database.pin_primary()
+
+    def request_scope(self):
+        """
+        Context (i.e. request) within which the DB connections are reused,
+        if enabled. See `Database.request_scope`
+        """
+        return self._db.request_scope()
+
+    def stats(self) -> dict:
+        """
+        Return internal metrics, useful for monitoring & sizing
+        """
+        return {
+            "pool": self._db.stats(),
+            "caches": {
+                "customers": self._customers.stats(),
+                "accounts": self._accounts.stats(),
+                "missing_accounts": self._missing_accounts.stats(),
+                "balances": self._balances.stats(),
+                "idempotency": self._responses.stats(),
+            },
+        }
+
+    def _write_epoch(self, account_id: int | None) -> int:
+        """
+        Return the number of writes this worker knows of on the account,
+        or on the accounts' list if None. It changes on every write
+        """
+        if account_id is None:
+            return self._account_creations
+        return self._balance_generations[account_id % BALANCE_GENERATIONS]
+
+    def invalidate_balances(self, account_ids: list[int]):
+        """
+        Drop the cached balances of the given accounts, which changed
+        """
+        for account_id in account_ids:
+            self._balances.pop(account_id)
+            self._balance_generations[
+                account_id % BALANCE_GENERATIONS] += 1
 
     async def create_account(
             self,
             customer: str,
-            deposit: float
+            deposit: float,
+            idempotency_key: str | None = None
     ) -> models.Account:
         """
         Create a customer row in the db, if it doesn't exist yet
+        (the known customers' ids are cached by name)
         Create a new account associated to this customer
         This account has an initial deposit of `deposit` (should be positive)
 
+        If `idempotency_key` was already used to create an account, this
+        account is returned instead, and nothing is created. If it was used
+        with other parameters, IdempotencyKeyReusedException is raised
+
         :return: The newly created account's id
         """
         if deposit <= 0:
@@ -36,22 +362,63 @@ class Handler(object):
                 "[Create Account] Initial deposit is negative or 0, "
                 "when it should be positive")
 
-        # create customer if it doesn't exist yet
-        owner_id = await self.__get_customer(customer)
-        account_id = await self._db.insert(
-            Tables.accounts,
-            "owner_id", owner_id,
-            "deposit", deposit,
-        )
+        idempotency = self.__idempotency(
+            idempotency_key, customer=customer, deposit=deposit)
+        return await self.__idempotent(
+            "account", idempotency, models.Account,
+            lambda: self.__create_account(customer, deposit, idempotency))
 
-        account = models.Account(
-            id=account_id,
-            owner_id=owner_id,
-            deposit=deposit
-        )
+    async def __create_account(
+            self,
+            customer: str,
+            deposit: float,
+            idempotency: tuple[str, str] | None
+    ) -> models.Account:
+        owner_id = self._customers.get(customer)
+        # the customer & its account are created in a single transaction
+        async with self._db.transaction() as tx:
+            if owner_id is None:
+                # create customer if it doesn't exist yet
+                owner_id = await tx.insert_or_get(
+                    Tables.customers, "name", customer)
+            account_id = await tx.insert(
+                Tables.accounts,
+                "owner_id", owner_id,
+                "deposit", deposit,
+            )
+            account = models.Account(
+                id=account_id,
+                owner_id=owner_id,
+                deposit=deposit
+            )
+            if idempotency is not None:
+                await self.__store_response(
+                    tx, "account", idempotency, account)
+        # cached once committed only
+        self._customers.set(customer, owner_id)
+        self.__record_account(account_id, True)
+        # the reads in flight can't see the new account
+        self._account_creations += 1
+        self._balance_generations[account_id % BALANCE_GENERATIONS] += 1
         logger.debug(f"Successfully created new account={account}")
         return account
 
+    async def preload_accounts(self):
+        """
+        Fill the existing accounts' cache with the most recent accounts,
+        so that the first lookups don't need any query
+        """
+        query = (
+            f"SELECT id FROM {Tables.accounts.value} "
+            f"ORDER BY id DESC LIMIT %s")
+        count = 0
+        async for r in self._db.stream(
+                query, (self._config.account_cache_size,)):
+            self._accounts.set(r[0], True)
+            count += 1
+        logger.info(f"Preloaded {count} accounts")
+
+    @coalesced
     async def get_accounts(
             self,
             account_id: int | None = None
@@ -61,10 +428,13 @@ class Handler(object):
         Otherwise, return the account corresponding to this id
         If not account is found, a NotFoundException error is raise
         """
-        query = f"SELECT id, owner_id, deposit FROM {Tables.accounts.value}"
         if account_id:
-            query += f" WHERE id={account_id}"
-        rows = await self._db.execute(query)
+            row = await self.__load(
+                self._accounts_loader, self.__load_accounts, account_id)
+            rows = [row] if row is not None else []
+        else:
+            rows = await self._db.read(
+                f"SELECT id, owner_id, deposit FROM {Tables.accounts.value}")
         if account_id is not None and not rows:
             raise NotFoundException(
                 f"Account with id={account_id} doesn't exist")
@@ -80,72 +450,202 @@ class Handler(object):
             f"matching account_id={account_id}")
         return accounts
 
+    async def stream_accounts(self) -> AsyncIterator[models.Account]:
+        """
+        Yield all accounts in DB, one by one, as they are read from the DB.
+        Contrary to `get_accounts`, the memory usage doesn't depend on the
+        number of accounts
+        """
+        query = f"SELECT id, owner_id, deposit FROM {Tables.accounts.value}"
+        async for r in self._db.stream(query):
+            yield models.Account(id=r[0], owner_id=r[1], deposit=r[2])
+
     async def transfer(
             self,
             source_id: int,
             target_id: int,
-            amount: float
+            amount: float,
+            idempotency_key: str | None = None
     ) -> models.Transfer:
         """
         Create a new transfer row in the db,
         from `source_id` account to `target_id` account.
         The amount of the transfer is `amount`
         (should always be positive)
+
+        In write-behind mode, the transfer is queued, and written along the
+        other queued transfers: it returns once it's committed
+
+        If `idempotency_key` was already used to make a transfer, this
+        transfer is returned instead, and nothing is created. If it was used
+        with other parameters, IdempotencyKeyReusedException is raised
+
+        If the overdraft check is enabled and the source account's balance
+        doesn't cover `amount`, InsufficientFundsException is raised
         """
         if amount <= 0:
             raise ValueError(
                 "[Transfer] transfer amount is negative or 0, "
                 "when it should be positive")
 
-        utc_timestamp = utils.get_utc_timestamp()
-        transfer_id = await self._db.insert(
-            Tables.transfers,
-            "from_id", source_id,
-            "to_id", target_id,
-            "amount", amount,
-            "`utc_timestamp`", utc_timestamp,
-        )
+        if idempotency_key is not None:
+            # the key is stored in the transfer's transaction: it's not
+            # written behind, along the other transfers
+            idempotency = self.__idempotency(
+                idempotency_key,
+                source_id=source_id, target_id=target_id, amount=amount)
+            return await self.__idempotent(
+                "transfer", idempotency, models.Transfer,
+                lambda: self.__transfer(
+                    source_id, target_id, amount, idempotency))
+        if self._transfers_writer is not None:
+            transfer = await self._transfers_writer.write(
+                models.TransferRequest(
+                    source_id=source_id, target_id=target_id, amount=amount))
+            # the next reads of this request should see the new transfer
+            self.pin_primary()
+            return transfer
+        return await self.__transfer(source_id, target_id, amount)
 
-        transfer = models.Transfer(
-            id=transfer_id,
-            utc_timestamp=utc_timestamp,
-            from_id=source_id,
-            to_id=target_id,
-            amount=amount,
-        )
+    async def __transfer(
+            self,
+            source_id: int,
+            target_id: int,
+            amount: float,
+            idempotency: tuple[str, str] | None = None
+    ) -> models.Transfer:
+        utc_timestamp = utils.get_utc_timestamp()
+        # the running balances are updated in the same transaction
+        async with self.__transfers_transaction(
+                [(source_id, target_id, amount)]) as tx:
+            transfer_id = await tx.insert(
+                Tables.transfers,
+                "from_id", source_id,
+                "to_id", target_id,
+                "amount", amount,
+                "`utc_timestamp`", utc_timestamp,
+            )
+            for query, args in self.__balances_update(
+                    [(source_id, target_id, amount)]):
+                await tx.execute(query, args)
+            transfer = models.Transfer(
+                id=transfer_id,
+                utc_timestamp=utc_timestamp,
+                from_id=source_id,
+                to_id=target_id,
+                amount=amount,
+            )
+            if idempotency is not None:
+                await self.__store_response(
+                    tx, "transfer", idempotency, transfer)
+        await self.__balances_changed([source_id, target_id])
         logger.debug(f"Successfully made a new transfer={transfer}")
         return transfer
 
-    async def get_balances(self, account_id: int) -> models.Balances:
+    async def transfer_batch(
+            self,
+            transfers: list[models.TransferRequest]
+    ) -> list[models.Transfer]:
+        """
+        Create all given transfers in the db, in a single transaction.
+        They are all validated first: if any is invalid, none is created.
+        Likewise if the overdraft check is enabled and any exceeds the
+        balance of its source account, once the previous ones are made.
+        All created transfers share the same timestamp
+
+        :return: the created transfers, in the same order
+        """
+        if not transfers:
+            raise ValueError("[Transfer Batch] there is no transfer to make")
+        for i, t in enumerate(transfers):
+            if t.amount <= 0:
+                raise ValueError(
+                    f"[Transfer Batch] transfer #{i} amount is negative or 0, "
+                    f"when it should be positive")
+        return await self.__write_transfers(transfers)
+
+    async def __write_transfers(
+            self,
+            transfers: list[models.TransferRequest]
+    ) -> list[models.Transfer]:
+        """
+        Create the given (valid) transfers in the db, in a single transaction
+        """
+        utc_timestamp = utils.get_utc_timestamp()
+        # the running balances are updated in the same transaction
+        async with self.__transfers_transaction([
+                (t.source_id, t.target_id, t.amount) for t in transfers
+        ]) as tx:
+            transfer_ids = await tx.insert_many(
+                Tables.transfers,
+                ("from_id", "to_id", "amount", "`utc_timestamp`"),
+                [
+                    (t.source_id, t.target_id, t.amount, utc_timestamp)
+                    for t in transfers
+                ],
+            )
+            for query, args in self.__balances_update([
+                (t.source_id, t.target_id, t.amount) for t in transfers
+            ]):
+                await tx.execute(query, args)
+
+        created = [
+            models.Transfer(
+                id=transfer_id,
+                utc_timestamp=utc_timestamp,
+                from_id=t.source_id,
+                to_id=t.target_id,
+                amount=t.amount,
+            ) for transfer_id, t in zip(transfer_ids, transfers)
+        ]
+        await self.__balances_changed(sorted({
+            account_id
+            for t in transfers
+            for account_id in (t.source_id, t.target_id)
+        }))
+        logger.debug(f"Successfully made {len(created)} new transfers")
+        return created
+
+    @coalesced
+    async def get_balances(
+            self,
+            account_id: int,
+            as_of: int | None = None
+    ) -> models.Balances:
         """
         Find in the db all transfers from or to the given account's id
         If the account doesn't exist, NotFoundException is raised
 
+        :param as_of: if given, return the balances at this UTC timestamp,
+           i.e. counting only the transfers made at or before it
+
         :return: the found balances
         """
-        # Get account initial deposit
-        query = (
-            f"SELECT deposit FROM {Tables.accounts.value} "
-            f"WHERE id={account_id}")
-        data = await self._db.execute(query)
-        if not data:  # account does not exist
+        # a read pinned to the primary sees the latest writes, which the
+        # caches might not know of yet
+        pinned = Database.is_primary_pinned()
+        if as_of is None and not pinned:
+            balances = self._balances.get(account_id)
+            if balances is not None:
+                return balances
+        generation = self._balance_generations[
+            account_id % BALANCE_GENERATIONS]
+        if not pinned and self._missing_accounts.get(account_id):
             raise NotFoundException(
                 f"Account with id={account_id} doesn't exist")
-        deposit = data[0][0]
-
-        # fetch the credits and debits from the DB
-        credit_rows, debit_rows = await asyncio.gather(
-            self._db.execute(
-                f"SELECT amount FROM {Tables.transfers.value} "
-                f"WHERE to_id={account_id}"),
-            self._db.execute(
-                f"SELECT amount FROM {Tables.transfers.value} "
-                f"WHERE from_id={account_id}"),
-        )
 
-        # get the amount only and compute the sum
-        credits = sum([r[0] for r in credit_rows])
-        debits = sum([r[0] for r in debit_rows])
+        # Get account initial deposit, credits and debits in one round trip
+        if as_of is None:
+            data = await self.__load(
+                self._balances_loader, self.__load_balances, account_id)
+        else:
+            data = await self.__load_balances_as_of(account_id, as_of)
+        self.__record_account(account_id, data is not None)
+        if data is None:  # account does not exist
+            raise NotFoundException(
+                f"Account with id={account_id} doesn't exist")
+        deposit, credits, debits = data
+
         balances = models.Balances(
             account_id=account_id,
             deposit=deposit,
@@ -153,15 +653,179 @@ class Handler(object):
             debits=debits,
             balance=deposit + credits - debits
         )
+        # unless a transfer changed them while they were read
+        if as_of is None and generation == self._balance_generations[
+                account_id % BALANCE_GENERATIONS]:
+            self._balances.set(account_id, balances)
         logger.debug(
             f"Successfully got balances={balances} "
             f"from account_id={account_id}")
         return balances
 
+    async def backfill_balances(self):
+        """
+        (Re-)compute the pre-computed credits & debits of every account
+        from the full transfers history.
+        This should be run once on databases created before the
+        `balances` table existed, before enabling `precomputed_balances`
+        """
+        query = (
+            f"INSERT INTO {Tables.balances.value} (id, credits, debits) "
+            f"SELECT a.id, "
+            f"(SELECT COALESCE(SUM(amount), 0) FROM {Tables.transfers.value} "
+            f"WHERE to_id=a.id), "
+            f"(SELECT COALESCE(SUM(amount), 0) FROM {Tables.transfers.value} "
+            f"WHERE from_id=a.id) "
+            f"FROM {Tables.accounts.value} a "
+            f"ON DUPLICATE KEY UPDATE "
+            f"credits=VALUES(credits), debits=VALUES(debits)")
+        async with self._db.transaction() as tx:
+            await tx.execute(query)
+            # the recomputed balances include what the shards counted
+            await tx.execute(f"DELETE FROM {Tables.balance_shards.value}")
+        logger.info("Successfully backfilled the accounts' balances")
+
+    async def checkpoint_balances(self):
+        """
+        Record the credits & debits of the accounts at the current time,
+        minus the checkpoints' lag, in the `balance_checkpoints` table.
+        Each checkpoint is computed from the account's previous one, plus
+        the transfers made since (read by index ranges). Accounts without
+        any new transfer aren't checkpointed again.
+        The accounts are read by chunks, out of any transaction: unlike an
+        INSERT ... SELECT, the read takes no lock on the transfers, so it
+        never blocks the transfers being made.
+        A single worker takes them at once
+        """
+        utc_timestamp = utils.get_utc_timestamp() - self._config.checkpoint_lag
+        query = (
+            f"SELECT a.id, COALESCE(c.credits, 0), COALESCE(c.debits, 0), "
+            f"{self.__checkpoint_sum('to_id')}, "
+            f"{self.__checkpoint_sum('from_id')} "
+            f"FROM {Tables.accounts.value} a "
+            f"{self.__checkpoint_join()} "
+            f"WHERE a.id > %s ORDER BY a.id LIMIT %s")
+        # a lagging replica could miss transfers made before the checkpoint
+        self.pin_primary()
+        checkpointed = 0
+        async with self._db.lock("balance_checkpoints"):
+            last_id = 0
+            while True:
+                rows = await self._db.read(
+                    query,
+                    (utc_timestamp,) * 3 + (last_id, CHECKPOINT_CHUNK_SIZE))
+                checkpoints = [
+                    (account_id, utc_timestamp,
+                     credits + new_credits, debits + new_debits)
+                    for account_id, credits, debits, new_credits, new_debits
+                    in rows if new_credits > 0 or new_debits > 0]
+                if checkpoints:
+                    await self._db.insert_many(
+                        Tables.balance_checkpoints,
+                        ("account_id", "`utc_timestamp`", "credits", "debits"),
+                        checkpoints)
+                    checkpointed += len(checkpoints)
+                if len(rows) < CHECKPOINT_CHUNK_SIZE:
+                    break
+                last_id = rows[-1][0]
+        logger.info(
+            f"Successfully checkpointed the balances of {checkpointed} "
+            f"accounts at utc_timestamp={utc_timestamp}")
+
+    async def __load_balances_as_of(
+            self,
+            account_id: int,
+            as_of: int
+    ) -> tuple | None:
+        """
+        Read the initial deposit, credits & debits of the account at the
+        `as_of` UTC timestamp: those of its latest checkpoint before it,
+        plus the transfers made since
+
+        :return: the (deposit, credits, debits) row, None if not found
+        """
+        query = (
+            f"SELECT a.deposit, "
+            f"COALESCE(c.credits, 0) + {self.__checkpoint_sum('to_id')}, "
+            f"COALESCE(c.debits, 0) + {self.__checkpoint_sum('from_id')} "
+            f"FROM {Tables.accounts.value} a "
+            f"{self.__checkpoint_join()} WHERE a.id=%s")
+        rows = await self._db.read(query, (as_of,) * 3 + (account_id,))
+        return tuple(rows[0]) if rows else None
+
+    @staticmethod
+    def __checkpoint_sum(field: str) -> str:
+        """
+        Build the sub-query summing the amounts of the account's
+        transfers, from or to it (`field`), made after its checkpoint `c`
+        (if any) and at or before a given UTC timestamp
+        """
+        return (
+            f"(SELECT COALESCE(SUM(amount), 0) FROM {Tables.transfers.value} "
+            f"WHERE {field}=a.id "
+            f"AND `utc_timestamp` > COALESCE(c.`utc_timestamp`, -1) "
+            f"AND `utc_timestamp` <= %s)")
+
+    @staticmethod
+    def __checkpoint_join() -> str:
+        """
+        Build the join of the accounts `a` to their latest checkpoint `c`
+        at or before a given UTC timestamp, if any
+        """
+        return (
+            f"LEFT JOIN {Tables.balance_checkpoints.value} c "
+            f"ON c.account_id=a.id AND c.`utc_timestamp`=("
+            f"SELECT MAX(`utc_timestamp`) "
+            f"FROM {Tables.balance_checkpoints.value} "
+            f"WHERE account_id=a.id AND `utc_timestamp` <= %s)")
+
+    async def fold_balance_shards(self):
+        """
+        Add the hot accounts' sub-counters to their running balances, and
+        remove them, so that reading their balances stays cheap.
+        A single worker folds them at once. The sub-counters are locked
+        meanwhile: transfers from & to hot accounts wait until it's over
+        """
+        async with self._db.lock("fold_balance_shards"):
+            async with self._db.transaction() as tx:
+                rows = await tx.execute(
+                    f"SELECT id, SUM(credits), SUM(debits) "
+                    f"FROM {Tables.balance_shards.value} "
+                    f"GROUP BY id FOR UPDATE")
+                if not rows:
+                    return
+                rows = sorted(tuple(r) for r in rows)
+                await tx.execute(
+                    balances_update_query(len(rows)),
+                    tuple(value for row in rows for value in row))
+                await tx.execute(
+                    f"DELETE FROM {Tables.balance_shards.value} "
+                    f"WHERE id IN ({', '.join(['%s'] * len(rows))})",
+                    tuple(r[0] for r in rows))
+        logger.info(f"Successfully folded the shards of {len(rows)} accounts")
+
+    async def prune_idempotency_keys(self):
+        """
+        Remove the idempotency keys older than their time to live: a
+        request retried with an expired key is made again
+        """
+        expired = utils.get_utc_timestamp() - self._config.idempotency_key_ttl
+        await self._db.execute(
+            f"DELETE FROM {Tables.idempotency_keys.value} "
+            f"WHERE `utc_timestamp` < %s", (expired,))
+        logger.info(
+            f"Successfully removed the idempotency keys older than "
+            f"utc_timestamp={expired}")
+
+    @coalesced
     async def get_transfer_history(
             self,
             account_id: int,
-            type_: models.TransferType = models.TransferType.any
+            type_: models.TransferType = models.TransferType.any,
+            limit: int | None = None,
+            after: tuple[int, int, str] | None = None,
+            since: int | None = None,
+            until: int | None = None
     ) -> list[models.Transfer]:
         """
         Find in the db all transfers from or to the given account's id
@@ -172,90 +836,454 @@ class Handler(object):
            -> credit: return only transfer to this account id
            -> debit: return only transfer from this account id
            -> any: return all types of transfers
+        :param limit: maximum number of returned transfers. All of them
+           if None
+        :param after: (utc_timestamp, id, type) of the last transfer of the
+           previous page. Only the transfers coming after it are returned
+        :param since: if given, only return transfers made at or after this
+           UTC timestamp
+        :param until: if given, only return transfers made at or before this
+           UTC timestamp
 
-        :return:the sorted list of transfers, sorted by timestamp, ASCENDING.
+        :return:the sorted list of transfers, sorted by timestamp, id then
+           type, ASCENDING. A transfer to itself is both a credit & a debit
         """
         # Check account existence
         if not await self.__account_exists(account_id):
             raise NotFoundException(
                 f"Account with id={account_id} doesn't exist")
 
-        credits, debits = [], []
-        match type_:
-            case models.TransferType.credit:
-                credits = await self.__get_credit_transfers(account_id)
-            case models.TransferType.debit:
-                debits = await self.__get_debit_transfers(account_id)
-            case models.TransferType.any:
-                credits, debits = await asyncio.gather(
-                    self.__get_credit_transfers(account_id),
-                    self.__get_debit_transfers(account_id),
-                )
-        transfers = sorted(credits + debits, key=lambda t: t.utc_timestamp)
+        # a single query, whose rows are already sorted by the DB
+        query, args = self.__history_query(
+            account_id, type_, limit, after, since, until)
+        rows = await self._db.read(query, args)
+        transfers = [self.__transfer_from_row(r) for r in rows]
         logger.debug(
             f"Successfully fetched {len(transfers)} of type={type_.value} "
             f"corresponding to account_id={account_id}")
         return transfers
 
-    async def __get_customer(self, customer: str) -> int:
+    async def stream_transfer_history(
+            self,
+            account_id: int,
+            type_: models.TransferType = models.TransferType.any,
+            limit: int | None = None,
+            after: tuple[int, int, str] | None = None,
+            since: int | None = None,
+            until: int | None = None
+    ) -> AsyncIterator[models.Transfer]:
+        """
+        Same as `get_transfer_history`, but the transfers are yielded one by
+        one by the returned iterator, as they are read from the DB.
+        The account's existence is checked before returning: a
+        NotFoundException is raised by this call, not while iterating
         """
-        Get customer from the DB with name "customer" and returns its id
-        If it doesn't exist, create it first
+        if not await self.__account_exists(account_id):
+            raise NotFoundException(
+                f"Account with id={account_id} doesn't exist")
+
+        query, args = self.__history_query(
+            account_id, type_, limit, after, since, until)
+
+        async def transfers() -> AsyncIterator[models.Transfer]:
+            async for r in self._db.stream(query, args):
+                yield self.__transfer_from_row(r)
+
+        return transfers()
 
-        :return: The (new) customer's row's id
+    def __balances_update(
+            self,
+            transfers: list[tuple[int, int, float]]
+    ) -> list[tuple[str, QueryArgs]]:
         """
-        query = f"SELECT id FROM {Tables.customers.value} WHERE name='{customer}'"
-        res = await self._db.execute(query)
-        if res:  # the customer already exists in the DB: return its id
-            return res[0][0]
+        Build the queries & args adding the given transfers to the
+        running balances. Those of the hot accounts are added to one of
+        their sub-counters, picked at random, so that concurrent transfers
+        rarely update the same row
+
+        :param transfers: list of (source_id, target_id, amount)
 
-        # Create the customer
-        return await self._db.insert(Tables.customers, "name", customer)
+        Rows are upserted in id order, to avoid deadlocks between
+        concurrent transfers touching the same accounts
+        """
+        deltas: dict[int, list[float]] = {}
+        for source_id, target_id, amount in transfers:
+            deltas.setdefault(target_id, [0, 0])[0] += amount
+            deltas.setdefault(source_id, [0, 0])[1] += amount
+        rows, sharded_rows = [], []
+        for account_id, (credits, debits) in sorted(deltas.items()):
+            shards = self._config.hot_account_shards.get(account_id, 0)
+            if shards > 1:
+                sharded_rows.append(
+                    (account_id, random.randrange(shards), credits, debits))
+            else:
+                rows.append((account_id, credits, debits))
+        queries = []
+        for rows_, sharded in ((rows, False), (sharded_rows, True)):
+            if rows_:
+                queries.append((
+                    balances_update_query(len(rows_), sharded=sharded),
+                    tuple(value for row in rows_ for value in row)))
+        return queries
 
     async def __account_exists(self, account_id: int) -> bool:
         """
         Return True if the account's id exist in the DB, False otherwise
+        The DB is queried only if it's not known yet. An account missing
+        from a lagging replica is looked up again by the pinned reads
         """
-        query = f"SELECT * FROM {Tables.accounts.value} WHERE id={account_id}"
-        rows = await self._db.execute(query)
-        return bool(rows)
+        if self._accounts.get(account_id):
+            return True
+        if (not Database.is_primary_pinned()
+                and self._missing_accounts.get(account_id)):
+            return False
+        row = await self.__load(
+            self._accounts_loader, self.__load_accounts, account_id)
+        self.__record_account(account_id, row is not None)
+        return row is not None
 
-    async def __get_credit_transfers(self, account_id: int) -> list[models.Transfer]:
+    @staticmethod
+    async def __load(
+            loader: utils.BatchLoader,
+            load_many: Callable[[list[int]], Awaitable[dict]],
+            account_id: int
+    ):
         """
-        Get transfer to this account from the DB,
-        and format them into Transfer models
+        Load the account's row, batched with the concurrent lookups.
+        Reads pinned to the primary are not batched with the others,
+        which are read from the replicas
         """
-        query = (
-            f"SELECT id, from_id, `utc_timestamp`, amount FROM {Tables.transfers.value} "
-            f"WHERE to_id={account_id}")
-        rows = await self._db.execute(query)
-        return [
-            models.Transfer(
-                id=r[0],
-                type=models.TransferType.credit,
-                from_id=r[1],
-                to_id=account_id,
-                utc_timestamp=r[2],
-                amount=r[3]
-            ) for r in rows
-        ]
+        if Database.is_primary_pinned():
+            return (await load_many([account_id])).get(account_id)
+        return await loader.load(account_id)
 
-    async def __get_debit_transfers(self, account_id: int) -> list[models.Transfer]:
+    async def __load_accounts(self, account_ids: list[int]) -> dict[int, tuple]:
         """
-        Get transfer from this account from the DB,
-        and format them into Transfer models
+        Read the given accounts in a single query
+
+        :return: the (id, owner_id, deposit) rows by id
         """
         query = (
-            f"SELECT id, to_id, `utc_timestamp`, amount FROM {Tables.transfers.value} "
-            f"WHERE from_id={account_id}")
-        rows = await self._db.execute(query)
-        return [
-            models.Transfer(
-                id=r[0],
-                type=models.TransferType.debit,
-                from_id=account_id,
-                to_id=r[1],
-                utc_timestamp=r[2],
-                amount=r[3]
-            ) for r in rows
-        ]
+            f"SELECT id, owner_id, deposit FROM {Tables.accounts.value} "
+            f"WHERE id IN ({', '.join(['%s'] * len(account_ids))})")
+        rows = await self._db.read(query, tuple(account_ids))
+        return {r[0]: tuple(r) for r in rows}
+
+    async def __load_balances(self, account_ids: list[int]) -> dict[int, tuple]:
+        """
+        Read the initial deposit, credits & debits of the given accounts
+        in a single query
+
+        :return: the (deposit, credits, debits) rows by id
+        """
+        query = self.__balances_query(len(account_ids))
+        rows = await self._db.read(query, tuple(account_ids))
+        return {r[0]: tuple(r[1:]) for r in rows}
+
+    def __balances_query(self, accounts: int) -> str:
+        """
+        Build the query reading the (id, deposit, credits, debits) rows
+        of `accounts` accounts, given their ids
+        """
+        if self._config.precomputed_balances:
+            # credits & debits are maintained on every transfer. Those of
+            # the hot accounts are partly in their not yet folded shards
+            query = (
+                f"SELECT a.id, a.deposit, COALESCE(b.credits, 0) + "
+                f"(SELECT COALESCE(SUM(credits), 0) "
+                f"FROM {Tables.balance_shards.value} WHERE id=a.id), "
+                f"COALESCE(b.debits, 0) + "
+                f"(SELECT COALESCE(SUM(debits), 0) "
+                f"FROM {Tables.balance_shards.value} WHERE id=a.id) "
+                f"FROM {Tables.accounts.value} a "
+                f"LEFT JOIN {Tables.balances.value} b ON b.id=a.id ")
+        else:
+            # The sums are computed by the DB, so that only one row is
+            # returned per account, whatever the number of its transfers
+            query = (
+                f"SELECT a.id, a.deposit, "
+                f"(SELECT COALESCE(SUM(amount), 0) FROM {Tables.transfers.value} "
+                f"WHERE to_id=a.id), "
+                f"(SELECT COALESCE(SUM(amount), 0) FROM {Tables.transfers.value} "
+                f"WHERE from_id=a.id) "
+                f"FROM {Tables.accounts.value} a ")
+        return query + f"WHERE a.id IN ({', '.join(['%s'] * accounts)})"
+
+    @contextlib.asynccontextmanager
+    async def __transfers_transaction(
+            self,
+            transfers: list[tuple[int, int, float]]
+    ) -> AsyncIterator[Transaction]:
+        """
+        Transaction making the given transfers.
+        If the overdraft check is enabled, their source accounts are locked
+        until it's over, and it's rejected if any of them can't afford its
+        transfers.
+        Their in-process locks are taken first, so that transfers from the
+        same account made by this worker wait without holding a connection.
+        Then their rows are locked, for the transfers of the other workers.
+        Transfers from other accounts only wait if they share a lock
+        stripe. Accounts created into a locked gap wait too (see
+        `__check_funds`)
+
+        :param transfers: list of (source_id, target_id, amount)
+        """
+        if not self._config.overdraft_check:
+            async with self._db.transaction() as tx:
+                yield tx
+            return
+        source_ids = sorted({source_id for source_id, _, _ in transfers})
+        async with self._account_locks.hold(*source_ids):
+            async with self._db.transaction() as tx:
+                await self.__check_funds(tx, source_ids, transfers)
+                yield tx
+
+    async def __check_funds(
+            self,
+            tx: Transaction,
+            source_ids: list[int],
+            transfers: list[tuple[int, int, float]]
+    ):
+        """
+        Lock the rows of the source accounts, in id order to avoid
+        deadlocks, and check that their balances cover the transfers,
+        in order. Unknown accounts are external: they are not checked,
+        but InnoDB locks the gap where their rows would be, until the
+        transaction is over
+        """
+        args = tuple(source_ids)
+        await tx.execute(
+            f"SELECT id FROM {Tables.accounts.value} "
+            f"WHERE id IN ({', '.join(['%s'] * len(source_ids))}) "
+            f"ORDER BY id FOR UPDATE", args)
+        rows = await tx.execute(self.__balances_query(len(source_ids)), args)
+        balances = {r[0]: r[1] + r[2] - r[3] for r in rows}
+        for source_id, target_id, amount in transfers:
+            if source_id in balances:
+                if balances[source_id] < amount:
+                    raise InsufficientFundsException(
+                        f"Account with id={source_id} has insufficient "
+                        f"funds for a transfer of amount={amount}")
+                balances[source_id] -= amount
+            if target_id in balances:
+                balances[target_id] += amount
+
+    @staticmethod
+    def __idempotency(
+            idempotency_key: str | None,
+            **params: str | int | float
+    ) -> tuple[str, str] | None:
+        """
+        Return the idempotency key of a request, along the hash of its
+        `params`, None if it has no key
+        """
+        if idempotency_key is None:
+            return None
+        fingerprint = json.dumps(params, sort_keys=True).encode()
+        return idempotency_key, hashlib.sha256(fingerprint).hexdigest()
+
+    async def __idempotent(
+            self,
+            endpoint: str,
+            idempotency: tuple[str, str] | None,
+            model: type[pydantic.BaseModel],
+            write: Callable[[], Awaitable[pydantic.BaseModel]]
+    ) -> pydantic.BaseModel:
+        """
+        Run `write` once per idempotency key & endpoint: the next calls
+        with the same key, or the concurrent ones, get its response back.
+        The concurrent ones wait for the first one: each call runs in its
+        own request, and reuses its connection (see `Database.request_scope`).
+        `write` should store its response (see `__store_response`).
+        A call whose request hash differs from the first one's is rejected
+
+        :param idempotency: (key, request hash). `write` is just run if None
+        """
+        if idempotency is None:
+            return await write()
+        idempotency_key, request_hash = idempotency
+        async with self._idempotency_locks.hold((endpoint, idempotency_key)):
+            stored = self._responses.get((endpoint, idempotency_key))
+            if stored is None:
+                stored = await self.__idempotent_write(
+                    endpoint, idempotency, model, write)
+        stored_hash, response = stored
+        if stored_hash != request_hash:
+            raise IdempotencyKeyReusedException(
+                f"Idempotency key={idempotency_key} was already used "
+                f"with other parameters")
+        # the next reads of this request should see the written rows
+        self.pin_primary()
+        return response
+
+    async def __idempotent_write(
+            self,
+            endpoint: str,
+            idempotency: tuple[str, str],
+            model: type[pydantic.BaseModel],
+            write: Callable[[], Awaitable[pydantic.BaseModel]]
+    ) -> tuple[str, pydantic.BaseModel]:
+        idempotency_key, request_hash = idempotency
+        stored = await self.__stored_response(endpoint, idempotency_key, model)
+        if stored is None:
+            try:
+                stored = request_hash, await write()
+            except IntegrityError:
+                # another worker stored a response for this key first:
+                # the write was rolled back
+                stored = await self.__stored_response(
+                    endpoint, idempotency_key, model)
+                if stored is None:
+                    raise
+        self._responses.set((endpoint, idempotency_key), stored)
+        return stored
+
+    async def __stored_response(
+            self,
+            endpoint: str,
+            idempotency_key: str,
+            model: type[pydantic.BaseModel]
+    ) -> tuple[str, pydantic.BaseModel] | None:
+        """
+        Read the request hash & response stored for this idempotency key,
+        if any. It's read from the primary, which has the latest keys
+        """
+        rows = await self._db.execute(
+            f"SELECT request_hash, response "
+            f"FROM {Tables.idempotency_keys.value} "
+            f"WHERE endpoint=%s AND idempotency_key=%s",
+            (endpoint, idempotency_key))
+        if not rows:
+            return None
+        logger.debug(
+            f"Found stored response for idempotency_key={idempotency_key}")
+        return rows[0][0], model.model_validate_json(rows[0][1])
+
+    @staticmethod
+    async def __store_response(
+            tx: Transaction,
+            endpoint: str,
+            idempotency: tuple[str, str],
+            response: pydantic.BaseModel
+    ):
+        """
+        Store the response of the idempotency key, and its request's hash,
+        in the write's transaction. It fails if the key is already stored
+        """
+        idempotency_key, request_hash = idempotency
+        await tx.insert(
+            Tables.idempotency_keys,
+            "endpoint", endpoint,
+            "idempotency_key", idempotency_key,
+            "request_hash", request_hash,
+            "response", response.model_dump_json(),
+            "`utc_timestamp`", utils.get_utc_timestamp(),
+        )
+
+    async def __balances_changed(self, account_ids: list[int]):
+        """
+        Drop the changed balances from this worker's cache,
+        and from the other workers' ones
+        """
+        self.invalidate_balances(account_ids)
+        try:
+            await self._invalidation.publish(account_ids)
+        except Exception:
+            # the transfers are committed anyway: the other workers'
+            # entries expire after the cache's ttl
+            logger.exception(
+                f"Failed to publish the changed balances of "
+                f"accounts={account_ids}")
+
+    def __record_account(self, account_id: int, exists: bool):
+        """
+        Remember whether the account exists, for the next lookups
+        """
+        if exists:
+            self._accounts.set(account_id, True)
+            self._missing_accounts.pop(account_id)
+        else:
+            self._missing_accounts.set(account_id, True)
+
+    @staticmethod
+    def __transfer_from_row(row: tuple) -> models.Transfer:
+        """
+        Format a row of the history query into a Transfer model
+        """
+        return models.Transfer(
+            id=row[0],
+            type=models.TransferType(row[1]),
+            from_id=row[2],
+            to_id=row[3],
+            utc_timestamp=row[4],
+            amount=row[5]
+        )
+
+    @staticmethod
+    def __history_query(
+            account_id: int,
+            type_: models.TransferType,
+            limit: int | None,
+            after: tuple[int, int, str] | None,
+            since: int | None = None,
+            until: int | None = None
+    ) -> tuple[str, QueryArgs]:
+        """
+        Build the query, and its args, returning the page of at most `limit`
+        transfers of type `type_` from or to `account_id` coming after
+        `after`, made between `since` and `until`,
+        sorted by (utc_timestamp, id, type).
+
+        Each type of transfer is a range on its own
+        (account, utc_timestamp) index, whose entries also hold the id.
+        For `any` type, both ranges are merged by MySQL with UNION ALL:
+        a transfer to the account itself is in both, sorted by type
+        """
+        branches = []
+        if type_ in (models.TransferType.credit, models.TransferType.any):
+            branches.append((models.TransferType.credit, "to_id"))
+        if type_ in (models.TransferType.debit, models.TransferType.any):
+            branches.append((models.TransferType.debit, "from_id"))
+
+        range_filter, range_args = "", ()
+        if since is not None and until is not None:
+            range_filter += " AND `utc_timestamp` BETWEEN %s AND %s"
+            range_args += (since, until)
+        elif since is not None:
+            range_filter += " AND `utc_timestamp` >= %s"
+            range_args += (since,)
+        elif until is not None:
+            range_filter += " AND `utc_timestamp` <= %s"
+            range_args += (until,)
+        order = " ORDER BY `utc_timestamp`, id"
+        limit_filter, limit_args = "", ()
+        if limit is not None:
+            limit_filter, limit_args = " LIMIT %s", (limit,)
+
+        selects, args = [], ()
+        for transfer_type, column in branches:
+            page_filter, page_args = range_filter, range_args
+            if after is not None:
+                after_timestamp, after_id, after_type = after
+                # the transfer of `after` comes again in this branch if
+                # its type is sorted after the type of `after`
+                id_operator = ">=" if transfer_type.value > after_type else ">"
+                page_filter += (
+                    f" AND (`utc_timestamp` > %s "
+                    f"OR (`utc_timestamp` = %s AND id {id_operator} %s))")
+                page_args += (after_timestamp, after_timestamp, after_id)
+            selects.append(
+                f"SELECT id, '{transfer_type.value}' AS transfer_type, "
+                f"from_id, to_id, `utc_timestamp`, amount "
+                f"FROM {Tables.transfers.value} WHERE {column}=%s"
+                + page_filter)
+            args += (account_id,) + page_args + limit_args
+        if len(selects) == 1:
+            return selects[0] + order + limit_filter, args
+
+        # each branch reads at most a page, before being merged
+        inner = order + limit_filter if limit is not None else ""
+        query = " UNION ALL ".join(
+            [f"({select}{inner})" for select in selects]
+        ) + order + ", transfer_type" + limit_filter
+        return query, args + limit_args
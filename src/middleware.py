@@ -18,7 +18,7 @@ class LoggerMiddleware(BaseHTTPMiddleware):
     """
     # some endpoints don't require any logging
     # they should be added to this set
-    excluded_paths = {"/ping"}
+    excluded_paths = {"/ping", "/stats"}
 
     async def dispatch(
             self,
@@ -36,7 +36,7 @@ class LoggerMiddleware(BaseHTTPMiddleware):
             # Those errors are expected, and don't require any logging
             status_code = err.http_status
             return JSONResponse(
-                {"error": "NOT_FOUND", "message": str(err)},
+                {"error": err.error, "message": str(err)},
                 status_code=status_code
             )
         except:
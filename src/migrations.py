@@ -0,0 +1,144 @@
+import dataclasses
+
+import utils
+from database import Database, Tables
+
+logger = utils.get_logger(__name__)
+
+
+@dataclasses.dataclass
+class Migration:
+    version: int
+    description: str
+    queries: tuple[str, ...]
+
+
+# The ordered list of schema changes, applied once on every database.
+# Applied migrations should never be modified: add a new one instead,
+# with the next version number
+MIGRATIONS: list[Migration] = [
+    Migration(
+        version=1,
+        description="Index transfers by source account",
+        queries=(
+            f"CREATE INDEX ix_transfers_from_id ON {Tables.transfers.value} "
+            f"(from_id, `utc_timestamp`)",
+        ),
+    ),
+    Migration(
+        version=2,
+        description="Index transfers by target account",
+        queries=(
+            f"CREATE INDEX ix_transfers_to_id ON {Tables.transfers.value} "
+            f"(to_id, `utc_timestamp`)",
+        ),
+    ),
+    Migration(
+        version=3,
+        description="Index customers by name",
+        queries=(
+            # names can be longer than the maximum key length:
+            # only their prefix is indexed
+            f"CREATE INDEX ix_customers_name ON {Tables.customers.value} "
+            f"(name(255))",
+        ),
+    ),
+    Migration(
+        version=4,
+        description="Index accounts by owner",
+        queries=(
+            f"CREATE INDEX ix_accounts_owner_id ON {Tables.accounts.value} "
+            f"(owner_id)",
+        ),
+    ),
+    Migration(
+        version=5,
+        description="Make customers' names unique",
+        queries=(
+            # merge the customers with the same name into the oldest one
+            f"UPDATE {Tables.accounts.value} a "
+            f"JOIN {Tables.customers.value} c ON c.id = a.owner_id "
+            f"JOIN (SELECT MIN(id) AS id, BINARY name AS name "
+            f"FROM {Tables.customers.value} GROUP BY BINARY name) k "
+            f"ON k.name = BINARY c.name "
+            f"SET a.owner_id = k.id WHERE a.owner_id <> k.id",
+            f"DELETE c FROM {Tables.customers.value} c "
+            f"JOIN {Tables.customers.value} k "
+            f"ON BINARY k.name = BINARY c.name AND k.id < c.id",
+            # names can be longer than the maximum key length:
+            # their hash is unique instead
+            f"ALTER TABLE {Tables.customers.value} "
+            f"ADD COLUMN name_hash BINARY(32) "
+            f"AS (UNHEX(SHA2(name, 256))) STORED, "
+            f"ADD UNIQUE INDEX ux_customers_name_hash (name_hash), "
+            f"DROP INDEX ix_customers_name",
+        ),
+    ),
+    Migration(
+        version=6,
+        description="Store the responses of idempotent requests",
+        queries=(
+            f"CREATE TABLE IF NOT EXISTS {Tables.idempotency_keys.value} ("
+            f"id int NOT NULL AUTO_INCREMENT PRIMARY KEY, "
+            f"endpoint Varchar(32) NOT NULL, "
+            f"idempotency_key Varchar(255) NOT NULL, "
+            f"request_hash Char(64) NOT NULL, "
+            f"response Text NOT NULL, "
+            f"`utc_timestamp` int, "
+            f"UNIQUE INDEX ux_idempotency_keys (endpoint, idempotency_key), "
+            f"INDEX ix_idempotency_keys_utc_timestamp (`utc_timestamp`))",
+        ),
+    ),
+    Migration(
+        version=7,
+        description="Split the running balances of hot accounts",
+        queries=(
+            f"CREATE TABLE IF NOT EXISTS {Tables.balance_shards.value} ("
+            f"id int NOT NULL, "
+            f"shard int NOT NULL, "
+            f"credits double NOT NULL DEFAULT 0, "
+            f"debits double NOT NULL DEFAULT 0, "
+            f"PRIMARY KEY (id, shard))",
+        ),
+    ),
+    Migration(
+        version=8,
+        description="Checkpoint the balances",
+        queries=(
+            f"CREATE TABLE IF NOT EXISTS {Tables.balance_checkpoints.value} ("
+            f"account_id int NOT NULL, "
+            f"`utc_timestamp` int NOT NULL, "
+            f"credits double NOT NULL, "
+            f"debits double NOT NULL, "
+            f"PRIMARY KEY (account_id, `utc_timestamp`))",
+        ),
+    ),
+]
+
+
+async def migrate(db: Database, migrations: list[Migration] | None = None):
+    """
+    Apply, in version order, all migrations that weren't applied yet,
+    and record them in the `schema_versions` table.
+    A MySQL lock makes sure that workers starting at the same time don't
+    apply the same migration twice
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+    async with db.lock("schema_migrations"):
+        rows = await db.execute(
+            f"SELECT version FROM {Tables.schema_versions.value}")
+        applied = {r[0] for r in rows}
+        for migration in sorted(migrations, key=lambda m: m.version):
+            if migration.version in applied:
+                continue
+            logger.info(
+                f"[MySQL] Applying migration version={migration.version}: "
+                f"{migration.description}")
+            for query in migration.queries:
+                await db.execute(query)
+            await db.insert(
+                Tables.schema_versions,
+                "version", migration.version,
+                "description", migration.description,
+                "`utc_timestamp`", utils.get_utc_timestamp(),
+            )
@@ -41,6 +41,15 @@ class Transfer(pydantic.BaseModel):
     )
 
 
+class TransferRequest(pydantic.BaseModel):
+    source_id: int = Field(..., description="Transfer from this account's id")
+    target_id: int = Field(..., description="Transfer to this account's id")
+    amount: float = Field(
+        ...,
+        description="Transfer's amount. Should be positive"
+    )
+
+
 class Balances(pydantic.BaseModel):
     account_id: int = Field(
         ...,
@@ -1,7 +1,9 @@
 from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-from fastapi import FastAPI, status
-from fastapi.responses import Response
+import pydantic
+from fastapi import Depends, FastAPI, Header, Query, status
+from fastapi.responses import Response, StreamingResponse
 
 import middleware
 import models
@@ -32,6 +34,12 @@ tags_metadata = [
 # which is possible only inside an async function
 handler: Handler | None = None
 
+# maximum number of transfers returned by a single history page
+MAX_HISTORY_PAGE_SIZE = 1000
+
+# Newline-delimited JSON: one JSON object per line
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
 
 @asynccontextmanager
 async def lifespan(_):
@@ -44,27 +52,77 @@ async def lifespan(_):
         logger.critical("Unexpected failure while creating the handler")
         raise
     yield
+    # write the pending transfers before shutting down
+    await handler.close()
     # delete the handler object while the event loop is still not closed
     del handler
 
 
+async def read_your_writes(x_read_your_writes: bool = Header(False)):
+    """
+    Reads are sent to replicas, which might lag behind the primary.
+    With the `X-Read-Your-Writes: true` header, the request reads from the
+    primary, and sees the latest writes
+    """
+    if x_read_your_writes:
+        handler.pin_primary()
+
+
+async def request_connections():
+    """
+    The DB connections acquired by the request are reused by its next
+    queries, and released once the response is sent
+    (if `MYSQL_REQUEST_SCOPED_CONNECTIONS` is enabled)
+    """
+    if handler is None:  # e.g. health checks, which don't use the DB
+        yield
+        return
+    async with handler.request_scope():
+        yield
+
+
 app = FastAPI(
     title="Simple Banking API",
     description=description,
     summary="API to handle accounts",
     version="0.0.1",
     lifespan=lifespan,
+    dependencies=[Depends(request_connections), Depends(read_your_writes)],
 )
 
 # add middleware to log request events & errors
 app.add_middleware(middleware.LoggerMiddleware)
 
 
+def wants_ndjson(stream: bool, accept: str | None) -> bool:
+    """
+    The streaming mode is selected either by the `stream` query flag,
+    or by accepting the NDJSON media type
+    """
+    return stream or (accept is not None and NDJSON_MEDIA_TYPE in accept)
+
+
+def ndjson_response(items: AsyncIterator[pydantic.BaseModel]) -> StreamingResponse:
+    """
+    Stream each item as a JSON line, as soon as it is yielded
+    """
+    async def lines() -> AsyncIterator[str]:
+        async for item in items:
+            yield item.model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
 @app.get("/ping", include_in_schema=False)
 def ping():
     return Response("OK!")
 
 
+@app.get("/stats", include_in_schema=False)
+def stats():
+    return handler.stats()
+
+
 @app.post(
     "/account",
     tags=["accounts"],
@@ -72,8 +130,17 @@ def ping():
     response_model=models.Account,
     response_model_exclude_none=True,
 )
-async def create_account(customer: str, deposit: float):
-    return await handler.create_account(customer, deposit)
+async def create_account(
+        customer: str,
+        deposit: float,
+        idempotency_key: str | None = Header(None, max_length=255)
+):
+    """
+    A retried request with the same `Idempotency-Key` header returns the
+    account created by the first one, and doesn't create any other
+    """
+    return await handler.create_account(
+        customer, deposit, idempotency_key=idempotency_key)
 
 
 @app.get(
@@ -81,7 +148,17 @@ async def create_account(customer: str, deposit: float):
     tags=["accounts"],
     response_model=list[models.Account],
 )
-async def get_accounts(account_id: int | None = None):
+async def get_accounts(
+        account_id: int | None = None,
+        stream: bool = False,
+        accept: str | None = Header(None)
+):
+    """
+    When listing all accounts, they can be streamed as NDJSON by setting
+    `stream=true`, or the `Accept: application/x-ndjson` header
+    """
+    if account_id is None and wants_ndjson(stream, accept):
+        return ndjson_response(handler.stream_accounts())
     return await handler.get_accounts(account_id=account_id)
 
 
@@ -90,8 +167,12 @@ async def get_accounts(account_id: int | None = None):
     tags=["accounts"],
     response_model=models.Balances,
 )
-async def get_balances(account_id: int):
-    return await handler.get_balances(account_id)
+async def get_balances(account_id: int, as_of: int | None = None):
+    """
+    If the `as_of` UTC timestamp is given, the balances at this time are
+    returned instead of the current ones
+    """
+    return await handler.get_balances(account_id, as_of=as_of)
 
 
 @app.post(
@@ -104,9 +185,28 @@ async def get_balances(account_id: int):
 async def accounts_transfer(
         source_id: int,
         target_id: int,
-        amount: float
+        amount: float,
+        idempotency_key: str | None = Header(None, max_length=255)
 ) -> models.Transfer:
-    return await handler.transfer(source_id, target_id, amount)
+    """
+    A retried request with the same `Idempotency-Key` header returns the
+    transfer made by the first one, and doesn't make any other
+    """
+    return await handler.transfer(
+        source_id, target_id, amount, idempotency_key=idempotency_key)
+
+
+@app.post(
+    "/transfers/batch",
+    tags=["transfers"],
+    status_code=status.HTTP_201_CREATED,
+    response_model=list[models.Transfer],
+    response_model_exclude_defaults=True,
+)
+async def accounts_transfer_batch(
+        transfers: list[models.TransferRequest]
+) -> list[models.Transfer]:
+    return await handler.transfer_batch(transfers)
 
 
 @app.get(
@@ -115,7 +215,39 @@ async def accounts_transfer(
     response_model=list[models.Transfer],
 )
 async def get_transfer_history(
+        response: Response,
         account_id: int,
-        transfer_type: models.TransferType = models.TransferType.any
+        transfer_type: models.TransferType = models.TransferType.any,
+        limit: int | None = Query(None, gt=0, le=MAX_HISTORY_PAGE_SIZE),
+        cursor: str | None = None,
+        since: int | None = None,
+        until: int | None = None,
+        stream: bool = False,
+        accept: str | None = Header(None)
 ):
-    return await handler.get_transfer_history(account_id, type_=transfer_type)
+    """
+    If `since` and/or `until` UTC timestamps are given, only the transfers
+    made in this time range (inclusive) are returned.
+
+    If `limit` is given, at most `limit` transfers are returned. When the page
+    is full, the `X-Next-Cursor` response header holds the `cursor` to pass to
+    get the next page
+
+    The transfers can be streamed as NDJSON by setting `stream=true`, or the
+    `Accept: application/x-ndjson` header. In this mode, no next cursor is
+    returned
+    """
+    after = utils.decode_cursor(cursor) if cursor is not None else None
+    if wants_ndjson(stream, accept):
+        transfers = await handler.stream_transfer_history(
+            account_id, type_=transfer_type, limit=limit, after=after,
+            since=since, until=until)
+        return ndjson_response(transfers)
+    transfers = await handler.get_transfer_history(
+        account_id, type_=transfer_type, limit=limit, after=after,
+        since=since, until=until)
+    if limit is not None and len(transfers) == limit:
+        last = transfers[-1]
+        response.headers["X-Next-Cursor"] = utils.encode_cursor(
+            last.utc_timestamp, last.id, last.type.value)
+    return transfers
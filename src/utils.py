@@ -1,11 +1,21 @@
+import asyncio
+import base64
+import binascii
+import collections
+import contextlib
+import contextvars
 import datetime
 import logging
 import os
+import time
 from datetime import timezone
 from http.client import responses
+from typing import Any, Awaitable, Callable, Hashable
 
 from fastapi import Request
 
+from exceptions import BadRequestException
+
 
 def get_utc_timestamp() -> int:
     # Getting the current date and time
@@ -14,6 +24,31 @@ def get_utc_timestamp() -> int:
     return int(utc_time.timestamp())
 
 
+def encode_cursor(utc_timestamp: int, id_: int, type_: str) -> str:
+    """
+    Encode the position of a transfer, (utc_timestamp, id, type),
+    into an opaque pagination cursor
+    """
+    raw = f"{utc_timestamp}:{id_}:{type_}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[int, int, str]:
+    """
+    Decode a pagination cursor created by `encode_cursor`
+    into (utc_timestamp, id, type)
+    If the cursor is invalid, a BadRequestException is raised
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        utc_timestamp, id_, type_ = raw.split(":")
+        if type_ not in ("credit", "debit"):
+            raise ValueError(f"Unknown transfer type={type_}")
+        return int(utc_timestamp), int(id_), type_
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise BadRequestException(f"Invalid cursor={cursor}") from e
+
+
 def server_log_message(req: Request, status_code: int):
     """
     Create a nice looking log for server responses
@@ -22,6 +57,58 @@ def server_log_message(req: Request, status_code: int):
     return f"\"{req.method} {req.url}\" {status_str}"
 
 
+def get_env_flag(name: str, default: bool = False) -> bool:
+    """
+    Parse the environment `name` as a boolean flag: "1" or "0"
+    If it is unset or has the wrong format, `default` is returned
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return bool(int(value))
+    except ValueError:
+        logging.exception(
+            f"{name} environment has the wrong format: {value}")
+        return default
+
+
+def get_env_int(name: str, default: int) -> int:
+    """
+    Parse the environment `name` as an integer
+    If it is unset or has the wrong format, `default` is returned
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.exception(
+            f"{name} environment has the wrong format: {value}")
+        return default
+
+
+def get_env_int_map(name: str) -> dict[int, int]:
+    """
+    Parse the environment `name` as a mapping of integers to integers,
+    formatted as "key:value,key:value"
+    If it is unset or has the wrong format, an empty mapping is returned
+    """
+    value = os.getenv(name)
+    if not value:
+        return {}
+    try:
+        return {
+            int(k): int(v)
+            for k, v in (item.split(":") for item in value.split(","))
+        }
+    except ValueError:
+        logging.exception(
+            f"{name} environment has the wrong format: {value}")
+        return {}
+
+
 def get_logger(name: str) -> logging.Logger:
     """
     Create a custom logger:
@@ -29,13 +116,7 @@ def get_logger(name: str) -> logging.Logger:
     - make sure logs are streamed to the console
     """
     # parse debug from environment
-    debug_env = os.getenv("DEBUG", "0")
-    try:
-        debug = bool(int(debug_env))
-    except ValueError:
-        logging.exception(
-            f"DEBUG environment has the wrong format: {debug_env}")
-        debug = False
+    debug = get_env_flag("DEBUG")
 
     # create handler and formatter
     handler = logging.StreamHandler()
@@ -54,3 +135,357 @@ def get_logger(name: str) -> logging.Logger:
         handler.setLevel(logging.INFO)
     logger.addHandler(handler)
     return logger
+
+
+class LRUCache(object):
+    """
+    In-memory mapping keeping at most `maxsize` items: when it's full,
+    the least recently used item is evicted.
+    If `ttl` is set, items expire `ttl` seconds after being set.
+    A `maxsize` of 0 disables the cache: nothing is kept
+
+    >> cache = LRUCache(2)
+    >> cache.set("John", 1)
+    >> cache.get("John")
+    1
+    """
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # (value, expiration time) by key
+        self._items: collections.OrderedDict = collections.OrderedDict()
+        # usage counters, see `stats`
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __lookup(self, key) -> tuple[bool, object]:
+        """
+        Return whether `key` is cached and not expired, and its value
+        """
+        if key not in self._items:
+            return False, None
+        value, expires_at = self._items[key]
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._items[key]
+            self._expirations += 1
+            return False, None
+        return True, value
+
+    def get(self, key, default=None):
+        """
+        Return the value of `key`, or `default` if it's not cached
+        """
+        found, value = self.__lookup(key)
+        if not found:
+            self._misses += 1
+            return default
+        self._hits += 1
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self._maxsize <= 0:
+            return
+        expires_at = None
+        if self._ttl is not None:
+            expires_at = time.monotonic() + self._ttl
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+        if len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+            self._evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        Remove `key`, and return its value or `default` if it's not cached
+        """
+        found, value = self.__lookup(key)
+        self._items.pop(key, None)
+        return value if found else default
+
+    def stats(self) -> dict:
+        """
+        Return the cache's size and usage counters
+        """
+        lookups = self._hits + self._misses
+        return {
+            "size": len(self._items),
+            "maxsize": self._maxsize,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.,
+            # items removed to make room for new ones
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls: while a call for a given key is in flight,
+    the next calls with the same key don't run, but share its result (or
+    error). Once it's over, the next call runs again: no result is
+    kept, so that none is stale
+
+    >> flight = SingleFlight()
+    >> await asyncio.gather(
+    >>     flight.do("balances-1", lambda: read_balances(1)),
+    >>     flight.do("balances-1", lambda: read_balances(1)),
+    >> )  # read_balances is called once
+    """
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]) -> Any:
+        """
+        Return the result of `fn()`, or of the in-flight call with `key`
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+        # a cancelled caller doesn't cancel the call shared with the others
+        return await asyncio.shield(call)
+
+
+class StripedLock(object):
+    """
+    In-process locks by key, e.g. by account's id. Keys are spread over a
+    fixed number of locks (stripes): unrelated keys rarely share one, and
+    the memory used doesn't grow with the number of keys.
+    Locks are always taken in the same order, so that two callers locking
+    the same keys can't deadlock
+
+    >> locks = StripedLock(1024)
+    >> async with locks.hold(2, 1):
+    >>     ...  # no other caller holds 1 or 2
+    """
+    def __init__(self, stripes: int):
+        if stripes <= 0:
+            raise ValueError("The number of stripes should be positive")
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys: Hashable):
+        """
+        Hold the locks of all given keys
+        """
+        stripes = sorted({hash(key) % len(self._locks) for key in keys})
+        async with contextlib.AsyncExitStack() as stack:
+            for stripe in stripes:
+                await stack.enter_async_context(self._locks[stripe])
+            yield
+
+
+class BatchLoader(object):
+    """
+    Batch the loads of single keys: the keys loaded within the same event
+    loop iteration (or `delay` seconds) are loaded at once, by a single
+    call of `load_many`, which returns the found values by key.
+    Each caller gets its own key's value, or None if it wasn't found
+
+    >> loader = BatchLoader(read_accounts)
+    >> await asyncio.gather(loader.load(1), loader.load(2))
+    >> # read_accounts is called once, with [1, 2]
+    """
+    def __init__(
+            self,
+            load_many: Callable[[list], Awaitable[dict]],
+            delay: float = 0.,
+            max_batch_size: int = 1000
+    ):
+        self._load_many = load_many
+        self._delay = delay
+        self._max_batch_size = max_batch_size
+        # the batch being collected: a future per key
+        self._batch: dict[Hashable, asyncio.Future] = {}
+        # the running loads, referenced until they are over
+        self._loads: set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable) -> Any:
+        """
+        Return the value of `key`, loaded along the other keys of its batch
+        """
+        future = self._batch.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._batch:
+                # the batch is loaded outside any request's context, since
+                # it's shared by several requests
+                context = contextvars.Context()
+                if self._delay > 0:
+                    loop.call_later(
+                        self._delay, self.__dispatch, self._batch,
+                        context=context)
+                else:
+                    loop.call_soon(
+                        self.__dispatch, self._batch, context=context)
+            future = loop.create_future()
+            self._batch[key] = future
+            if len(self._batch) >= self._max_batch_size:
+                # full: the next keys join a new batch
+                self._batch = {}
+        # a cancelled caller doesn't cancel the load of the others
+        return await asyncio.shield(future)
+
+    def __dispatch(self, batch: dict[Hashable, asyncio.Future]):
+        if self._batch is batch:
+            self._batch = {}
+        task = asyncio.ensure_future(self.__load(batch))
+        self._loads.add(task)
+        task.add_done_callback(self._loads.discard)
+
+    async def __load(self, batch: dict[Hashable, asyncio.Future]):
+        try:
+            values = await self._load_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for key, future in batch.items():
+            future.set_result(values.get(key))
+
+
+class BatchWriter(object):
+    """
+    Write-behind queue: the written items are queued, and a background
+    task writes everything queued within `max_wait` seconds (up to
+    `batch_size` items) by a single call of `write_many`, which returns a
+    result per item. Each writer waits until its item's batch is written,
+    and gets its own result.
+    Once `max_queue_size` items are queued, the writers wait for some room
+    (backpressure)
+
+    >> writer = BatchWriter(insert_transfers)
+    >> await asyncio.gather(writer.write(t1), writer.write(t2))
+    >> # insert_transfers is called once, with [t1, t2]
+    """
+    def __init__(
+            self,
+            write_many: Callable[[list], Awaitable[list]],
+            batch_size: int = 100,
+            max_wait: float = 0.005,
+            max_queue_size: int = 10000
+    ):
+        self._write_many = write_many
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        # (item, future) pairs. A None item stops the background task
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task: asyncio.Task | None = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def write(self, item: Any) -> Any:
+        """
+        Queue `item`, and return its result once written
+        """
+        if self._closed:
+            raise RuntimeError("The writer is closed")
+        if self._task is None:
+            # the background task runs outside any request's context,
+            # since it writes the items of several requests
+            self._task = contextvars.Context().run(
+                asyncio.ensure_future, self.__run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        # a cancelled writer doesn't cancel the write of the others
+        return await asyncio.shield(future)
+
+    async def close(self):
+        """
+        Write the queued items, then stop the background task
+        """
+        self._closed = True
+        if self._task is None:
+            return
+        await self._queue.put((None, None))
+        await self._task
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait
+            while batch[-1][0] is not None and len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                try:
+                    batch.append(await asyncio.wait_for(
+                        self._queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            stopped = batch[-1][0] is None
+            if stopped:
+                batch.pop()
+            if batch:
+                await self.__write(batch)
+            if stopped:
+                return
+
+    async def __write(self, batch: list[tuple[Any, asyncio.Future]]):
+        try:
+            results = await self._write_many([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+class PeriodicTask(object):
+    """
+    Background task calling `fn` every `interval` seconds, until it's
+    closed. A failed call is logged, and the next ones run anyway
+
+    >> task = PeriodicTask(fold_counters, interval=60)
+    >> task.start()
+    >> ...
+    >> await task.close()
+    """
+    def __init__(self, fn: Callable[[], Awaitable], interval: float):
+        self._fn = fn
+        self._interval = interval
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        """
+        Start the background task, if it isn't yet
+        """
+        if self._task is None:
+            # the background task runs outside any request's context
+            self._task = contextvars.Context().run(
+                asyncio.ensure_future, self.__run())
+
+    async def close(self):
+        """
+        Stop the background task, cancelling its current call if any
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self._fn()
+            except Exception:
+                logging.exception("The periodic task has failed")
@@ -7,6 +7,10 @@ dbname="banking-api"
 query="TRUNCATE TABLE accounts;
 TRUNCATE TABLE transfers;
 TRUNCATE TABLE customers;
+TRUNCATE TABLE balances;
+TRUNCATE TABLE idempotency_keys;
+TRUNCATE TABLE balance_shards;
+TRUNCATE TABLE balance_checkpoints;
 "
 
 docker exec "$container_id" mysql -u"$user" -p"$password" -e "$query" "$dbname"
\ No newline at end of file
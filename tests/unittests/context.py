@@ -14,3 +14,5 @@ import handler
 import models
 import exceptions
 import server
+import backfill
+import migrations
@@ -0,0 +1,12 @@
+from unittest.mock import patch, AsyncMock
+
+import pytest
+
+from .context import backfill
+
+
+@pytest.mark.asyncio
+async def test_main():
+    with patch("handler.Handler.create", AsyncMock()) as mocked:
+        await backfill.main()
+        mocked.return_value.backfill_balances.assert_awaited_once()
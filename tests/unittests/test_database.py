@@ -1,10 +1,11 @@
+import asyncio
 from contextlib import asynccontextmanager
 from unittest.mock import patch, AsyncMock, Mock
 
 import pytest
 
-from .context import database as db
-from .utils import set_environments, check_error
+from .context import database as db, utils
+from .utils import set_environments, check_error, create_mock_pool
 
 
 @pytest.mark.parametrize(
@@ -30,6 +31,7 @@ from .utils import set_environments, check_error
         ),
     ]
 )
+
 def test_DBConnectionData_from_environment(
         MYSQL_DB_ADDRESS, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE,
         expected
@@ -54,6 +56,105 @@ db_env = {
 }
 
 
+@pytest.mark.parametrize(
+    "pool_envs,expected",
+    [
+        (  # pool options
+                {
+                    "MYSQL_POOL_MINSIZE": "5",
+                    "MYSQL_POOL_MAXSIZE": "50",
+                    "MYSQL_POOL_RECYCLE": "3600",
+                    "MYSQL_POOL_ACQUIRE_TIMEOUT": "0.5",
+                },
+                db.DBConnectionData(
+                    host="localhost", port=3306,
+                    user="user", password="password",
+                    dbname="dbname",
+                    pool_minsize=5, pool_maxsize=50,
+                    pool_recycle=3600, acquire_timeout=0.5,
+                ),
+        ),
+        (  # primary's connections reserved to reads
+                {"MYSQL_PRIMARY_READ_POOL_MAXSIZE": "2"},
+                db.DBConnectionData(
+                    host="localhost", port=3306,
+                    user="user", password="password",
+                    dbname="dbname",
+                    primary_read_maxsize=2,
+                ),
+        ),
+        (  # wrong pool option format
+                {"MYSQL_POOL_MAXSIZE": "many"},
+                ValueError("Error: Wrong MYSQL_POOL_MAXSIZE format: many!"),
+        ),
+        (  # read replicas
+                {"MYSQL_REPLICA_ADDRESSES": "replica1:3306,replica2:3307"},
+                db.DBConnectionData(
+                    host="localhost", port=3306,
+                    user="user", password="password",
+                    dbname="dbname",
+                    replicas=[("replica1", 3306), ("replica2", 3307)],
+                ),
+        ),
+        (  # request-scoped connections
+                {"MYSQL_REQUEST_SCOPED_CONNECTIONS": "1"},
+                db.DBConnectionData(
+                    host="localhost", port=3306,
+                    user="user", password="password",
+                    dbname="dbname",
+                    request_scoped=True,
+                ),
+        ),
+        (  # wrong replica port format
+                {"MYSQL_REPLICA_ADDRESSES": "replica1:unknown"},
+                ValueError("Error: Wrong db port format: unknown!"),
+        ),
+    ]
+)
+def test_DBConnectionData_from_environment_pool(
+        pool_envs: dict[str, str],
+        expected: db.DBConnectionData | Exception
+):
+    with set_environments({**db_env, **pool_envs}):
+        with check_error(expected):
+            conn_data = db.DBConnectionData.from_environment()
+            assert conn_data == expected, f"Unexpected result={conn_data}"
+
+
+@pytest.mark.parametrize(
+    "minsize,maxsize,read_maxsize,replicas,expected",
+    [
+        (1, 10, None, False, ((1, 5), (0, 5))),  # half of them by default
+        (1, 10, None, True, ((1, 10), None)),  # replicas serve the reads
+        (4, 10, 2, False, ((4, 8), (0, 2))),
+        (10, 10, 4, True, ((6, 6), (4, 4))),
+        (1, 10, 0, False, ((1, 10), None)),
+        (1, 1, None, False, ((1, 1), None)),  # a single connection
+        (
+            1, 10, 10, False,
+            ValueError(
+                "Error: Wrong primary's read pool size: 10! "
+                "It should be positive or 0, and less than "
+                "MYSQL_POOL_MAXSIZE=10"),
+        ),
+    ]
+)
+def test_DBConnectionData_primary_pool_sizes(
+        minsize: int,
+        maxsize: int,
+        read_maxsize: int | None,
+        replicas: bool,
+        expected: tuple | Exception
+):
+    data = db.DBConnectionData(
+        host="localhost", port=3306, user="user", password="password",
+        dbname="dbname", pool_minsize=minsize, pool_maxsize=maxsize,
+        primary_read_maxsize=read_maxsize,
+        replicas=[("replica", 3306)] if replicas else [])
+    with check_error(expected):
+        assert data.primary_pool_sizes() == expected
+
+
 @pytest.mark.asyncio
 async def test_Database_create():
     global db_env
@@ -61,49 +162,23 @@ async def test_Database_create():
         with patch("aiomysql.create_pool", AsyncMock()) as mocked:
             mydb = await db.Database.create()
             assert isinstance(mydb, db.Database)
-            kwargs = mocked.call_args.kwargs
-            assert kwargs == {
+            expected = {
                 "host": "localhost",
                 "port": 3306,
                 "user": "user",
                 "password": "password",
                 "db": "dbname",
                 "autocommit": False,
+                "minsize": 1,
+                "maxsize": 10,
+                "pool_recycle": -1,
             }
-
-
-def create_mock_pool(returned_data: list = None):
-    """
-    Mock the function aiomysql.create_pool
-    Mock the aiomysql.Pool.acquire method as well
-    """
-    pool = Mock()
-
-    # Save the last cursors for testing purpose
-    # (args & kwargs access for example)
-    pool.last_cursors = []
-
-    @asynccontextmanager
-    async def mocked_pool_acquire():
-        nonlocal pool
-        conn = Mock()
-        conn.commit = AsyncMock()
-
-        @asynccontextmanager
-        async def cursor():
-            nonlocal pool
-            curr = Mock()
-            curr.execute = AsyncMock()
-            curr.fetchall = AsyncMock(return_value=returned_data or [])
-            curr.lastrowid = len(pool.last_cursors)
-            pool.last_cursors.append(curr)
-            yield curr
-
-        conn.cursor = cursor
-        yield conn
-
-    pool.acquire = mocked_pool_acquire
-    return pool
+            # a pool for writes, and a pool in autocommit mode for reads,
+            # sharing the primary's connections
+            write_call, read_call = mocked.call_args_list
+            assert write_call.kwargs == {**expected, "maxsize": 5}
+            assert read_call.kwargs == {
+                **expected, "autocommit": True, "minsize": 0, "maxsize": 5}
 
 
 @pytest.mark.asyncio
@@ -140,6 +215,21 @@ async def test_Database_create_tables():
                     "`utc_timestamp` int, amount double, "
                     "PRIMARY KEY (id))"
                 ),
+                (
+                    "CREATE TABLE IF NOT EXISTS balances"
+                    "(id int NOT NULL AUTO_INCREMENT, "
+                    "credits double NOT NULL DEFAULT 0, "
+                    "debits double NOT NULL DEFAULT 0, "
+                    "PRIMARY KEY (id))"
+                ),
+                (
+                    "CREATE TABLE IF NOT EXISTS schema_versions"
+                    "(id int NOT NULL AUTO_INCREMENT, "
+                    "version int NOT NULL UNIQUE, "
+                    "description Varchar(255), "
+                    "`utc_timestamp` int, "
+                    "PRIMARY KEY (id))"
+                ),
             }
             queries = {
                 m.execute.call_args.args[0]
@@ -149,7 +239,7 @@ async def test_Database_create_tables():
 
 
 @pytest.mark.parametrize(
-    "table,field_values,expected_query",
+    "table,field_values,expected",
     [
         (  # missing value for the given field -> failing with ValueError
                 db.Tables.accounts,
@@ -159,12 +249,15 @@ async def test_Database_create_tables():
         (  # insert integer and double
                 db.Tables.accounts,
                 ("owner_id", 123, "deposit", 214.56),
-                "INSERT INTO accounts (owner_id, deposit) VALUES (123, 214.56)",
+                (
+                    "INSERT INTO accounts (owner_id, deposit) VALUES (%s, %s)",
+                    (123, 214.56),
+                ),
         ),
         (  # insert string
                 db.Tables.customers,
                 ("name", "John Smith",),
-                "INSERT INTO customers (name) VALUES ('John Smith')",
+                ("INSERT INTO customers (name) VALUES (%s)", ("John Smith",)),
         )
     ]
 )
@@ -172,7 +265,7 @@ async def test_Database_create_tables():
 async def test_Database_insert(
         table: db.Tables,
         field_values: tuple[str | int | float],
-        expected_query: str
+        expected: tuple[str, tuple] | Exception
 ):
     global db_env
     with set_environments(db_env):
@@ -183,11 +276,162 @@ async def test_Database_insert(
                 AsyncMock(return_value=pool_mocked)
         ):
             mydb = await db.Database.create()
-            with check_error(expected_query):
+            with check_error(expected):
                 lastid = await mydb.insert(table, *field_values)
                 assert lastid == 0
-                query = pool_mocked.last_cursors[-1].execute.call_args.args[0]
-                assert query == expected_query
+                # values are passed as args, and escaped by the client
+                call_args = pool_mocked.last_cursors[-1].execute.call_args.args
+                assert call_args == expected
+
+
+@pytest.mark.asyncio
+async def test_Database_transaction():
+    global db_env
+    with set_environments(db_env):
+        # mock the create_pool method
+        pool_mocked = create_mock_pool(returned_data=[[1]])
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            async with mydb.transaction() as tx:
+                rows = await tx.execute(
+                    "SELECT id FROM customers WHERE name=%s", ("John",))
+                assert rows == [[1]]
+                await tx.insert(db.Tables.accounts, "owner_id", rows[0][0])
+
+            # all statements are sent on the same connection
+            assert len(pool_mocked.last_connections) == 1
+            queries = [
+                c.args
+                for c in pool_mocked.last_cursors[-1].execute.call_args_list
+            ]
+            assert queries == [
+                ("SELECT id FROM customers WHERE name=%s", ("John",)),
+                ("INSERT INTO accounts (owner_id) VALUES (%s)", (1,)),
+            ]
+            conn = pool_mocked.last_connections[-1]
+            conn.commit.assert_awaited_once()
+            conn.rollback.assert_not_awaited()
+            pool_mocked.release.assert_awaited_once_with(conn)
+
+
+@pytest.mark.parametrize(
+    "field_values,expected",
+    [
+        (("name",), ValueError("Each inserted value should have a field name")),
+        (
+            ("name", "John"),
+            (
+                "INSERT INTO customers (name) VALUES (%s) "
+                "ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)",
+                ("John",),
+            ),
+        ),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Transaction_insert_or_get(
+        field_values: tuple, expected: tuple | Exception):
+    curr = Mock()
+    curr.execute = AsyncMock()
+    curr.lastrowid = 456
+    tx = db.Transaction(curr)
+    with check_error(expected):
+        assert await tx.insert_or_get(db.Tables.customers, *field_values) == 456
+        assert curr.execute.call_args.args == expected
+
+
+@pytest.mark.asyncio
+async def test_Database_transaction_rollback():
+    global db_env
+    with set_environments(db_env):
+        # mock the create_pool method
+        pool_mocked = create_mock_pool()
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            with pytest.raises(ValueError):
+                async with mydb.transaction() as tx:
+                    await tx.insert(db.Tables.customers, "name", "John")
+                    await tx.insert(db.Tables.accounts, "owner_id")
+
+            conn = pool_mocked.last_connections[-1]
+            conn.rollback.assert_awaited_once()
+            conn.commit.assert_not_awaited()
+            # the connection is given back to the pool
+            pool_mocked.release.assert_awaited_once_with(conn)
+
+
+@pytest.mark.parametrize(
+    "rows,chunk_size,expected",
+    [
+        (  # nothing to insert: no statement is executed
+            [],
+            2,
+            ([], []),
+        ),
+        (  # a row has the wrong number of values
+            [("John", 1), ("Kevin",)],
+            2,
+            ValueError("Each inserted row should have a value per field"),
+        ),
+        (  # wrong chunk size
+            [("John", 1)],
+            0,
+            ValueError("The chunk size should be positive"),
+        ),
+        (  # 3 rows inserted by chunks of 2 rows
+            [("John", 1), ("Kevin", 2), ("Paul", 3)],
+            2,
+            (
+                [0, 1, 0],
+                [
+                    (
+                        "INSERT INTO customers (name, age) "
+                        "VALUES (%s, %s), (%s, %s)",
+                        ("John", 1, "Kevin", 2),
+                    ),
+                    (
+                        "INSERT INTO customers (name, age) VALUES (%s, %s)",
+                        ("Paul", 3),
+                    ),
+                ],
+            ),
+        ),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Database_insert_many(
+        rows: list[tuple],
+        chunk_size: int,
+        expected: tuple[list[int], list[tuple]] | Exception
+):
+    global db_env
+    with set_environments(db_env):
+        # mock the create_pool method
+        pool_mocked = create_mock_pool()
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            with check_error(expected):
+                ids = await mydb.insert_many(
+                    db.Tables.customers, ("name", "age"), rows,
+                    chunk_size=chunk_size)
+                expected_ids, expected_queries = expected
+                # the mocked cursor's lastrowid is constant
+                assert ids == expected_ids
+                queries = [
+                    c.args
+                    for m in pool_mocked.last_cursors
+                    for c in m.execute.call_args_list
+                ]
+                assert queries == expected_queries
 
 
 @pytest.mark.asyncio
@@ -203,5 +447,298 @@ async def test_Database_execute():
         ):
             mydb = await db.Database.create()
             data = await mydb.execute(
-                "SELECT owner_id, deposit FROM accounts WHERE id=1")
+                "SELECT owner_id, deposit FROM accounts WHERE id=%s", (1,))
             assert data == returned_data
+            call_args = pool_mocked.last_cursors[-1].execute.call_args.args
+            assert call_args == (
+                "SELECT owner_id, deposit FROM accounts WHERE id=%s", (1,))
+
+
+@pytest.mark.asyncio
+async def test_Database_read():
+    global db_env
+    with set_environments(db_env):
+        returned_data = [[123, 234.45]]
+        pool_mocked = create_mock_pool(returned_data=returned_data)
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            data = await mydb.read(
+                "SELECT owner_id, deposit FROM accounts WHERE id=%s", (1,))
+            assert data == returned_data
+            call_args = pool_mocked.last_cursors[-1].execute.call_args.args
+            assert call_args == (
+                "SELECT owner_id, deposit FROM accounts WHERE id=%s", (1,))
+            # reads are in autocommit mode: no COMMIT round trip
+            pool_mocked.last_connections[-1].commit.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_Database_stream():
+    global db_env
+    with set_environments(db_env):
+        returned_data = [[1, 234.45], [2, 100.]]
+        pool_mocked = create_mock_pool(returned_data=returned_data)
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            rows = [
+                r async for r in mydb.stream(
+                    "SELECT id, deposit FROM accounts WHERE owner_id=%s",
+                    (1,), fetch_size=10)
+            ]
+            assert rows == returned_data
+            curr = pool_mocked.last_cursors[-1]
+            assert curr.execute.call_args.args == (
+                "SELECT id, deposit FROM accounts WHERE owner_id=%s", (1,))
+            assert curr.fetchmany.call_args.args == (10,)
+
+
+@pytest.mark.parametrize(
+    "scope_envs,connections",
+    [
+        ({}, 3),  # disabled: a connection per query
+        ({"MYSQL_REQUEST_SCOPED_CONNECTIONS": "1"}, 1),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Database_request_scope(scope_envs: dict, connections: int):
+    global db_env
+    with set_environments({**db_env, **scope_envs}):
+        pool_mocked = create_mock_pool()
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            async with mydb.request_scope():
+                await mydb.read("SELECT 1")
+                await mydb.read("SELECT 2")
+                await mydb.execute("SELECT 3")
+            assert len(pool_mocked.last_connections) == connections
+            # all connections are released at the end of the scope
+            assert pool_mocked.release.await_count == connections
+            # the scope is over: the next query acquires a new connection
+            await mydb.read("SELECT 4")
+            assert len(pool_mocked.last_connections) == connections + 1
+
+
+@pytest.mark.asyncio
+async def test_Database_request_scope_not_bound():
+    global db_env
+    with set_environments({
+        **db_env, "MYSQL_REQUEST_SCOPED_CONNECTIONS": "1"
+    }):
+        pool_mocked = create_mock_pool()
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            async with mydb.request_scope():
+                # nested scopes share the same connections
+                async with mydb.request_scope():
+                    # the bound connection is in use: a second one is acquired
+                    async with mydb.transaction():
+                        await mydb.read("SELECT 1")
+                    assert len(pool_mocked.last_connections) == 2
+                    pool_mocked.release.assert_awaited_once()
+
+                    # streams never use the request's connection
+                    [_ async for _ in mydb.stream("SELECT 2")]
+                    assert len(pool_mocked.last_connections) == 3
+                    assert pool_mocked.release.await_count == 2
+
+                    # a failed query's connection is released, not reused
+                    with pytest.raises(ValueError):
+                        async with mydb.transaction():
+                            raise ValueError("error")
+                    assert pool_mocked.release.await_count == 3
+                    await mydb.read("SELECT 3")
+                    assert len(pool_mocked.last_connections) == 4
+            pool_mocked.release.assert_awaited_with(
+                pool_mocked.last_connections[3])
+            assert pool_mocked.release.await_count == 4
+
+
+@pytest.mark.asyncio
+async def test_Database_detached_scope():
+    global db_env
+    with set_environments({
+        **db_env, "MYSQL_REQUEST_SCOPED_CONNECTIONS": "1"
+    }):
+        pool_mocked = create_mock_pool()
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            flight = utils.SingleFlight()
+            started, event = asyncio.Event(), asyncio.Event()
+
+            async def read():
+                async with mydb.detached_scope():
+                    started.set()
+                    await event.wait()
+                    await mydb.read("SELECT 1")
+                    await mydb.read("SELECT 2")
+                    return mydb.is_primary_pinned()
+
+            async def request():
+                # a read shared by concurrent requests (e.g. coalesced)
+                async with mydb.request_scope():
+                    mydb.pin_primary()
+                    return await flight.do("read", read)
+
+            first = asyncio.ensure_future(request())
+            await started.wait()
+            second = asyncio.ensure_future(request())
+            await asyncio.sleep(0)
+            # the first request is over before the shared read
+            first.cancel()
+            await asyncio.sleep(0)
+            event.set()
+            # the read is still pinned to the primary
+            assert await second is True
+            # its queries share a connection, which isn't bound to the
+            # cancelled request's scope, but released once the read is over
+            assert len(pool_mocked.last_connections) == 1
+            pool_mocked.release.assert_awaited_once()
+
+            # out of any request scope, each query has its own connection
+            async with mydb.detached_scope():
+                await mydb.read("SELECT 3")
+                await mydb.read("SELECT 4")
+            assert len(pool_mocked.last_connections) == 3
+
+
+@pytest.mark.parametrize(
+    "returned_data,expected",
+    [
+        ([[1]], None),  # lock acquired
+        ([[0]], TimeoutError("Couldn't acquire MySQL lock=mylock")),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Database_lock(returned_data: list, expected: Exception | None):
+    global db_env
+    with set_environments(db_env):
+        pool_mocked = create_mock_pool(returned_data=returned_data)
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            with check_error(expected):
+                async with mydb.lock("mylock", timeout=10):
+                    pass
+                queries = [
+                    c.args
+                    for c in pool_mocked.last_cursors[-1].execute.call_args_list
+                ]
+                assert queries == [
+                    ("SELECT GET_LOCK(%s, %s)", ("mylock", 10)),
+                    ("SELECT RELEASE_LOCK(%s)", ("mylock",)),
+                ]
+
+
+@pytest.mark.asyncio
+async def test_Database_stats():
+    global db_env
+    with set_environments(db_env):
+        pool_mocked = create_mock_pool()
+        pool_mocked.size, pool_mocked.freesize = 4, 1
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            await mydb.execute("SELECT 1")
+            await mydb.execute("SELECT 1")
+            stats = mydb.stats()
+            assert stats["replicas"] == []
+            primary = stats["primary"]
+            assert primary["acquired"] == 2
+            assert primary["waiting"] == 0
+            assert primary["timeouts"] == 0
+            assert primary["wait_seconds_max"] <= primary["wait_seconds_total"]
+            assert {
+                k: v for k, v in primary.items()
+                if k in {"minsize", "maxsize", "size", "free", "used"}
+            } == {"minsize": 1, "maxsize": 10, "size": 4, "free": 1, "used": 3}
+            # the connections are released
+            assert pool_mocked.release.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_Database_acquire_timeout():
+    global db_env
+    with set_environments({**db_env, "MYSQL_POOL_ACQUIRE_TIMEOUT": "0.01"}):
+        pool_mocked = create_mock_pool()
+
+        async def never_free():
+            await asyncio.sleep(1)
+
+        pool_mocked.acquire = never_free
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(return_value=pool_mocked)
+        ):
+            mydb = await db.Database.create()
+            with pytest.raises(asyncio.TimeoutError):
+                await mydb.execute("SELECT 1")
+            stats = mydb.stats()["primary"]
+            assert stats["timeouts"] == 1
+            assert stats["waiting"] == 0
+
+
+@pytest.mark.asyncio
+async def test_Database_read_replicas():
+    global db_env
+    envs = {**db_env, "MYSQL_REPLICA_ADDRESSES": "replica1:3306, replica2:3307"}
+    with set_environments(envs):
+        primary, replica1, replica2 = [create_mock_pool() for _ in range(3)]
+        with patch(
+                "aiomysql.create_pool",
+                AsyncMock(side_effect=[primary, replica1, replica2])
+        ) as mocked:
+            mydb = await db.Database.create()
+            hosts = [
+                (c.kwargs["host"], c.kwargs["port"], c.kwargs["autocommit"])
+                for c in mocked.call_args_list
+            ]
+            # the primary's reads share its writes' pool
+            assert hosts == [
+                ("localhost", 3306, False),
+                ("replica1", 3306, True),
+                ("replica2", 3307, True),
+            ]
+
+            # reads are sent to the replicas in turn, writes to the primary
+            await mydb.read("SELECT 1")
+            await mydb.read("SELECT 1")
+            rows = [r async for r in mydb.stream("SELECT 1")]
+            assert rows == []
+            assert len(replica1.last_cursors) == 1
+            assert len(replica2.last_cursors) == 2
+            assert len(primary.last_cursors) == 0
+            assert len(mydb.stats()["replicas"]) == 2
+
+            async def read_after_write():
+                await mydb.insert(db.Tables.customers, "name", "John")
+                await mydb.read("SELECT 1")
+                return [r async for r in mydb.stream("SELECT 1")]
+
+            # after a write, the reads of the same context use the primary,
+            # and end their transaction
+            assert await asyncio.create_task(read_after_write()) == []
+            assert len(primary.last_cursors) == 3
+            for conn in primary.last_connections[-2:]:
+                conn.commit.assert_awaited_once()
+            # other contexts still read from the replicas
+            await mydb.read("SELECT 1")
+            assert len(replica1.last_cursors) == 2
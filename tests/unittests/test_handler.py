@@ -1,10 +1,23 @@
-from unittest.mock import patch, AsyncMock
+import asyncio
+import hashlib
+import json
+from contextlib import asynccontextmanager
+from unittest.mock import patch, AsyncMock, Mock
 
 import pytest
 from freezegun import freeze_time
 
 from .context import handler as hd, models, exceptions as exc
-from .utils import check_error
+from .utils import (
+    async_iter, check_error, create_mock_pool, mock_transaction,
+    set_environments)
+
+
+@pytest.fixture(autouse=True)
+def mock_migrations():
+    """The schema migrations are tested in test_migrations.py"""
+    with patch("migrations.migrate", AsyncMock()) as mocked:
+        yield mocked
 
 
 @patch("database.Database.create", AsyncMock())
@@ -14,6 +27,137 @@ async def test_Handler_create():
     assert isinstance(handler, hd.Handler)
 
 
+@pytest.mark.asyncio
+async def test_Handler_stats():
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        handler._db.stats = Mock(return_value={"size": 1})
+        stats = handler.stats()
+        assert stats["pool"] == {"size": 1}
+        assert set(stats["caches"]) == {
+            "customers", "accounts", "missing_accounts", "balances",
+            "idempotency"}
+        assert stats["caches"]["balances"]["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_Handler_request_scope():
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        handler._db.request_scope = Mock(return_value="scope")
+        assert handler.request_scope() == "scope"
+
+
+@pytest.mark.asyncio
+async def test_Handler_request_scope_connections():
+    # the primary's pools. A transfer to account 1 is read, also read
+    # as the account's row
+    pool = create_mock_pool()
+    read_pool = create_mock_pool([[1, "credit", 2, 1, 1710137580, 5.]])
+    with set_environments({
+        "MYSQL_DB_ADDRESS": "localhost:3306",
+        "MYSQL_USER": "user",
+        "MYSQL_PASSWORD": "password",
+        "MYSQL_DATABASE": "dbname",
+        "MYSQL_REQUEST_SCOPED_CONNECTIONS": "1",
+    }), patch("aiomysql.create_pool", AsyncMock(
+            side_effect=[pool, read_pool])):
+        handler = hd.Handler(await hd.Database.create())
+    # the idempotency key is looked up, then stored along the transfer,
+    # on the request's connection
+    async with handler.request_scope():
+        await handler.transfer(2, 1, 5., idempotency_key="key")
+    assert len(pool.last_connections) == 1
+    # the account is checked, then its history read, on the connection
+    # of the shared read
+    async with handler.request_scope():
+        handler.pin_primary()
+        assert len(await handler.get_transfer_history(1)) == 1
+    assert len(read_pool.last_connections) == 1
+    read_pool.release.assert_awaited_once()
+
+
+def test_Handler_pin_primary():
+    with patch("database.Database.pin_primary") as mocked:
+        hd.Handler.pin_primary()
+        mocked.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "envs,expected",
+    [
+        ({}, hd.HandlerConfig(precomputed_balances=False)),
+        (
+            {"PRECOMPUTED_BALANCES": "1"},
+            hd.HandlerConfig(precomputed_balances=True),
+        ),
+        (
+            {"CUSTOMER_CACHE_SIZE": "100"},
+            hd.HandlerConfig(customer_cache_size=100),
+        ),
+        (
+            {
+                "ACCOUNT_CACHE_SIZE": "100",
+                "MISSING_ACCOUNT_TTL": "10",
+                "PRELOAD_ACCOUNTS": "1",
+            },
+            hd.HandlerConfig(
+                account_cache_size=100,
+                missing_account_ttl=10,
+                preload_accounts=True),
+        ),
+        (
+            {"BALANCE_CACHE_SIZE": "100", "BALANCE_CACHE_TTL": "1"},
+            hd.HandlerConfig(balance_cache_size=100, balance_cache_ttl=1),
+        ),
+        (
+            {"IDEMPOTENCY_CACHE_SIZE": "100", "IDEMPOTENCY_KEY_TTL": "0"},
+            hd.HandlerConfig(
+                idempotency_cache_size=100, idempotency_key_ttl=0),
+        ),
+        (
+            {"ACCOUNT_BATCH_DELAY_US": "200"},
+            hd.HandlerConfig(batch_delay_us=200),
+        ),
+        (
+            {
+                "WRITE_BEHIND_TRANSFERS": "1",
+                "TRANSFER_FLUSH_SIZE": "50",
+                "TRANSFER_FLUSH_MAX_WAIT_MS": "2",
+                "TRANSFER_QUEUE_SIZE": "500",
+            },
+            hd.HandlerConfig(
+                write_behind=True,
+                flush_size=50,
+                flush_max_wait_ms=2,
+                queue_size=500),
+        ),
+        (
+            {"CHECK_OVERDRAFT": "1", "ACCOUNT_LOCK_STRIPES": "64"},
+            hd.HandlerConfig(overdraft_check=True, account_lock_stripes=64),
+        ),
+        (
+            {"HOT_ACCOUNT_SHARDS": "12:16,42:8", "SHARD_FOLD_INTERVAL": "10"},
+            hd.HandlerConfig(
+                hot_account_shards={12: 16, 42: 8}, shard_fold_interval=10),
+        ),
+        (
+            {
+                "BALANCE_CHECKPOINT_INTERVAL": "3600",
+                "BALANCE_CHECKPOINT_LAG": "30",
+            },
+            hd.HandlerConfig(checkpoint_interval=3600, checkpoint_lag=30),
+        ),
+    ]
+)
+def test_HandlerConfig_from_environment(
+        envs: dict[str, str],
+        expected: hd.HandlerConfig
+):
+    with set_environments(envs):
+        assert hd.HandlerConfig.from_environment() == expected
+
+
 @pytest.mark.parametrize(
     "customer,deposit,expected",
     [
@@ -29,10 +173,10 @@ async def test_Handler_create():
             234.56,
             models.Account(id=123, owner_id=456, deposit=234.56),
         ),
-        (  # customer Kevin should already exist
+        (  # customer Kevin already exists: the upsert returns its id
             "Kevin",
             234.56,
-            models.Account(id=789, owner_id=456, deposit=234.56),
+            models.Account(id=123, owner_id=456, deposit=234.56),
         )
     ]
 )
@@ -40,16 +184,112 @@ async def test_Handler_create():
 async def test_Handler_create_account(customer, deposit, expected):
     with patch("database.Database.create", AsyncMock()):
         handler = await hd.Handler.create()
-        match customer:
-            case "John":  # new customer is created
-                handler._db.execute = AsyncMock(return_value=[])
-                handler._db.insert = AsyncMock(side_effect=[456, 123])
-            case _:  # customer already exists
-                handler._db.execute = AsyncMock(return_value=[[456]])
-                handler._db.insert = AsyncMock(side_effect=[789])
+        # the customer & account are created in the same transaction
+        tx = mock_transaction(handler._db)
+        tx.insert_or_get.return_value = 456
+        tx.insert.return_value = 123
         with check_error(expected):
             account = await handler.create_account(customer, deposit)
             assert account == expected
+            # the customer's name is passed as an argument, never
+            # interpolated into the query
+            assert tx.insert_or_get.call_args.args == (
+                hd.Tables.customers, "name", customer)
+
+
+@pytest.mark.asyncio
+async def test_Handler_create_preload_accounts():
+    mydb = Mock()
+    mydb.create_tables = AsyncMock()
+    mydb.stream = Mock(return_value=async_iter([[3], [2]]))
+    with set_environments({
+        "PRELOAD_ACCOUNTS": "1", "ACCOUNT_CACHE_SIZE": "2"
+    }), patch("database.Database.create", AsyncMock(return_value=mydb)):
+        handler = await hd.Handler.create()
+    assert mydb.stream.call_args.args == (
+        "SELECT id FROM accounts ORDER BY id DESC LIMIT %s", (2,))
+    # preloaded accounts are found without any query
+    handler._db.read = AsyncMock()
+    assert await handler.get_transfer_history(2) == []
+    handler._db.read.assert_awaited_once()
+
+
+@freeze_time("2024-03-11T06:13:00Z")
+@pytest.mark.asyncio
+async def test_Handler_account_exists_cached():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(missing_account_ttl=5))
+    handler._db.read = AsyncMock(return_value=[])
+    handler._db.stream = Mock(side_effect=lambda *_: async_iter([]))
+    with pytest.raises(exc.NotFoundException):
+        await handler.stream_transfer_history(123)
+    # the account is known not to exist: not queried again
+    with pytest.raises(exc.NotFoundException):
+        await handler.get_transfer_history(123)
+    assert handler._db.read.await_count == 1
+
+    # until the missing account expires
+    with freeze_time("2024-03-11T06:13:06Z"):
+        with pytest.raises(exc.NotFoundException):
+            await handler.get_transfer_history(123)
+    assert handler._db.read.await_count == 2
+
+    # a created account is known to exist, and no longer missing
+    tx = mock_transaction(handler._db)
+    tx.insert_or_get.return_value = 456
+    tx.insert.return_value = 123
+    await handler.create_account("John", 10.)
+    assert handler._missing_accounts.get(123) is None
+    await handler.stream_transfer_history(123)
+    assert await handler.get_transfer_history(123) == []
+    # only the history is read
+    assert handler._db.read.await_count == 3
+    handler._db.read.assert_awaited_with(
+        handler._db.read.call_args.args[0], (123, 123))
+
+
+@pytest.mark.asyncio
+async def test_Handler_account_exists_pinned():
+    handler = hd.Handler(Mock())
+    # the account was just created: a lagging replica misses it
+    handler._db.read = AsyncMock(side_effect=[[], [[123, 456, 10.]], []])
+    with pytest.raises(exc.NotFoundException):
+        await handler.get_transfer_history(123)
+
+    # a read pinned to the primary looks it up again
+    async def pinned_read():
+        handler.pin_primary()
+        return await handler.get_transfer_history(123)
+
+    assert await pinned_read() == []
+    assert handler._db.read.await_count == 3
+
+
+@pytest.mark.parametrize("cache_size,upserts", [(10, 1), (0, 2)])
+@pytest.mark.asyncio
+async def test_Handler_create_account_cached_customer(
+        cache_size: int, upserts: int):
+    handler = hd.Handler(Mock(), hd.HandlerConfig(
+        customer_cache_size=cache_size))
+    tx = mock_transaction(handler._db)
+    tx.insert_or_get.return_value = 456
+    tx.insert.side_effect = [123, 789]
+    await handler.create_account("John", 10.)
+    account = await handler.create_account("John", 20.)
+    assert account == models.Account(id=789, owner_id=456, deposit=20.)
+    # a cached customer isn't looked for in the DB
+    assert tx.insert_or_get.await_count == upserts
+
+
+@pytest.mark.asyncio
+async def test_Handler_create_account_rolled_back():
+    handler = hd.Handler(Mock())
+    tx = mock_transaction(handler._db)
+    tx.insert_or_get.return_value = 456
+    tx.insert.side_effect = ValueError("error")
+    with pytest.raises(ValueError):
+        await handler.create_account("John", 10.)
+    # the customer might not exist: it is not cached
+    assert handler._customers.get("John") is None
 
 
 @pytest.mark.parametrize(
@@ -81,13 +321,13 @@ async def test_Handler_get_accounts(
         handler = await hd.Handler.create()
         match account_id:
             case 0:
-                handler._db.execute = AsyncMock(return_value=[])
+                handler._db.read = AsyncMock(return_value=[])
             case 123:
-                handler._db.execute = AsyncMock(return_value=[
+                handler._db.read = AsyncMock(return_value=[
                     [123, 456, 234.56],
                 ])
             case None:
-                handler._db.execute = AsyncMock(return_value=[
+                handler._db.read = AsyncMock(return_value=[
                     [123, 456, 234.56],
                     [111, 789, 100.],
                 ])
@@ -96,6 +336,21 @@ async def test_Handler_get_accounts(
             assert accounts == expected
 
 
+@pytest.mark.asyncio
+async def test_Handler_stream_accounts():
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        handler._db.stream = Mock(return_value=async_iter([
+            [123, 456, 234.56],
+            [111, 789, 100.],
+        ]))
+        accounts = [a async for a in handler.stream_accounts()]
+        assert accounts == [
+            models.Account(id=123, owner_id=456, deposit=234.56),
+            models.Account(id=111, owner_id=789, deposit=100.),
+        ]
+
+
 @freeze_time("2024-03-11T06:13:00Z")
 @pytest.mark.parametrize(
     "amount,expected",
@@ -122,10 +377,363 @@ async def test_Handler_get_accounts(
 async def test_Handler_transfer(amount, expected):
     with patch("database.Database.create", AsyncMock()):
         handler = await hd.Handler.create()
-        handler._db.insert = AsyncMock(return_value=123)
+        tx = mock_transaction(handler._db)
+        tx.insert.return_value = 123
         with check_error(expected):
             transfer = await handler.transfer(111, 222, amount)
             assert transfer == expected
+            # the running balances are updated in the transfer's transaction
+            assert tx.execute.call_args.args == (
+                "INSERT INTO balances (id, credits, debits) "
+                "VALUES (%s, %s, %s), (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE credits=credits+VALUES(credits), "
+                "debits=debits+VALUES(debits)",
+                (111, 0, 234.56, 222, 234.56, 0),
+            )
+
+
+# freezegun would freeze the event loop's clock, and the flush's timer
+@patch("utils.get_utc_timestamp", Mock(return_value=1710137580))
+@pytest.mark.asyncio
+async def test_Handler_transfer_write_behind():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(write_behind=True))
+    tx = mock_transaction(handler._db)
+    tx.insert_many.return_value = [7, 8]
+    transfers = await asyncio.gather(
+        handler.transfer(1, 2, 10.), handler.transfer(2, 3, 5.))
+    assert transfers == [
+        models.Transfer(
+            id=7, utc_timestamp=1710137580, from_id=1, to_id=2, amount=10.),
+        models.Transfer(
+            id=8, utc_timestamp=1710137580, from_id=2, to_id=3, amount=5.),
+    ]
+    # both transfers are written by a single transaction
+    assert tx.insert_many.call_args.args[2] == [
+        (1, 2, 10., 1710137580),
+        (2, 3, 5., 1710137580),
+    ]
+    tx.execute.assert_awaited_once()
+    await handler.close()
+
+
+def request_hash(**params: str | int | float) -> str:
+    """The hash stored along an idempotent request with `params`"""
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+@patch("utils.get_utc_timestamp", Mock(return_value=1710137580))
+@pytest.mark.asyncio
+async def test_Handler_transfer_idempotent():
+    # idempotent transfers are never written behind
+    handler = hd.Handler(Mock(), hd.HandlerConfig(write_behind=True))
+    handler._db.execute = AsyncMock(return_value=[])
+    tx = mock_transaction(handler._db)
+    tx.insert.return_value = 123
+    expected = models.Transfer(
+        id=123, utc_timestamp=1710137580, from_id=1, to_id=2, amount=5.)
+    # concurrent & next calls with the same key share the first response
+    transfers = await asyncio.gather(*[
+        handler.transfer(1, 2, 5., idempotency_key="key") for _ in range(2)])
+    assert transfers == [expected, expected]
+    assert await handler.transfer(1, 2, 5., idempotency_key="key") == expected
+    handler._db.execute.assert_awaited_once_with(
+        "SELECT request_hash, response FROM idempotency_keys "
+        "WHERE endpoint=%s AND idempotency_key=%s",
+        ("transfer", "key"))
+    # the response is stored in the transfer's transaction
+    transfer_insert, key_insert = tx.insert.call_args_list
+    assert transfer_insert.args[0] == hd.Tables.transfers
+    assert key_insert.args == (
+        hd.Tables.idempotency_keys,
+        "endpoint", "transfer",
+        "idempotency_key", "key",
+        "request_hash", request_hash(source_id=1, target_id=2, amount=5.),
+        "response", expected.model_dump_json(),
+        "`utc_timestamp`", 1710137580,
+    )
+
+
+@pytest.mark.asyncio
+async def test_Handler_transfer_idempotency_key_reused():
+    handler = hd.Handler(Mock())
+    transfer = models.Transfer(
+        id=123, utc_timestamp=1710137580, from_id=1, to_id=2, amount=5.)
+    handler._db.execute = AsyncMock(
+        return_value=[[
+            request_hash(source_id=1, target_id=2, amount=5.),
+            transfer.model_dump_json()]])
+    mock_transaction(handler._db)
+    assert await handler.transfer(1, 2, 5., idempotency_key="key") == transfer
+    # the same key, for another transfer
+    with check_error(exc.IdempotencyKeyReusedException(
+            "Idempotency key=key was already used with other parameters")):
+        await handler.transfer(1, 2, 6., idempotency_key="key")
+
+
+@freeze_time("2024-03-11T06:13:00Z")
+@pytest.mark.asyncio
+async def test_Handler_prune_idempotency_keys():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(idempotency_key_ttl=3600))
+    handler._db.execute = AsyncMock()
+    await handler.prune_idempotency_keys()
+    handler._db.execute.assert_awaited_once_with(
+        "DELETE FROM idempotency_keys WHERE `utc_timestamp` < %s",
+        (1710137580 - 3600,))
+    # the keys are kept forever
+    assert hd.Handler(
+        Mock(), hd.HandlerConfig(idempotency_key_ttl=0))._keys_pruner is None
+
+
+@pytest.mark.asyncio
+async def test_Handler_create_account_idempotent_stored():
+    handler = hd.Handler(Mock())
+    account = models.Account(id=123, owner_id=456, deposit=10.)
+    # the key was used by another worker
+    handler._db.execute = AsyncMock(return_value=[[
+        request_hash(customer="John", deposit=10.),
+        account.model_dump_json()]])
+    tx = mock_transaction(handler._db)
+    assert await handler.create_account(
+        "John", 10., idempotency_key="key") == account
+    tx.insert.assert_not_awaited()
+    assert handler._db.execute.call_args.args[1] == ("account", "key")
+
+
+@pytest.mark.asyncio
+async def test_Handler_create_account_idempotent_conflict():
+    handler = hd.Handler(Mock())
+    account = models.Account(id=123, owner_id=456, deposit=10.)
+    # another worker stores its response during the write
+    stored = [
+        request_hash(customer="John", deposit=10.), account.model_dump_json()]
+    handler._db.execute = AsyncMock(side_effect=[[], [stored], [], []])
+    tx = mock_transaction(handler._db)
+    tx.insert_or_get.return_value = 456
+    tx.insert.side_effect = [789, hd.IntegrityError(1062, "Duplicate")]
+    assert await handler.create_account(
+        "John", 10., idempotency_key="key") == account
+
+    # the write fails for another reason
+    tx.insert.side_effect = [789, hd.IntegrityError(1062, "Duplicate")]
+    with pytest.raises(hd.IntegrityError):
+        await handler.create_account("John", 10., idempotency_key="other")
+
+
+@pytest.mark.parametrize(
+    "transfers,balances,expected",
+    [
+        (  # the source account can afford the transfer
+            [(1, 2, 10.)],
+            [[1, 10., 5., 5.]],
+            None,
+        ),
+        (  # the source account can't afford the transfer
+            [(1, 2, 10.)],
+            [[1, 10., 0., 5.]],
+            exc.InsufficientFundsException(
+                "Account with id=1 has insufficient funds "
+                "for a transfer of amount=10.0"),
+        ),
+        (  # the source account is external: it's not checked
+            [(1, 2, 10.)],
+            [],
+            None,
+        ),
+        (  # account 2 is credited by the first transfer of the batch
+            [(1, 2, 10.), (2, 3, 15.)],
+            [[1, 10., 0., 0.], [2, 5., 0., 0.]],
+            None,
+        ),
+        (  # but not enough
+            [(1, 2, 10.), (2, 3, 16.)],
+            [[1, 10., 0., 0.], [2, 5., 0., 0.]],
+            exc.InsufficientFundsException(
+                "Account with id=2 has insufficient funds "
+                "for a transfer of amount=16.0"),
+        ),
+    ]
+)
+@pytest.mark.parametrize("precomputed_balances", [False, True])
+@pytest.mark.asyncio
+async def test_Handler_transfer_overdraft_check(
+        transfers: list[tuple[int, int, float]],
+        balances: list[list],
+        expected: Exception | None,
+        precomputed_balances: bool
+):
+    # queued transfers are never checked: they are written directly
+    handler = hd.Handler(Mock(), hd.HandlerConfig(
+        overdraft_check=True, write_behind=True,
+        precomputed_balances=precomputed_balances))
+    assert handler._transfers_writer is None
+    tx = mock_transaction(handler._db)
+    tx.execute.side_effect = [[], balances, []]
+    tx.insert.return_value = 1
+    tx.insert_many.return_value = list(range(len(transfers)))
+    with check_error(expected):
+        if len(transfers) == 1:
+            await handler.transfer(*transfers[0])
+        else:
+            await handler.transfer_batch([
+                models.TransferRequest(
+                    source_id=source_id, target_id=target_id, amount=amount)
+                for source_id, target_id, amount in transfers
+            ])
+    # the source accounts' rows are locked, in id order
+    source_ids = tuple(sorted({t[0] for t in transfers}))
+    lock, read = tx.execute.call_args_list[:2]
+    assert lock.args == (
+        f"SELECT id FROM accounts WHERE id IN "
+        f"({', '.join(['%s'] * len(source_ids))}) ORDER BY id FOR UPDATE",
+        source_ids)
+    assert read.args[1] == source_ids
+    assert ("balances b" in read.args[0]) == precomputed_balances
+    if expected is not None:
+        tx.insert.assert_not_awaited()
+        tx.insert_many.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_Handler_transfer_overdraft_check_locks():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(overdraft_check=True))
+    order = []
+
+    @asynccontextmanager
+    async def transaction():
+        tx = Mock()
+        tx.insert = AsyncMock()
+        tx.execute = AsyncMock(side_effect=[[], [], None])
+        order.append("begin")
+        await asyncio.sleep(0)
+        yield tx
+        order.append("commit")
+
+    handler._db.transaction = transaction
+    # transfers from account 1 wait for each other, even in-process,
+    # not transfers from other accounts
+    await asyncio.gather(
+        handler.transfer(1, 2, 5.), handler.transfer(1, 3, 5.),
+        handler.transfer(2, 1, 5.))
+    assert order == ["begin", "begin", "commit", "commit", "begin", "commit"]
+
+
+@patch("random.randrange", Mock(return_value=3))
+@pytest.mark.asyncio
+async def test_Handler_transfer_hot_account():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(
+        hot_account_shards={2: 8, 3: 1}))
+    tx = mock_transaction(handler._db)
+    await handler.transfer(1, 2, 10.)
+    # the hot account's credits go to one of its 8 sub-counters
+    balances, shards = tx.execute.call_args_list
+    assert balances.args == (hd.balances_update_query(1), (1, 0, 10.))
+    assert shards.args == (
+        "INSERT INTO balance_shards (id, shard, credits, debits) "
+        "VALUES (%s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE credits=credits+VALUES(credits), "
+        "debits=debits+VALUES(debits)",
+        (2, 3, 10., 0),
+    )
+    # a single sub-counter is the balances' row
+    tx.execute.reset_mock()
+    await handler.transfer(3, 2, 10.)
+    balances, shards = tx.execute.call_args_list
+    assert balances.args == (hd.balances_update_query(1), (3, 0, 10.))
+
+
+@pytest.mark.asyncio
+async def test_Handler_background_jobs():
+    with patch("database.Database.create", AsyncMock()), \
+            set_environments({
+                "HOT_ACCOUNT_SHARDS": "2:8",
+                "BALANCE_CHECKPOINT_INTERVAL": "3600"}):
+        handler = await hd.Handler.create()
+    assert handler._shards_folder is not None
+    assert handler._checkpointer is not None
+    assert handler._keys_pruner is not None
+    # the folds, checkpoints & prunes are stopped on shutdown
+    await handler.close()
+
+
+@pytest.mark.asyncio
+async def test_Handler_close():
+    # nothing to do without write-behind
+    await hd.Handler(Mock()).close()
+
+
+@pytest.mark.asyncio
+async def test_Handler_transfer_to_itself():
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        tx = mock_transaction(handler._db)
+        tx.insert.return_value = 123
+        await handler.transfer(111, 111, 10.)
+        assert tx.execute.call_args.args == (
+            "INSERT INTO balances (id, credits, debits) "
+            "VALUES (%s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE credits=credits+VALUES(credits), "
+            "debits=debits+VALUES(debits)",
+            (111, 10., 10.),
+        )
+
+
+@freeze_time("2024-03-11T06:13:00Z")
+@pytest.mark.parametrize(
+    "transfers,expected",
+    [
+        (  # nothing to transfer
+            [],
+            ValueError("[Transfer Batch] there is no transfer to make"),
+        ),
+        (  # one of the amounts is negative
+            [
+                models.TransferRequest(source_id=1, target_id=2, amount=10),
+                models.TransferRequest(source_id=2, target_id=3, amount=-1),
+            ],
+            ValueError(
+                "[Transfer Batch] transfer #1 amount is negative or 0, "
+                "when it should be positive"),
+        ),
+        (  # all transfers are created
+            [
+                models.TransferRequest(source_id=1, target_id=2, amount=10),
+                models.TransferRequest(source_id=2, target_id=3, amount=5),
+            ],
+            [
+                models.Transfer(
+                    id=7, utc_timestamp=1710137580,
+                    from_id=1, to_id=2, amount=10),
+                models.Transfer(
+                    id=8, utc_timestamp=1710137580,
+                    from_id=2, to_id=3, amount=5),
+            ],
+        ),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Handler_transfer_batch(
+        transfers: list[models.TransferRequest],
+        expected: list[models.Transfer] | Exception
+):
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        tx = mock_transaction(handler._db)
+        tx.insert_many.return_value = [7, 8]
+        with check_error(expected):
+            created = await handler.transfer_batch(transfers)
+            assert created == expected
+            call = tx.insert_many.call_args
+            assert call.args[2] == [
+                (1, 2, 10, 1710137580),
+                (2, 3, 5, 1710137580),
+            ]
+            # the running balances of the 3 accounts are updated at once
+            assert tx.execute.call_args.args[1] == (
+                1, 0, 10,
+                2, 10, 5,
+                3, 5, 0,
+            )
 
 
 @pytest.mark.parametrize(
@@ -147,27 +755,341 @@ async def test_Handler_transfer(amount, expected):
         )
     ]
 )
+@pytest.mark.parametrize("precomputed_balances", [False, True])
 @pytest.mark.asyncio
 async def test_Handler_get_balances(
         account_id: int,
-        expected: models.Balances
+        expected: models.Balances,
+        precomputed_balances: bool
 ):
     with patch("database.Database.create", AsyncMock()):
         handler = await hd.Handler.create()
+        handler._config.precomputed_balances = precomputed_balances
         match account_id:
             case 0:  # This account doesn't exist in the DB
-                handler._db.execute = AsyncMock(return_value=[])
+                handler._db.read = AsyncMock(return_value=[])
             case _:  # all other accounts exist
-                handler._db.execute = AsyncMock(side_effect=[
-                    [[10]],  # initial account's deposit
-                    [[3], [7], [5]],  # credits rows (amount only)
-                    [[6], [7]],  # debits rows (amount only)
+                handler._db.read = AsyncMock(return_value=[
+                    # id, deposit, credits & debits sums
+                    [account_id, 10, 15, 13],
                 ])
         with check_error(expected):
             balances = await handler.get_balances(account_id)
             assert balances == expected
 
 
+@pytest.mark.asyncio
+async def test_Handler_get_balances_missing_account():
+    handler = hd.Handler(Mock())
+    handler._db.read = AsyncMock(return_value=[])
+    for _ in range(2):
+        with pytest.raises(exc.NotFoundException):
+            await handler.get_balances(0)
+    # the account is known not to exist: the DB is queried once
+    handler._db.read.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_Handler_get_balances_pinned():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(balance_cache_size=10))
+    # a lagging replica misses account 2, & the latest transfer of 1
+    handler._db.read = AsyncMock(side_effect=[[], [[1, 10., 0., 0.]]])
+    with pytest.raises(exc.NotFoundException):
+        await handler.get_balances(2)
+    assert (await handler.get_balances(1)).balance == 10.
+
+    # the reads pinned to the primary skip the caches
+    async def pinned_read(account_id: int) -> models.Balances:
+        handler.pin_primary()
+        return await handler.get_balances(account_id)
+
+    handler._db.read = AsyncMock(side_effect=[
+        [[2, 20., 0., 0.]], [[1, 10., 5., 0.]]])
+    assert (await pinned_read(2)).balance == 20.
+    assert (await pinned_read(1)).balance == 15.
+    assert handler._db.read.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_Handler_get_balances_as_of():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(balance_cache_size=10))
+    handler._db.read = AsyncMock(side_effect=[[[10., 15., 5.]], []])
+    assert await handler.get_balances(1, as_of=1710137580) == models.Balances(
+        account_id=1, deposit=10., credits=15., debits=5., balance=20.)
+    # from the latest checkpoint, plus the transfers since
+    query, args = handler._db.read.call_args.args
+    assert "LEFT JOIN balance_checkpoints c ON c.account_id=a.id" in query
+    assert args == (1710137580, 1710137580, 1710137580, 1)
+    # past balances are not cached
+    assert handler.stats()["caches"]["balances"]["size"] == 0
+
+    with pytest.raises(exc.NotFoundException):
+        await handler.get_balances(2, as_of=1710137580)
+
+
+@patch("handler.CHECKPOINT_CHUNK_SIZE", 2)
+@patch("utils.get_utc_timestamp", Mock(return_value=1710137580))
+@pytest.mark.asyncio
+async def test_Handler_checkpoint_balances():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(checkpoint_lag=60))
+
+    @asynccontextmanager
+    async def lock(_):
+        yield
+
+    handler._db.lock = Mock(side_effect=lock)
+    # (id, checkpointed credits & debits, new credits & debits), by chunks
+    handler._db.read = AsyncMock(side_effect=[
+        [[1, 10., 5., 2., 0.], [2, 0., 0., 0., 0.]],
+        [[4, 0., 0., 0., 0.], [7, 3., 0., 0., 1.]],
+        [[8, 0., 0., 0., 0.]],
+    ])
+    handler._db.insert_many = AsyncMock()
+    with patch("database.Database.pin_primary") as pin_primary:
+        await handler.checkpoint_balances()
+    handler._db.lock.assert_called_once_with("balance_checkpoints")
+    # the balances are read from the primary, without locking anything
+    pin_primary.assert_called_once()
+    query, args = handler._db.read.call_args_list[0].args
+    assert query.startswith("SELECT a.id, ")
+    assert query.endswith("WHERE a.id > %s ORDER BY a.id LIMIT %s")
+    assert "FOR UPDATE" not in query
+    # the checkpoint is taken behind the current time, after the last
+    # account of the previous chunk
+    assert [c.args[1] for c in handler._db.read.call_args_list] == [
+        (1710137520,) * 3 + (0, 2),
+        (1710137520,) * 3 + (2, 2),
+        (1710137520,) * 3 + (7, 2),
+    ]
+    # accounts without new transfers are skipped
+    fields = ("account_id", "`utc_timestamp`", "credits", "debits")
+    assert [c.args for c in handler._db.insert_many.call_args_list] == [
+        (hd.Tables.balance_checkpoints, fields, [(1, 1710137520, 12., 5.)]),
+        (hd.Tables.balance_checkpoints, fields, [(7, 1710137520, 3., 1.)]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_Handler_get_balances_cached():
+    channel = hd.InvalidationChannel()
+    channel.publish = AsyncMock()
+    channel.subscribe = Mock()
+    handler = hd.Handler(
+        Mock(), hd.HandlerConfig(balance_cache_size=10), invalidation=channel)
+    # the handler drops the balances published by other workers
+    channel.subscribe.assert_called_once_with(handler.invalidate_balances)
+    handler._db.read = AsyncMock(
+        side_effect=[[[1, 10, 0, 0]], [[1, 10, 5, 0]]])
+    expected = models.Balances(account_id=1, deposit=10., balance=10.)
+    assert await handler.get_balances(1) == expected
+    # the balances are cached
+    assert await handler.get_balances(1) == expected
+    handler._db.read.assert_awaited_once()
+
+    # a transfer drops the balances of both accounts, in all workers
+    tx = mock_transaction(handler._db)
+    tx.insert.return_value = 123
+    await handler.transfer(2, 1, 5.)
+    channel.publish.assert_awaited_once_with([2, 1])
+    balances = await handler.get_balances(1)
+    assert balances.credits == 5.
+    assert handler._db.read.await_count == 2
+
+    # as well as a batch
+    tx.insert_many.return_value = [124]
+    await handler.transfer_batch([
+        models.TransferRequest(source_id=1, target_id=2, amount=1.)])
+    channel.publish.assert_awaited_with([1, 2])
+    stats = handler.stats()["caches"]["balances"]
+    assert (stats["size"], stats["hits"], stats["misses"]) == (0, 1, 2)
+
+
+@pytest.mark.asyncio
+async def test_Handler_get_balances_invalidated_while_read():
+    handler = hd.Handler(Mock(), hd.HandlerConfig(balance_cache_size=10))
+    reading, transferred = asyncio.Event(), asyncio.Event()
+
+    async def read(*_):
+        # the read sees the balances before the transfer
+        reading.set()
+        await transferred.wait()
+        return [[1, 10, 0, 0]]
+
+    handler._db.read = AsyncMock(side_effect=read)
+    balances = asyncio.ensure_future(handler.get_balances(1))
+    await reading.wait()
+    tx = mock_transaction(handler._db)
+    tx.insert.return_value = 123
+    await handler.transfer(2, 1, 5.)
+    transferred.set()
+    assert (await balances).balance == 10.
+    # the stale balances were not cached: the next read sees the transfer
+    handler._db.read = AsyncMock(return_value=[[1, 10, 5, 0]])
+    assert (await handler.get_balances(1)).balance == 15.
+    # and those are cached
+    assert (await handler.get_balances(1)).balance == 15.
+    handler._db.read.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_Handler_get_balances_coalesced():
+    handler = hd.Handler(Mock())
+
+    async def read(_, args):
+        await asyncio.sleep(0)
+        return [[account_id, 10, 0, 0] for account_id in args]
+
+    handler._db.read = AsyncMock(side_effect=read)
+    results = await asyncio.gather(
+        handler.get_balances(1),
+        handler.get_balances(1),
+        handler.get_balances(2),
+    )
+    assert [b.account_id for b in results] == [1, 1, 2]
+    # the concurrent identical reads share a single lookup,
+    # and the concurrent lookups a single query
+    handler._db.read.assert_awaited_once()
+    assert handler._db.read.call_args.args[1] == (1, 2)
+
+    # reads pinned to the primary don't share the replicas' results
+    async def pinned_read():
+        handler.pin_primary()
+        return await handler.get_balances(1)
+
+    await asyncio.gather(handler.get_balances(1), pinned_read())
+    assert handler._db.read.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_Handler_reads_coalesced_before_write():
+    handler = hd.Handler(Mock())
+    reading, transferred = asyncio.Event(), asyncio.Event()
+
+    async def read(*_):
+        # the first read sees the balances before the transfer
+        if not reading.is_set():
+            reading.set()
+            await transferred.wait()
+            return [[1, 10, 0, 0]]
+        return [[1, 10, 5, 0]]
+
+    handler._db.read = AsyncMock(side_effect=read)
+    before = asyncio.ensure_future(handler.get_balances(1))
+    await reading.wait()
+    tx = mock_transaction(handler._db)
+    tx.insert.return_value = 123
+    await handler.transfer(2, 1, 5.)
+    # a read starting once the transfer is acknowledged sees it
+    after = asyncio.ensure_future(handler.get_balances(1))
+    await asyncio.sleep(0)
+    transferred.set()
+    assert (await before).balance == 10.
+    assert (await after).balance == 15.
+
+    # so does a read of the accounts starting once one is created
+    tx.insert_or_get.return_value = 456
+    epoch = handler._write_epoch(None)
+    await handler.create_account("John", 10.)
+    assert handler._write_epoch(None) == epoch + 1
+
+
+@pytest.mark.parametrize("precomputed_balances", [False, True])
+@pytest.mark.asyncio
+async def test_Handler_lookups_batched(precomputed_balances: bool):
+    handler = hd.Handler(Mock(), hd.HandlerConfig(
+        precomputed_balances=precomputed_balances))
+    handler._db.read = AsyncMock(side_effect=[
+        [[1, 456, 10.], [2, 789, 20.]],  # account 3 doesn't exist
+        [[1, 10., 5., 0.]],
+    ])
+    results = await asyncio.gather(
+        handler.get_accounts(1),
+        handler.get_accounts(2),
+        handler.get_accounts(3),
+        return_exceptions=True,
+    )
+    assert results[:2] == [
+        [models.Account(id=1, owner_id=456, deposit=10.)],
+        [models.Account(id=2, owner_id=789, deposit=20.)],
+    ]
+    assert isinstance(results[2], exc.NotFoundException)
+    # the 3 lookups are made by a single query
+    assert handler._db.read.call_args.args == (
+        "SELECT id, owner_id, deposit FROM accounts "
+        "WHERE id IN (%s, %s, %s)",
+        (1, 2, 3),
+    )
+
+    balances = await handler.get_balances(1)
+    assert balances.balance == 15.
+    query, args = handler._db.read.call_args.args
+    assert query.endswith("WHERE a.id IN (%s)")
+    assert args == (1,)
+
+
+@pytest.mark.asyncio
+async def test_Handler_transfer_publish_failure():
+    channel = hd.InvalidationChannel()
+    channel.publish = AsyncMock(side_effect=ConnectionError("error"))
+    handler = hd.Handler(Mock(), invalidation=channel)
+    tx = mock_transaction(handler._db)
+    tx.insert.return_value = 123
+    # the transfer is committed anyway
+    transfer = await handler.transfer(1, 2, 5.)
+    assert transfer.id == 123
+
+
+@pytest.mark.asyncio
+async def test_InvalidationChannel():
+    # the default channel doesn't reach any other worker
+    channel = hd.InvalidationChannel()
+    channel.subscribe(Mock())
+    await channel.publish([1, 2])
+
+
+@pytest.mark.asyncio
+async def test_Handler_backfill_balances():
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        tx = mock_transaction(handler._db)
+        await handler.backfill_balances()
+        backfill, clear = tx.execute.call_args_list
+        assert backfill.args[0].startswith(
+            "INSERT INTO balances (id, credits, debits) SELECT a.id, ")
+        # the shards' credits & debits are now in the balances
+        assert clear.args == ("DELETE FROM balance_shards",)
+
+
+@pytest.mark.asyncio
+async def test_Handler_fold_balance_shards():
+    handler = hd.Handler(Mock())
+
+    @asynccontextmanager
+    async def lock(_):
+        yield
+
+    handler._db.lock = Mock(side_effect=lock)
+    tx = mock_transaction(handler._db)
+    tx.execute.side_effect = [[[9, 30., 5.], [4, 10., 0.]], [], []]
+    await handler.fold_balance_shards()
+    handler._db.lock.assert_called_once_with("fold_balance_shards")
+    select, update, delete = tx.execute.call_args_list
+    assert select.args == (
+        "SELECT id, SUM(credits), SUM(debits) FROM balance_shards "
+        "GROUP BY id FOR UPDATE",)
+    # the sums are added to the balances, in id order
+    assert update.args == (
+        hd.balances_update_query(2), (4, 10., 0., 9, 30., 5.))
+    assert delete.args == (
+        "DELETE FROM balance_shards WHERE id IN (%s, %s)", (4, 9))
+
+    # nothing to fold
+    tx.execute.reset_mock(side_effect=True)
+    tx.execute.return_value = []
+    await handler.fold_balance_shards()
+    tx.execute.assert_awaited_once()
+
+
 @pytest.mark.parametrize(
     "account_id,transfer_type,expected",
     [
@@ -254,24 +1176,277 @@ async def test_Handler_get_transfer_history(
         handler = await hd.Handler.create()
         match (account_id, transfer_type):
             case (0, _):  # This account doesn't exist in the DB
-                handler._db.execute = AsyncMock(return_value=[])
+                handler._db.read = AsyncMock(return_value=[])
             case (_, models.TransferType.any):
-                handler._db.execute = AsyncMock(side_effect=[
-                    [[account_id, "Kevin"]],
-                    [[1, 456, 1710137580, 100.], [3, 789, 1710137600, 25.]],
-                    [[2, 789, 1710137590, 200.]],
+                handler._db.read = AsyncMock(side_effect=[
+                    [[account_id]],
+                    [
+                        [1, "credit", 456, 123, 1710137580, 100.],
+                        [2, "debit", 123, 789, 1710137590, 200.],
+                        [3, "credit", 789, 123, 1710137600, 25.],
+                    ],
                 ])
             case (_, models.TransferType.credit):
-                handler._db.execute = AsyncMock(side_effect=[
-                    [[account_id, "Kevin"]],
-                    [[1, 456, 1710137580, 100.], [3, 789, 1710137600, 25.]],
+                handler._db.read = AsyncMock(side_effect=[
+                    [[account_id]],
+                    [
+                        [1, "credit", 456, 123, 1710137580, 100.],
+                        [3, "credit", 789, 123, 1710137600, 25.],
+                    ],
                 ])
             case (_, models.TransferType.debit):
-                handler._db.execute = AsyncMock(side_effect=[
-                    [[account_id, "Kevin"]],
-                    [[2, 789, 1710137590, 200.]],
+                handler._db.read = AsyncMock(side_effect=[
+                    [[account_id]],
+                    [[2, "debit", 123, 789, 1710137590, 200.]],
                 ])
         with check_error(expected):
             transfers = await handler.get_transfer_history(
                 account_id, type_=transfer_type)
             assert transfers == expected
+
+
+@pytest.mark.parametrize(
+    "transfer_type,limit,after,expected_query",
+    [
+        (  # full credit history
+            models.TransferType.credit,
+            None,
+            None,
+            (
+                "SELECT id, 'credit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE to_id=%s "
+                "ORDER BY `utc_timestamp`, id",
+                (123,),
+            ),
+        ),
+        (  # page of debits
+            models.TransferType.debit,
+            2,
+            (1710137590, 2, "debit"),
+            (
+                "SELECT id, 'debit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE from_id=%s AND (`utc_timestamp` > %s "
+                "OR (`utc_timestamp` = %s AND id > %s)) "
+                "ORDER BY `utc_timestamp`, id LIMIT %s",
+                (123, 1710137590, 1710137590, 2, 2),
+            ),
+        ),
+        (  # full history: both branches are merged by the DB
+            models.TransferType.any,
+            None,
+            None,
+            (
+                "(SELECT id, 'credit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE to_id=%s) UNION ALL "
+                "(SELECT id, 'debit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE from_id=%s) "
+                "ORDER BY `utc_timestamp`, id, transfer_type",
+                (123, 123),
+            ),
+        ),
+        (  # page of history: each branch reads at most a page. The debit
+            # of transfer 2 comes after its credit
+            models.TransferType.any,
+            2,
+            (1710137590, 2, "credit"),
+            (
+                "(SELECT id, 'credit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE to_id=%s AND (`utc_timestamp` > %s "
+                "OR (`utc_timestamp` = %s AND id > %s)) "
+                "ORDER BY `utc_timestamp`, id LIMIT %s) UNION ALL "
+                "(SELECT id, 'debit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE from_id=%s AND (`utc_timestamp` > %s "
+                "OR (`utc_timestamp` = %s AND id >= %s)) "
+                "ORDER BY `utc_timestamp`, id LIMIT %s) "
+                "ORDER BY `utc_timestamp`, id, transfer_type LIMIT %s",
+                (
+                    123, 1710137590, 1710137590, 2, 2,
+                    123, 1710137590, 1710137590, 2, 2,
+                    2,
+                ),
+            ),
+        ),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Handler_get_transfer_history_query(
+        transfer_type: models.TransferType,
+        limit: int | None,
+        after: tuple[int, int, str] | None,
+        expected_query: tuple[str, tuple]
+):
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        handler._db.read = AsyncMock(side_effect=[[[123]], []])
+        transfers = await handler.get_transfer_history(
+            123, type_=transfer_type, limit=limit, after=after)
+        assert transfers == []
+        assert handler._db.read.call_args.args == expected_query
+
+
+@pytest.mark.parametrize(
+    "since,until,expected_query",
+    [
+        (
+            1710137580,
+            1710137600,
+            (
+                "SELECT id, 'credit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE to_id=%s "
+                "AND `utc_timestamp` BETWEEN %s AND %s "
+                "AND (`utc_timestamp` > %s "
+                "OR (`utc_timestamp` = %s AND id > %s)) "
+                "ORDER BY `utc_timestamp`, id",
+                (
+                    123, 1710137580, 1710137600,
+                    1710137590, 1710137590, 2),
+            ),
+        ),
+        (
+            1710137580,
+            None,
+            (
+                "SELECT id, 'credit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE to_id=%s "
+                "AND `utc_timestamp` >= %s "
+                "AND (`utc_timestamp` > %s "
+                "OR (`utc_timestamp` = %s AND id > %s)) "
+                "ORDER BY `utc_timestamp`, id",
+                (123, 1710137580, 1710137590, 1710137590, 2),
+            ),
+        ),
+        (
+            None,
+            1710137600,
+            (
+                "SELECT id, 'credit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE to_id=%s "
+                "AND `utc_timestamp` <= %s "
+                "AND (`utc_timestamp` > %s "
+                "OR (`utc_timestamp` = %s AND id > %s)) "
+                "ORDER BY `utc_timestamp`, id",
+                (123, 1710137600, 1710137590, 1710137590, 2),
+            ),
+        ),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Handler_get_transfer_history_time_range(
+        since: int | None,
+        until: int | None,
+        expected_query: tuple[str, tuple]
+):
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        handler._db.read = AsyncMock(side_effect=[[[123]], []])
+        await handler.get_transfer_history(
+            123, type_=models.TransferType.credit,
+            after=(1710137590, 2, "debit"), since=since, until=until)
+        assert handler._db.read.call_args.args == expected_query
+
+
+@pytest.mark.asyncio
+async def test_Handler_get_transfer_history_self_transfer_pages():
+    handler = hd.Handler(Mock())
+    handler._accounts.set(1, True)
+    # transfer 2 is made from account 1 to itself: a credit & a debit
+    transfers = [(1, 1, 2), (2, 1, 1), (3, 2, 1)]
+    rows = sorted(
+        (1710137580, id_, type_, from_id, to_id)
+        for id_, from_id, to_id in transfers
+        for type_, account_id in (("credit", to_id), ("debit", from_id))
+        if account_id == 1
+    )
+
+    async def read(query: str, args: tuple) -> list:
+        # the DB runs each branch, then merges them by (utc_timestamp, id,
+        # type). Each branch's args: account, [after's keyset args,] limit
+        assert query.endswith(
+            "ORDER BY `utc_timestamp`, id, transfer_type LIMIT %s")
+        branches, size = query.split(" UNION ALL "), len(args) // 2
+        page = []
+        for i, type_ in enumerate(["credit", "debit"]):
+            branch_args = args[i * size:(i + 1) * size]
+            branch_rows = [r for r in rows if r[2] == type_]
+            if size > 2:
+                after = branch_args[1], branch_args[3]
+                inclusive = "id >= %s" in branches[i]
+                branch_rows = [
+                    r for r in branch_rows
+                    if r[:2] > after or (inclusive and r[:2] == after)]
+            page += branch_rows[:branch_args[-1]]
+        return [
+            [id_, type_, from_id, to_id, utc_timestamp, 1.]
+            for utc_timestamp, id_, type_, from_id, to_id
+            in sorted(page)[:args[-1]]
+        ]
+
+    handler._db.read = read
+    pages, after = [], None
+    while True:
+        page = await handler.get_transfer_history(1, limit=2, after=after)
+        if not page:
+            break
+        pages.append([(t.id, t.type.value) for t in page])
+        after = (page[-1].utc_timestamp, page[-1].id, page[-1].type.value)
+    # the page ending on the credit of transfer 2 is followed by its debit
+    assert pages == [
+        [(1, "debit"), (2, "credit")],
+        [(2, "debit"), (3, "credit")],
+    ]
+
+
+@pytest.mark.parametrize(
+    "account_id,expected",
+    [
+        (  # account does not exist: raised before iterating
+            0,
+            exc.NotFoundException("Account with id=0 doesn't exist"),
+        ),
+        (
+            123,
+            [
+                models.Transfer(
+                    id=1,
+                    utc_timestamp=1710137580,
+                    type=models.TransferType.credit,
+                    from_id=456,
+                    to_id=123,
+                    amount=100,
+                ),
+            ],
+        ),
+    ]
+)
+@pytest.mark.asyncio
+async def test_Handler_stream_transfer_history(
+        account_id: int,
+        expected: list[models.Transfer] | Exception
+):
+    with patch("database.Database.create", AsyncMock()):
+        handler = await hd.Handler.create()
+        handler._db.read = AsyncMock(
+            return_value=[[account_id]] if account_id else [])
+        handler._db.stream = Mock(return_value=async_iter([
+            [1, "credit", 456, 123, 1710137580, 100.],
+        ]))
+        with check_error(expected):
+            transfers = await handler.stream_transfer_history(
+                account_id, type_=models.TransferType.credit)
+            assert [t async for t in transfers] == expected
+            assert handler._db.stream.call_args.args == (
+                "SELECT id, 'credit' AS transfer_type, from_id, to_id, "
+                "`utc_timestamp`, amount "
+                "FROM transfers WHERE to_id=%s "
+                "ORDER BY `utc_timestamp`, id",
+                (123,),
+            )
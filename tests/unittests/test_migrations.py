@@ -0,0 +1,79 @@
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from freezegun import freeze_time
+
+from .context import migrations, database as db
+
+
+def test_MIGRATIONS_versions():
+    # versions are unique and ordered
+    versions = [m.version for m in migrations.MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+
+
+@freeze_time("2024-03-11T06:13:00Z")
+@pytest.mark.asyncio
+async def test_migrate():
+    mydb = Mock()
+
+    @asynccontextmanager
+    async def lock(_):
+        yield
+
+    mydb.lock = Mock(side_effect=lock)
+    mydb.execute = AsyncMock(side_effect=[
+        [[1]],  # version 1 is already applied
+        [],
+        [],
+        [],
+    ])
+    mydb.insert = AsyncMock()
+    await migrations.migrate(mydb, migrations=[
+        migrations.Migration(3, "third", ("QUERY 3",)),
+        migrations.Migration(1, "first", ("QUERY 1",)),
+        migrations.Migration(2, "second", ("QUERY 2a", "QUERY 2b")),
+    ])
+
+    mydb.lock.assert_called_once_with("schema_migrations")
+    queries = [c.args[0] for c in mydb.execute.call_args_list]
+    assert queries == [
+        "SELECT version FROM schema_versions",
+        "QUERY 2a",
+        "QUERY 2b",
+        "QUERY 3",
+    ]
+    inserted = [c.args for c in mydb.insert.call_args_list]
+    assert inserted == [
+        (
+            db.Tables.schema_versions,
+            "version", 2,
+            "description", "second",
+            "`utc_timestamp`", 1710137580,
+        ),
+        (
+            db.Tables.schema_versions,
+            "version", 3,
+            "description", "third",
+            "`utc_timestamp`", 1710137580,
+        ),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_migrate_default_migrations():
+    mydb = Mock()
+
+    @asynccontextmanager
+    async def lock(_):
+        yield
+
+    mydb.lock = Mock(side_effect=lock)
+    # everything already applied
+    mydb.execute = AsyncMock(
+        return_value=[[m.version] for m in migrations.MIGRATIONS])
+    mydb.insert = AsyncMock()
+    await migrations.migrate(mydb)
+    mydb.execute.assert_awaited_once()
+    mydb.insert.assert_not_awaited()
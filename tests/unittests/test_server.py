@@ -1,9 +1,10 @@
-from unittest.mock import Mock, AsyncMock, patch
+from unittest.mock import MagicMock, Mock, AsyncMock, patch
 
 import pytest
 from fastapi.testclient import TestClient
 
 from .context import server, exceptions as exc, models
+from .utils import async_iter
 
 # By default the TestClient will raise any exceptions that occur in the
 # application.
@@ -110,6 +111,14 @@ test_cases = [
         {"error": "INTERNAL_ERROR", "message": "Oops! Something went wrong!"},
         500,
     ),
+    (  # make transfer exceeding the source account's balance
+        "POST",
+        "/transfer",
+        {"source_id": 1, "target_id": 2, "amount": 100},
+        exc.InsufficientFundsException("insufficient funds"),
+        {"error": "INSUFFICIENT_FUNDS", "message": "insufficient funds"},
+        409,
+    ),
     (  # get transfer history
         "GET",
         "/transfer/history",
@@ -165,7 +174,7 @@ def mock_handler(
     if `err` is not None, the handler will raise this error
     otherwise it will return modelled data
     """
-    handler = Mock()
+    handler = MagicMock()
     if err is not None:
         handler.create_account = AsyncMock(side_effect=err)
         handler.get_accounts = AsyncMock(side_effect=err)
@@ -223,12 +232,278 @@ def test_routes(
     server.handler = None
 
 
+@pytest.mark.parametrize(
+    "handler_error,response_body,response_status_code",
+    [
+        (  # successful transfers
+            None,
+            [
+                {
+                    "id": 1,
+                    "utc_timestamp": 1710137580,
+                    "from_id": 1,
+                    "to_id": 2,
+                    "amount": 10.
+                },
+                {
+                    "id": 2,
+                    "utc_timestamp": 1710137580,
+                    "from_id": 2,
+                    "to_id": 3,
+                    "amount": 5.
+                },
+            ],
+            201,
+        ),
+        (  # unexpected error
+            ValueError("amount is negative!"),
+            {"error": "INTERNAL_ERROR", "message": "Oops! Something went wrong!"},
+            500,
+        ),
+    ]
+)
+def test_transfer_batch(
+        handler_error: Exception | None,
+        response_body: dict | list[dict],
+        response_status_code: int,
+):
+    server.handler = MagicMock()
+    if handler_error is not None:
+        server.handler.transfer_batch = AsyncMock(side_effect=handler_error)
+    else:
+        server.handler.transfer_batch = AsyncMock(
+            return_value=[models.Transfer(**d) for d in response_body])
+
+    body = [
+        {"source_id": 1, "target_id": 2, "amount": 10.},
+        {"source_id": 2, "target_id": 3, "amount": 5.},
+    ]
+    res = client.post("/transfers/batch", json=body)
+    assert res.status_code == response_status_code
+    assert res.json() == response_body
+    transfers = server.handler.transfer_batch.call_args.args[0]
+    assert transfers == [models.TransferRequest(**d) for d in body]
+    server.handler = None
+
+
+@pytest.mark.parametrize(
+    "params,expected_after,expected_cursor",
+    [
+        ({}, None, None),  # no pagination
+        ({"limit": 3}, None, None),  # last page
+        (  # full page
+            {"limit": 2},
+            None,
+            "MTcxMDEzNzU5MDoyOmNyZWRpdA==",
+        ),
+        (  # next page
+            {"limit": 2, "cursor": "MTcxMDEzNzU5MDoyOmNyZWRpdA=="},
+            (1710137590, 2, "credit"),
+            "MTcxMDEzNzU5MDoyOmNyZWRpdA==",
+        ),
+    ]
+)
+def test_get_transfer_history_pages(
+        params: dict,
+        expected_after: tuple[int, int, str] | None,
+        expected_cursor: str | None
+):
+    transfers = [
+        models.Transfer(
+            id=1, type=models.TransferType.credit, utc_timestamp=1710137580,
+            from_id=2, to_id=1, amount=1),
+        models.Transfer(
+            id=2, type=models.TransferType.credit, utc_timestamp=1710137590,
+            from_id=2, to_id=1, amount=1),
+    ]
+    server.handler = MagicMock()
+    server.handler.get_transfer_history = AsyncMock(return_value=transfers)
+    res = client.get(
+        "/transfer/history", params={"account_id": 1, **params})
+    assert res.status_code == 200
+    assert len(res.json()) == 2
+    assert res.headers.get("X-Next-Cursor") == expected_cursor
+    kwargs = server.handler.get_transfer_history.call_args.kwargs
+    assert kwargs["limit"] == params.get("limit")
+    assert kwargs["after"] == expected_after
+    server.handler = None
+
+
+def test_get_transfer_history_time_range():
+    server.handler = MagicMock()
+    server.handler.get_transfer_history = AsyncMock(return_value=[])
+    res = client.get("/transfer/history", params={
+        "account_id": 1, "since": 1710137580, "until": 1710137600})
+    assert res.status_code == 200
+    kwargs = server.handler.get_transfer_history.call_args.kwargs
+    assert kwargs["since"] == 1710137580
+    assert kwargs["until"] == 1710137600
+    server.handler = None
+
+
+def test_get_transfer_history_invalid_cursor():
+    server.handler = MagicMock()
+    res = client.get(
+        "/transfer/history", params={"account_id": 1, "cursor": "&&&"})
+    assert res.status_code == 400
+    assert res.json() == {
+        "error": "BAD_REQUEST", "message": "Invalid cursor=&&&"}
+    server.handler = None
+
+
+@pytest.mark.parametrize(
+    "params,headers",
+    [
+        ({"stream": "true"}, {}),
+        ({}, {"Accept": "application/x-ndjson"}),
+    ]
+)
+def test_get_accounts_ndjson(params: dict, headers: dict):
+    server.handler = MagicMock()
+    server.handler.stream_accounts = Mock(return_value=async_iter([
+        models.Account(id=123, owner_id=456, deposit=234.56),
+        models.Account(id=111, owner_id=456, deposit=100.),
+    ]))
+    res = client.get("/account", params=params, headers=headers)
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    assert res.text == (
+        '{"id":123,"owner_id":456,"deposit":234.56}\n'
+        '{"id":111,"owner_id":456,"deposit":100.0}\n'
+    )
+    server.handler = None
+
+
+@pytest.mark.parametrize(
+    "handler_error,response_body,response_status_code",
+    [
+        (
+            None,
+            (
+                '{"id":1,"type":"credit","utc_timestamp":1710137580,'
+                '"from_id":1,"to_id":123,"amount":100.0}\n'
+            ),
+            200,
+        ),
+        (  # the account's existence is checked before streaming
+            exc.NotFoundException("account does not exist"),
+            '{"error":"NOT_FOUND","message":"account does not exist"}',
+            404,
+        ),
+    ]
+)
+def test_get_transfer_history_ndjson(
+        handler_error: Exception | None,
+        response_body: str,
+        response_status_code: int
+):
+    server.handler = MagicMock()
+    server.handler.stream_transfer_history = AsyncMock(
+        side_effect=handler_error,
+        return_value=async_iter([
+            models.Transfer(
+                id=1, type=models.TransferType.credit,
+                utc_timestamp=1710137580, from_id=1, to_id=123, amount=100),
+        ]))
+    res = client.get(
+        "/transfer/history", params={"account_id": 123, "stream": "true"})
+    assert res.status_code == response_status_code
+    assert res.text == response_body
+    server.handler = None
+
+
 def test_ping():
     res = client.get("/ping")
     assert res.status_code == 200
     assert res.text == "OK!"
 
 
+def test_get_balances_as_of():
+    server.handler = MagicMock()
+    server.handler.get_balances = AsyncMock(return_value=models.Balances(
+        account_id=1, deposit=10.))
+    res = client.get(
+        "/account/balances", params={"account_id": 1, "as_of": 1710137580})
+    assert res.status_code == 200
+    server.handler.get_balances.assert_awaited_once_with(1, as_of=1710137580)
+    server.handler = None
+
+
+@pytest.mark.parametrize(
+    "headers,pinned",
+    [
+        ({}, False),
+        ({"X-Read-Your-Writes": "true"}, True),
+    ]
+)
+def test_read_your_writes(headers: dict, pinned: bool):
+    server.handler = MagicMock()
+    server.handler.get_balances = AsyncMock(return_value=models.Balances(
+        account_id=1, deposit=10.))
+    res = client.get(
+        "/account/balances", params={"account_id": 1}, headers=headers)
+    assert res.status_code == 200
+    assert server.handler.pin_primary.called == pinned
+    server.handler = None
+
+
+@pytest.mark.parametrize(
+    "path,params,method_name,response",
+    [
+        (
+            "/transfer",
+            {"source_id": 1, "target_id": 2, "amount": 5.},
+            "transfer",
+            models.Transfer(
+                id=1, utc_timestamp=1710137580, from_id=1, to_id=2,
+                amount=5.),
+        ),
+        (
+            "/account",
+            {"customer": "John", "deposit": 10.},
+            "create_account",
+            models.Account(id=1, owner_id=2, deposit=10.),
+        ),
+    ]
+)
+def test_idempotency_key(
+        path: str, params: dict, method_name: str, response
+):
+    server.handler = MagicMock()
+    method = AsyncMock(return_value=response)
+    setattr(server.handler, method_name, method)
+    res = client.post(path, params=params, headers={"Idempotency-Key": "key"})
+    assert res.status_code == 201
+    assert method.call_args.kwargs == {"idempotency_key": "key"}
+
+    # too long keys are rejected
+    res = client.post(
+        path, params=params, headers={"Idempotency-Key": "k" * 256})
+    assert res.status_code == 422
+    server.handler = None
+
+
+def test_request_connections():
+    server.handler = MagicMock()
+    server.handler.get_balances = AsyncMock(return_value=models.Balances(
+        account_id=1, deposit=10.))
+    res = client.get("/account/balances", params={"account_id": 1})
+    assert res.status_code == 200
+    # the request's queries are run within a request scope
+    server.handler.request_scope.assert_called_once()
+    server.handler.request_scope.return_value.__aexit__.assert_awaited_once()
+    server.handler = None
+
+
+def test_stats():
+    server.handler = MagicMock()
+    server.handler.stats = Mock(return_value={"pool": {"size": 1}})
+    res = client.get("/stats")
+    assert res.status_code == 200
+    assert res.json() == {"pool": {"size": 1}}
+    server.handler = None
+
+
 @pytest.mark.asyncio
 async def test_lifespan():
     # successful creation
@@ -1,10 +1,12 @@
+import asyncio
 import logging
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 
 import pytest
 from freezegun import freeze_time
 
-from .context import utils
+from .context import utils, exceptions as exc
+from .utils import check_error
 from .utils import set_environments
 
 
@@ -15,6 +17,42 @@ def test_get_utc_timestamp():
     assert res == expected, f"Expecting {expected}, got {res} instead"
 
 
+def test_encode_cursor():
+    cursor = utils.encode_cursor(1710137580, 123, "credit")
+    assert utils.decode_cursor(cursor) == (1710137580, 123, "credit")
+
+
+@pytest.mark.parametrize(
+    "cursor,expected",
+    [
+        ("MTcxMDEzNzU4MDoxMjM6ZGViaXQ=", (1710137580, 123, "debit")),
+        ("&&&", exc.BadRequestException("Invalid cursor=&&&")),  # not base64
+        (  # not utf-8
+            "__8=",
+            exc.BadRequestException("Invalid cursor=__8="),
+        ),
+        (  # not a timestamp:id:type triple
+            "MTcxMDEzNzU4MA==",
+            exc.BadRequestException("Invalid cursor=MTcxMDEzNzU4MA=="),
+        ),
+        (  # no type
+            "MTcxMDEzNzU4MDoxMjM=",
+            exc.BadRequestException("Invalid cursor=MTcxMDEzNzU4MDoxMjM="),
+        ),
+        (  # unknown type
+            "MTcxMDEzNzU4MDoxMjM6YW55",
+            exc.BadRequestException("Invalid cursor=MTcxMDEzNzU4MDoxMjM6YW55"),
+        ),
+    ]
+)
+def test_decode_cursor(
+        cursor: str,
+        expected: tuple[int, int, str] | Exception
+):
+    with check_error(expected):
+        assert utils.decode_cursor(cursor) == expected
+
+
 @pytest.mark.parametrize(
     "status_code,expected",
     [
@@ -31,6 +69,49 @@ def test_server_log_message(status_code: int, expected: str):
     assert mess == expected
 
 
+@pytest.mark.parametrize(
+    "value,default,expected",
+    [
+        (None, False, False),  # unset
+        (None, True, True),  # unset, with default
+        ("1", False, True),
+        ("0", True, False),
+        ("unknown", True, True),  # wrong format
+    ]
+)
+def test_get_env_flag(value: str | None, default: bool, expected: bool):
+    envs = {"MY_FLAG": value} if value is not None else {}
+    with set_environments(envs):
+        assert utils.get_env_flag("MY_FLAG", default=default) == expected
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, 10),  # unset
+        ("20", 20),
+        ("many", 10),  # wrong format
+    ]
+)
+def test_get_env_int(value: str | None, expected: int):
+    envs = {"MY_INT": value} if value is not None else {}
+    with set_environments(envs):
+        assert utils.get_env_int("MY_INT", 10) == expected
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, {}),  # unset
+        ("12:16,42:8", {12: 16, 42: 8}),
+        ("12:16,42", {}),  # wrong format
+    ]
+)
+def test_get_env_int_map(value: str | None, expected: dict[int, int]):
+    envs = {"MY_MAP": value} if value is not None else {}
+    with set_environments(envs):
+        assert utils.get_env_int_map("MY_MAP") == expected
+
 
 @pytest.mark.parametrize(
     "debug,expected_level",
@@ -44,3 +125,285 @@ def test_get_logger(debug: str, expected_level: int):
     with set_environments({"DEBUG": debug}):
         logger: logging.Logger = utils.get_logger(__name__)
         assert logger.level == expected_level
+
+
+def test_LRUCache():
+    cache = utils.LRUCache(2)
+    cache.set("John", 1)
+    cache.set("Kevin", 2)
+    assert cache.get("John") == 1
+    # Kevin is the least recently used: it is evicted
+    cache.set("Paul", 3)
+    assert len(cache) == 2
+    assert cache.get("Kevin") is None
+    assert cache.get("Kevin", 0) == 0
+    assert cache.get("John") == 1
+    assert cache.get("Paul") == 3
+    # updating a value
+    cache.set("John", 4)
+    assert cache.get("John") == 4
+    assert len(cache) == 2
+
+
+def test_LRUCache_disabled():
+    cache = utils.LRUCache(0)
+    cache.set("John", 1)
+    assert len(cache) == 0
+    assert cache.get("John") is None
+
+
+@freeze_time("2024-03-11T06:13:00Z")
+def test_LRUCache_ttl():
+    cache = utils.LRUCache(2, ttl=10)
+    cache.set("John", 1)
+    with freeze_time("2024-03-11T06:13:09Z"):
+        assert cache.get("John") == 1
+    with freeze_time("2024-03-11T06:13:10Z"):
+        assert cache.get("John") is None
+        assert len(cache) == 0
+
+
+def test_LRUCache_pop():
+    cache = utils.LRUCache(2)
+    cache.set("John", 1)
+    assert cache.pop("John") == 1
+    assert cache.pop("John") is None
+    assert cache.get("John") is None
+
+
+@freeze_time("2024-03-11T06:13:00Z")
+def test_LRUCache_stats():
+    cache = utils.LRUCache(1, ttl=10)
+    assert cache.stats()["hit_rate"] == 0.
+    cache.set("John", 1)
+    cache.get("John")
+    cache.get("Kevin")
+    cache.set("Kevin", 2)  # John is evicted
+    cache.pop("Kevin")  # not counted as a lookup
+    cache.set("Paul", 3)
+    with freeze_time("2024-03-11T06:13:10Z"):
+        cache.get("Paul")  # expired
+    assert cache.stats() == {
+        "size": 0,
+        "maxsize": 1,
+        "hits": 1,
+        "misses": 2,
+        "hit_rate": 1 / 3,
+        "evictions": 1,
+        "expirations": 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_SingleFlight():
+    flight = utils.SingleFlight()
+    calls = 0
+
+    async def read() -> int:
+        nonlocal calls
+        calls += 1
+        call = calls
+        await asyncio.sleep(0)
+        return call
+
+    # concurrent calls with the same key share the same call
+    results = await asyncio.gather(
+        flight.do("a", read), flight.do("a", read), flight.do("b", read))
+    assert results == [1, 1, 2]
+    assert len(flight) == 0
+    # the call is over: the next one runs again
+    assert await flight.do("a", read) == 3
+
+
+@pytest.mark.asyncio
+async def test_SingleFlight_error():
+    flight = utils.SingleFlight()
+    read = AsyncMock(side_effect=ValueError("error"))
+    results = await asyncio.gather(
+        flight.do("a", read), flight.do("a", read), return_exceptions=True)
+    assert [str(r) for r in results] == ["error", "error"]
+    read.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_SingleFlight_cancelled_caller():
+    flight = utils.SingleFlight()
+    event = asyncio.Event()
+
+    async def read() -> int:
+        await event.wait()
+        return 1
+
+    first = asyncio.ensure_future(flight.do("a", read))
+    second = asyncio.ensure_future(flight.do("a", read))
+    await asyncio.sleep(0)
+    first.cancel()
+    event.set()
+    # the call goes on for the other callers
+    assert await second == 1
+
+
+@pytest.mark.asyncio
+async def test_StripedLock():
+    locks = utils.StripedLock(4)
+    order = []
+
+    async def transfer(name: str, *account_ids: int):
+        async with locks.hold(*account_ids):
+            order.append(f"{name} starts")
+            await asyncio.sleep(0)
+            order.append(f"{name} ends")
+
+    # keys sharing a stripe (1 & 5) wait for each other, in any order.
+    # The others don't wait
+    await asyncio.gather(
+        transfer("a", 2, 1), transfer("b", 5, 2), transfer("c", 3))
+    assert order == [
+        "a starts", "c starts", "a ends", "c ends", "b starts", "b ends"]
+
+
+def test_StripedLock_invalid():
+    with pytest.raises(ValueError):
+        utils.StripedLock(0)
+
+
+@pytest.mark.asyncio
+async def test_BatchLoader():
+    load_many = AsyncMock(side_effect=lambda keys: {
+        key: key * 10 for key in keys if key != 3})
+    loader = utils.BatchLoader(load_many, max_batch_size=3)
+    results = await asyncio.gather(*[
+        loader.load(key) for key in [1, 2, 1, 3, 4]])
+    # each caller gets its own key's value, None if it wasn't found
+    assert results == [10, 20, 10, None, 40]
+    # the batches are loaded at once, up to 3 keys per batch
+    assert [c.args[0] for c in load_many.call_args_list] == [[1, 2, 3], [4]]
+
+
+@pytest.mark.asyncio
+async def test_BatchLoader_delay():
+    load_many = AsyncMock(side_effect=lambda keys: {key: key for key in keys})
+    loader = utils.BatchLoader(load_many, delay=0.01)
+
+    async def load_later(key: int) -> int:
+        await asyncio.sleep(0.001)
+        return await loader.load(key)
+
+    # the keys loaded during the delay join the batch
+    assert await asyncio.gather(loader.load(1), load_later(2)) == [1, 2]
+    load_many.assert_awaited_once_with([1, 2])
+
+
+@pytest.mark.asyncio
+async def test_BatchLoader_error():
+    load_many = AsyncMock(side_effect=ValueError("error"))
+    loader = utils.BatchLoader(load_many)
+    results = await asyncio.gather(
+        loader.load(1), loader.load(2), return_exceptions=True)
+    assert [str(r) for r in results] == ["error", "error"]
+    load_many.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_BatchWriter():
+    write_many = AsyncMock(side_effect=lambda items: [i * 10 for i in items])
+    writer = utils.BatchWriter(write_many, batch_size=2, max_wait=0.01)
+    results = await asyncio.gather(*[writer.write(i) for i in [1, 2, 3]])
+    # each writer gets its own result
+    assert results == [10, 20, 30]
+    # the queued items are written by batches of 2
+    assert [c.args[0] for c in write_many.call_args_list] == [[1, 2], [3]]
+    assert len(writer) == 0
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_BatchWriter_max_wait():
+    write_many = AsyncMock(side_effect=lambda items: items)
+    writer = utils.BatchWriter(write_many, max_wait=0.01)
+
+    async def write_later(item: int, delay: float) -> int:
+        await asyncio.sleep(delay)
+        return await writer.write(item)
+
+    # the items queued within the max wait join the batch
+    assert await asyncio.gather(
+        writer.write(1), write_later(2, 0.001), write_later(3, 0.05)
+    ) == [1, 2, 3]
+    assert [c.args[0] for c in write_many.call_args_list] == [[1, 2], [3]]
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_BatchWriter_backpressure():
+    event = asyncio.Event()
+
+    async def write_many(items: list) -> list:
+        await event.wait()
+        return items
+
+    writer = utils.BatchWriter(write_many, batch_size=1, max_queue_size=1)
+    first = asyncio.ensure_future(writer.write(1))
+    await asyncio.sleep(0.001)  # 1 is being written
+    second = asyncio.ensure_future(writer.write(2))
+    third = asyncio.ensure_future(writer.write(3))
+    await asyncio.sleep(0.001)
+    # 2 is queued, 3 waits for some room
+    assert len(writer) == 1
+    event.set()
+    assert await asyncio.gather(first, second, third) == [1, 2, 3]
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_BatchWriter_error():
+    write_many = AsyncMock(side_effect=ValueError("error"))
+    writer = utils.BatchWriter(write_many)
+    results = await asyncio.gather(
+        writer.write(1), writer.write(2), return_exceptions=True)
+    assert [str(r) for r in results] == ["error", "error"]
+    write_many.assert_awaited_once()
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_BatchWriter_close():
+    write_many = AsyncMock(side_effect=lambda items: items)
+    writer = utils.BatchWriter(write_many, max_wait=10)
+    # nothing was written yet
+    await utils.BatchWriter(write_many).close()
+
+    pending = asyncio.ensure_future(writer.write(1))
+    await asyncio.sleep(0)
+    # the queued items are written without waiting for the max wait
+    await writer.close()
+    assert await pending == 1
+    with pytest.raises(RuntimeError):
+        await writer.write(2)
+
+
+@pytest.mark.asyncio
+async def test_PeriodicTask():
+    done = asyncio.Event()
+    calls = 0
+
+    async def fold():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise ValueError("error")
+        done.set()
+
+    task = utils.PeriodicTask(fold, interval=0)
+    task.start()
+    task.start()  # already started
+    # the failed call doesn't stop the next ones
+    await asyncio.wait_for(done.wait(), 1)
+    await task.close()
+    assert calls >= 2
+
+
+@pytest.mark.asyncio
+async def test_PeriodicTask_close():
+    # nothing to stop
+    await utils.PeriodicTask(AsyncMock(), interval=60).close()
@@ -1,6 +1,7 @@
 import os
-from contextlib import contextmanager
-from typing import Any
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator
+from unittest.mock import AsyncMock, Mock
 
 
 @contextmanager
@@ -17,6 +18,75 @@ def set_environments(envs: dict[str, str]):
             del os.environ[key]
 
 
+async def async_iter(items: list) -> AsyncIterator:
+    """
+    Turn `items` into an async iterator, to mock streamed results
+    """
+    for item in items:
+        yield item
+
+
+def mock_transaction(db: Mock) -> Mock:
+    """
+    Mock the `transaction` method of the mocked database `db`
+    The returned transaction's methods are AsyncMocks, to be configured
+    and checked by the test
+    """
+    tx = Mock()
+    tx.execute = AsyncMock()
+    tx.insert = AsyncMock()
+    tx.insert_or_get = AsyncMock()
+    tx.insert_many = AsyncMock()
+
+    @asynccontextmanager
+    async def transaction():
+        yield tx
+
+    db.transaction = transaction
+    return tx
+
+
+def create_mock_pool(returned_data: list = None):
+    """
+    Mock the function aiomysql.create_pool
+    Mock the aiomysql.Pool.acquire method as well
+    """
+    pool = Mock()
+    pool.minsize, pool.maxsize, pool.size, pool.freesize = 1, 10, 1, 1
+
+    # Save the last connections & cursors for testing purpose
+    # (args & kwargs access for example)
+    pool.last_connections = []
+    pool.last_cursors = []
+
+    async def mocked_pool_acquire():
+        nonlocal pool
+        conn = Mock()
+        conn.commit = AsyncMock()
+        conn.rollback = AsyncMock()
+
+        @asynccontextmanager
+        async def cursor(*_):
+            nonlocal pool
+            curr = Mock()
+            curr.execute = AsyncMock()
+            curr.fetchall = AsyncMock(return_value=returned_data or [])
+            # server-side cursors: all rows are returned in one batch
+            curr.fetchmany = AsyncMock(
+                side_effect=[returned_data or [], []])
+            curr.lastrowid = len(pool.last_cursors)
+            pool.last_cursors.append(curr)
+            yield curr
+
+        conn.cursor = cursor
+        pool.last_connections.append(conn)
+        return conn
+
+    pool.acquire = mocked_pool_acquire
+    pool.release = AsyncMock()
+    return pool
+
+
 @contextmanager
 def check_error(expected: Any):
     """